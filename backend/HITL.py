@@ -1,43 +1,229 @@
-"""Functions for suggesting regions for user to label pre- and post- segmentation."""
+"""Functions for suggesting regions for user to label pre- and post- segmentation.
+
+Suggestions are the windows of the uncertainty maps of a user's last segmentation (or apply) with the highest mean
+uncertainty. Each map is summed over cells of side min(SUGGESTION_SIZES) // CANDIDATE_STRIDE in one O(HW) pass,
+then an integral image (summed area table) of the cell sums gives the sum of any window of cells in 4 lookups, so
+windows of every size are scored on a grid of stride size // CANDIDATE_STRIDE without touching the map again. The
+best few per image and size are pooled across the stack, and the top k that don't overlap each other are suggested.
+"""
 import numpy as np
 import matplotlib.pyplot as plt
 
-from typing import Tuple
+from threading import Lock
+from typing import Dict, List, Sequence, Tuple, TypeAlias
 
 N_W: int = 3
 N_H: int = 3
 DEBUG = False
 
+# side lengths (px) of square windows scored, capped at each image's size
+SUGGESTION_SIZES: Tuple[int, ...] = (32, 64, 128)
+N_SUGGESTIONS = 5
+# candidate windows are spaced size // CANDIDATE_STRIDE apart
+CANDIDATE_STRIDE = 4
+# candidates kept per image and size for each suggestion requested
+CANDIDATES_PER_SUGGESTION = 16
+
+# (image index, x0, y0, w, h, mean uncertainty in [0, 1])
+Suggestion: TypeAlias = Tuple[int, int, int, int, int, float]
+
 
 def find_least_certain_region(probs: np.ndarray) -> Tuple[int, int, int, int]:
     """Patch segmentation probs into N_W x N_H square, find total region uncertainty and return max.
 
-    :param probs: _description_
+    :param probs: (n_classes, h, w) arr of class probabilities
     :type probs: np.ndarray
-    :return: _description_
+    :return: grid x and y of the most uncertain region and the region width and height
     :rtype: Tuple[int, int, int, int]
     """
     max_certainty: np.ndarray = np.amax(probs, axis=0)
     uncertainties = 1 - max_certainty
-    overwrite = np.zeros_like(uncertainties)
     h, w = uncertainties.shape
     dx: int = w // N_W
     dy: int = h // N_H
-    region_uncertainties: np.ndarray = np.zeros((N_W * N_H))
-    i = 0
-    for y in range(N_H - 1):
-        for x in range(N_W - 1):
-            x0, x1 = x * dx, (x + 1) * dx
-            y0, y1 = y * dy, (y + 1) * dy
-            sub_region = uncertainties[y0: y1, x0: x1]
-            total_region_uncertaintiy = np.sum(sub_region)
-            overwrite[y0: y1, x0: x1] = total_region_uncertaintiy
-            region_uncertainties[i] = total_region_uncertaintiy
-            i += 1
-    max_uncertainty_loc = int(np.argmax(region_uncertainties))
-    mx = max_uncertainty_loc % N_W
-    my = max_uncertainty_loc // N_H
+    region_uncertainties = window_sums(integral_image(uncertainties), dy, dx)[::dy, ::dx][:N_H, :N_W]
+    my, mx = np.unravel_index(int(np.argmax(region_uncertainties)), region_uncertainties.shape)
     if DEBUG:
         plt.imsave('uncertainties.png', uncertainties, cmap='plasma')
+        overwrite = np.kron(region_uncertainties, np.ones((dy, dx)))
         plt.imsave('overwrite.png', overwrite, cmap='plasma')
-    return (mx, my, dx, dy)
+    return (int(mx), int(my), dx, dy)
+
+
+def integral_image(arr: np.ndarray) -> np.ndarray:
+    """Summed area table of 2D $arr, zero padded so entry (y, x) is the sum of $arr[:y, :x].
+
+    :param arr: (h, w) arr
+    :type arr: np.ndarray
+    :return: (h + 1, w + 1) arr, int64 (exact) for integer $arr else float64
+    :rtype: np.ndarray
+    """
+    h, w = arr.shape
+    dtype = np.int64 if np.issubdtype(arr.dtype, np.integer) else np.float64
+    integral = np.zeros((h + 1, w + 1), dtype=dtype)
+    np.cumsum(arr, axis=0, dtype=dtype, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    return integral
+
+
+def window_sums(integral: np.ndarray, win_h: int, win_w: int) -> np.ndarray:
+    """Sum of every $win_h x $win_w window of the arr with summed area table $integral.
+
+    :param integral: (h + 1, w + 1) summed area table from integral_image()
+    :type integral: np.ndarray
+    :param win_h: window height, at most h
+    :type win_h: int
+    :param win_w: window width, at most w
+    :type win_w: int
+    :return: (h - win_h + 1, w - win_w + 1) arr whose entry (y, x) is the sum of window with top left (y, x)
+    :rtype: np.ndarray
+    """
+    return (
+        integral[win_h:, win_w:] - integral[:-win_h, win_w:] - integral[win_h:, :-win_w] + integral[:-win_h, :-win_w]
+    )
+
+
+def block_sums(arr: np.ndarray, cell: int) -> np.ndarray:
+    """Sum 2D $arr over $cell x $cell blocks, edge padding it to a multiple of $cell.
+
+    :param arr: (h, w) arr
+    :type arr: np.ndarray
+    :param cell: block side length
+    :type cell: int
+    :return: (ceil(h / cell), ceil(w / cell)) arr, int64 for integer $arr else float64
+    :rtype: np.ndarray
+    """
+    h, w = arr.shape
+    if h % cell != 0 or w % cell != 0:
+        arr = np.pad(arr, ((0, -h % cell), (0, -w % cell)), mode="edge")
+    n_y, n_x = arr.shape[0] // cell, arr.shape[1] // cell
+    if arr.dtype == np.uint8 and cell * 255 <= np.iinfo(np.uint16).max:
+        # summing the rows of a block in uint16 first is much faster than in 64 bits
+        rows = arr.reshape((n_y, cell, n_x * cell)).sum(axis=1, dtype=np.uint16)
+        return rows.reshape((n_y, n_x, cell)).sum(axis=2, dtype=np.int64)
+    dtype = np.int64 if np.issubdtype(arr.dtype, np.integer) else np.float64
+    return arr.reshape((n_y, cell, n_x, cell)).sum(axis=(1, 3), dtype=dtype)
+
+
+def _candidates(
+    integral: np.ndarray, img_shape: Tuple[int, int], cell: int, size: int, n_keep: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Best $n_keep windows of side $size (capped at the image) on the candidate grid of an image, from the summed
+    area table $integral of its $cell x $cell block sums. Returns (n, 4) int arr of (x0, y0, w, h) and their sums
+    per pixel."""
+    n_y, n_x = integral.shape[0] - 1, integral.shape[1] - 1
+    win_y, win_x = min(max(size // cell, 1), n_y), min(max(size // cell, 1), n_x)
+    stride = max(min(win_y, win_x) // CANDIDATE_STRIDE, 1)
+    # always include the last row and column so windows touching the bottom / right edges are considered
+    ys = np.union1d(np.arange(0, n_y - win_y + 1, stride), [n_y - win_y])[:, np.newaxis]
+    xs = np.union1d(np.arange(0, n_x - win_x + 1, stride), [n_x - win_x])[np.newaxis, :]
+    # only the grid's windows are looked up, rather than computing window_sums() everywhere
+    sums = (
+        integral[ys + win_y, xs + win_x] - integral[ys, xs + win_x] - integral[ys + win_y, xs] + integral[ys, xs]
+    )
+    means = sums.ravel() / (win_y * win_x * cell * cell)
+    n_keep = min(n_keep, means.shape[0])
+    best = np.argpartition(means, -n_keep)[-n_keep:]
+    gy, gx = np.unravel_index(best, sums.shape)
+    # windows over the padded edge cells are shifted back inside the image
+    h, w = img_shape
+    win_h, win_w = min(win_y * cell, h), min(win_x * cell, w)
+    x0 = np.minimum(xs[0, gx] * cell, w - win_w)
+    y0 = np.minimum(ys[gy, 0] * cell, h - win_h)
+    n = best.shape[0]
+    regions = np.stack([x0, y0, np.full(n, win_w), np.full(n, win_h)], axis=1).astype(np.int64)
+    return regions, means[best]
+
+
+def suggest_regions(
+    uncertainty_maps: Sequence[np.ndarray],
+    k: int = N_SUGGESTIONS,
+    sizes: Sequence[int] = SUGGESTION_SIZES,
+) -> List[Suggestion]:
+    """Find the $k most uncertain non-overlapping square windows over all images of a stack.
+
+    Windows are ranked by mean uncertainty (ties going to the larger window), so a larger window only beats the
+    smaller ones inside it if it's as uncertain throughout. Windows in different images never overlap.
+
+    :param uncertainty_maps: (h, w) uncertainty arr of each image, uint8 (0-255) or float in [0, 1]
+    :type uncertainty_maps: Sequence[np.ndarray]
+    :param k: max number of regions to suggest, defaults to N_SUGGESTIONS
+    :type k: int, optional
+    :param sizes: window side lengths (px) to score, defaults to SUGGESTION_SIZES
+    :type sizes: Sequence[int], optional
+    :return: up to $k suggestions (image index, x0, y0, w, h, mean uncertainty in [0, 1]), most uncertain first
+    :rtype: List[Suggestion]
+    """
+    if k < 1 or len(sizes) == 0:
+        return []
+    cell = max(min(sizes) // CANDIDATE_STRIDE, 1)
+    all_regions: List[np.ndarray] = []
+    all_scores: List[np.ndarray] = []
+    for i, uncertainties in enumerate(uncertainty_maps):
+        integral = integral_image(block_sums(uncertainties, cell))
+        scale = 255 if uncertainties.dtype == np.uint8 else 1
+        for size in sorted(set(sizes)):
+            regions, scores = _candidates(
+                integral, uncertainties.shape, cell, size, k * CANDIDATES_PER_SUGGESTION
+            )
+            all_regions.append(np.concatenate((np.full((regions.shape[0], 1), i), regions), axis=1))
+            all_scores.append(scores / scale)
+    if len(all_regions) == 0:
+        return []
+    regions = np.concatenate(all_regions, axis=0)
+    scores = np.concatenate(all_scores, axis=0)
+
+    suggestions: List[Suggestion] = []
+    chosen = np.zeros((0, 5), dtype=np.int64)
+    for j in np.lexsort((-regions[:, 3] * regions[:, 4], -scores)):
+        img_idx, x0, y0, w, h = regions[j]
+        overlaps = (
+            (chosen[:, 0] == img_idx) &
+            (chosen[:, 1] < x0 + w) & (x0 < chosen[:, 1] + chosen[:, 3]) &
+            (chosen[:, 2] < y0 + h) & (y0 < chosen[:, 2] + chosen[:, 4])
+        )
+        if np.any(overlaps):
+            continue
+        chosen = np.concatenate((chosen, regions[j : j + 1]), axis=0)
+        suggestions.append((int(img_idx), int(x0), int(y0), int(w), int(h), float(scores[j])))
+        if len(suggestions) == k:
+            break
+    return suggestions
+
+
+_UNCERTAINTY_MAPS: Dict[str, List[np.ndarray]] = {}
+_REGISTRY_LOCK = Lock()
+
+
+def set_uncertainty_maps(UID: str, uncertainty_maps: List[np.ndarray]) -> None:
+    """Store the uncertainty maps of user $UID's latest segmentation (or apply) to suggest regions from.
+
+    :param UID: user ID
+    :type UID: str
+    :param uncertainty_maps: (h, w) uint8 uncertainty arr of each image
+    :type uncertainty_maps: List[np.ndarray]
+    """
+    with _REGISTRY_LOCK:
+        _UNCERTAINTY_MAPS[UID] = uncertainty_maps
+
+
+def get_uncertainty_maps(UID: str) -> List[np.ndarray] | None:
+    """Get the uncertainty maps of user $UID's latest segmentation, or None if they haven't segmented.
+
+    :param UID: user ID
+    :type UID: str
+    :return: uncertainty arr of each image or None
+    :rtype: List[np.ndarray] | None
+    """
+    with _REGISTRY_LOCK:
+        return _UNCERTAINTY_MAPS.get(UID)
+
+
+def clear_uncertainty_maps(UID: str) -> None:
+    """Forget the uncertainty maps of user $UID.
+
+    :param UID: user ID
+    :type UID: str
+    """
+    with _REGISTRY_LOCK:
+        _UNCERTAINTY_MAPS.pop(UID, None)
@@ -1,4 +1,5 @@
 import numpy as np
+import os
 from features import (
     multiscale_advanced_features,
     N_ALLOWED_CPUS,
@@ -7,6 +8,8 @@ from features import (
 )
 from sklearn.ensemble import RandomForestClassifier
 from skops.io import load as skload
+from binning import SKOPS_TRUSTED_TYPES
+from superpixels import compute_superpixels, region_features, is_superpixel_model
 from pickle import load
 from math import floor
 
@@ -41,15 +44,21 @@ def load_classifier_from_file(path_to_classifier: str) -> RandomForestClassifier
         if ".pkl" in path_to_classifier:
             classifier = load(f)
         elif ".skops" in path_to_classifier:
-            classifier = skload(path_to_classifier)
+            classifier = skload(path_to_classifier, trusted=SKOPS_TRUSTED_TYPES)
         else:
             raise Exception("classfier format must be .pkl or .skops")
     return classifier
 
 
 PATH_TO_DATA = "backend/apply/stack.tif"
+PATH_TO_CLASSIFIER = "backend/apply/classifier.skops"
+# small student of the classifier from distilling (downloaded as classifier_distilled.skops), much faster to apply
+PATH_TO_DISTILLED = "backend/apply/classifier_distilled.skops"
 if __name__ == "__main__":
-    model = load_classifier_from_file("backend/apply/classifier.skops")
+    if os.path.exists(PATH_TO_DISTILLED):
+        model = load_classifier_from_file(PATH_TO_DISTILLED)
+    else:
+        model = load_classifier_from_file(PATH_TO_CLASSIFIER)
 
     data_stack = imread(PATH_TO_DATA)  # (D,H,W)
     out_seg = np.zeros_like(data_stack)
@@ -57,9 +66,13 @@ if __name__ == "__main__":
     for i, slice_arr in enumerate(data_stack):
         feature_stack = multiscale_advanced_features(slice_arr, CURRENT_WEB_FEATURES)
         h, w, feat = feature_stack.shape
-        flat_apply_data = feature_stack.reshape((h * w, feat))
-
-        out_probs = model.predict_proba(flat_apply_data)
+        if is_superpixel_model(model):
+            # trained on region features (see superpixels.py), so predict each superpixel and scatter to its pixels
+            superpixels = compute_superpixels(slice_arr)
+            out_probs = model.predict_proba(region_features(feature_stack, superpixels))[superpixels.reshape(-1)]
+        else:
+            flat_apply_data = feature_stack.reshape((h * w, feat))
+            out_probs = model.predict_proba(flat_apply_data)
         seg_of_slice = np.argmax(out_probs, axis=-1).reshape((h, w))
 
         out_seg[i, :, :] = seg_of_slice
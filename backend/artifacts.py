@@ -0,0 +1,93 @@
+"""Background writer for the files a user can download (seg.tiff, seg.png, thumbnail, labels.tiff).
+
+Other deferrable work (i.e distilling the classifier, see distill.py) is queued on the same worker.
+
+Compositing and writing these after every /segmenting or /applying call used to happen before the response was
+sent, even though they're only read when the user saves (or submits to the gallery). Instead each export is
+queued as a write function per (UID, artifact) on a single background worker. Writes are coalesced: if an
+artifact's previous write hasn't started yet, it's replaced by the newer one, so only the latest version is
+written. Anything that reads the files calls wait_for_artifacts() first.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Dict, List, Tuple
+
+# max time to wait for pending writes when saving
+ARTIFACT_TIMEOUT_S = 60
+
+# single worker so background writes never take more than one core from interactive requests
+_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+# latest not yet started write function and the future that will run it, per (UID, artifact)
+_PENDING: Dict[Tuple[str, str], Callable[[], object]] = {}
+_FUTURES: Dict[Tuple[str, str], Future] = {}
+_REGISTRY_LOCK = Lock()
+
+
+def _run_latest(key: Tuple[str, str]) -> None:
+    """Run the latest write function queued for $key, if it hasn't been run (or forgotten) already."""
+    with _REGISTRY_LOCK:
+        write_fn = _PENDING.pop(key, None)
+    if write_fn is None:
+        return
+    try:
+        write_fn()
+    except Exception as e:
+        print(e)
+
+
+def queue_artifact(UID: str, artifact: str, write_fn: Callable[[], object]) -> None:
+    """Queue $write_fn to write $artifact of user $UID in the background, replacing a queued (unstarted) write of it.
+
+    :param UID: user ID
+    :type UID: str
+    :param artifact: name of the artifact, i.e "seg" or "labels"
+    :type artifact: str
+    :param write_fn: function writing the artifact to the user folder
+    :type write_fn: Callable[[], object]
+    """
+    key = (UID, artifact)
+    with _REGISTRY_LOCK:
+        queued = key in _PENDING
+        _PENDING[key] = write_fn
+        if not queued:
+            _FUTURES[key] = _EXECUTOR.submit(_run_latest, key)
+
+
+def wait_for_artifacts(UID: str, artifacts: List[str] | None = None, timeout: float = ARTIFACT_TIMEOUT_S) -> None:
+    """Wait until pending writes of $artifacts (all if None) of user $UID are done.
+
+    :param UID: user ID
+    :type UID: str
+    :param artifacts: names of artifacts to wait for, defaults to None (all)
+    :type artifacts: List[str] | None, optional
+    :param timeout: max time to wait for each in seconds, defaults to ARTIFACT_TIMEOUT_S
+    :type timeout: float, optional
+    """
+    with _REGISTRY_LOCK:
+        futures = [
+            future
+            for (uid, artifact), future in _FUTURES.items()
+            if uid == UID and (artifacts is None or artifact in artifacts)
+        ]
+    for future in futures:
+        try:
+            future.result(timeout=timeout)
+        except Exception as e:
+            print(e)
+    with _REGISTRY_LOCK:
+        for key, future in list(_FUTURES.items()):
+            if future.done() and key[0] == UID:
+                del _FUTURES[key]
+
+
+def clear_artifacts(UID: str) -> None:
+    """Drop queued (unstarted) writes of user $UID, i.e when their data folder is deleted.
+
+    :param UID: user ID
+    :type UID: str
+    """
+    with _REGISTRY_LOCK:
+        for key in [k for k in _PENDING if k[0] == UID]:
+            del _PENDING[key]
+        for key in [k for k in _FUTURES if k[0] == UID]:
+            del _FUTURES[key]
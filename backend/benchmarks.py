@@ -0,0 +1,410 @@
+"""
+Benchmarks for backend.
+
+Time training and applying each classifier backend on the three test micrographs (N=2,3,4 phases) with the
+rectangular labels from their roi config files, compare superpixel mode to the per-pixel path (time and
+Dice), the training point samplers against n_points, pruned to full feature stacks, compressed to uncompressed
+feature stacks (time, size and Dice), distilled to full forests and early exit to full tree evaluation. Run from
+the repo root: python backend/benchmarks.py
+"""
+import numpy as np
+import os
+import time
+import tempfile
+from tifffile import imread
+from typing import Callable, Dict, List, Tuple
+
+from test_resources.call_weka import sep, get_label_arr
+from features import multiscale_advanced_features, N_ALLOWED_CPUS, DEAFAULT_FEATURES, DEAFAULT_WEKA_FEATURES
+from file_handling import save_features, save_superpixels, get_features_path
+from forest_based import (
+    EnsembleMethodName,
+    get_model,
+    fit,
+    get_predictor,
+    get_class_weights,
+    sample_training_data,
+    get_score,
+    segment_with_features,
+    sample_training_data_with_sampler,
+    SamplerName,
+    SAMPLERS,
+)
+from binning import get_binner, clear_binner, bin_features, make_binned_model
+from training_set import clear_training_set
+from superpixels import compute_superpixels, dice_scores
+from compression import compress_features, get_projection, explained_variance, CompressionMethod
+from distill import distill
+from compiled_forest import compile_forest, EarlyExitPredictor
+from model_registry import encode_model
+from pruning import (
+    get_features_to_compute,
+    get_session_features,
+    clear_session_features,
+    is_pruned_model,
+    get_kept_columns,
+)
+
+MODELS: List[EnsembleMethodName] = ["FRF", "LGBM"]
+N_POINTS = 40000
+SAMPLE_SIZES = [1000, 4000, 16000]
+COMPRESSIONS: List[Tuple[CompressionMethod | None, int]] = [(None, 0), ("pca", 8), ("pca", 16), ("random", 16)]
+EARLY_EXIT_DELTAS: List[float] = [0, 1e-3, 1e-2]
+
+
+def _time(fn: Callable, *args) -> Tuple[object, float]:
+    """Call $fn with $args, return result and time taken in seconds."""
+    start_t = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start_t
+
+
+def benchmark_micrograph(fname: str, folder: str) -> Dict[str, Dict[str, float]]:
+    """Featurise micrograph $fname, then train and apply each model in MODELS with the micrograph's roi labels.
+
+    :param fname: micrograph filename (without extension) in test_resources
+    :type fname: str
+    :param folder: folder to cache the features in (acts as the session folder)
+    :type folder: str
+    :return: dict of model name: dict of fit time, predict time, validation score and accuracy on labels
+    :rtype: Dict[str, Dict[str, float]]
+    """
+    img_arr = imread(f"backend{sep}test_resources{sep}{fname}.tif")
+    label = get_label_arr(f"backend{sep}test_resources{sep}{fname}_roi_config.txt", img_arr)
+    feature_stack = multiscale_advanced_features(img_arr, DEAFAULT_FEATURES, max(N_ALLOWED_CPUS, 1))
+    save_features(folder, 0, feature_stack)
+    h, w, feat = feature_stack.shape
+    flat_data = feature_stack.reshape((h * w, feat))
+    flat_labels = label.reshape(-1)
+    labelled = flat_labels > 0
+    fit_data, target_data = sample_training_data(flat_data[labelled], flat_labels[labelled], N_POINTS)
+    weights, _ = get_class_weights(target_data)
+
+    results: Dict[str, Dict[str, float]] = {}
+    for model_name in MODELS:
+        model = get_model(model_name)
+        start_t = time.perf_counter()
+        if model_name == "LGBM":
+            # includes finding the bins, which is only done once per session in the app
+            binner = get_binner(folder, 1)
+            model = fit(model, bin_features(binner, fit_data), target_data, weights)
+            model = make_binned_model(binner, model)
+        else:
+            model = fit(model, fit_data, target_data, weights)
+        fit_t = time.perf_counter() - start_t
+        probs, predict_t = _time(get_predictor(model), flat_data)
+        classes = model.classes_[np.argmax(probs, axis=1)]
+        results[model_name] = {
+            "fit": fit_t,
+            "predict": predict_t,
+            "score": get_score(model),
+            "label accuracy": float(np.mean(classes[labelled] == flat_labels[labelled])),
+        }
+    clear_binner(folder)
+    return results
+
+
+def benchmark_superpixels(fname: str, folder: str) -> Dict[str, Dict[str, float]]:
+    """Segment micrograph $fname per pixel, per superpixel and per superpixel with refined boundaries.
+
+    :param fname: micrograph filename (without extension) in test_resources
+    :type fname: str
+    :param folder: folder to cache the features and superpixels in (acts as the session folder)
+    :type folder: str
+    :return: dict of mode: dict of segment time (train + apply), mean Dice vs per pixel and accuracy on labels
+    :rtype: Dict[str, Dict[str, float]]
+    """
+    img_arr = imread(f"backend{sep}test_resources{sep}{fname}.tif")
+    label = get_label_arr(f"backend{sep}test_resources{sep}{fname}_roi_config.txt", img_arr)
+    save_features(folder, 0, multiscale_advanced_features(img_arr, DEAFAULT_FEATURES, max(N_ALLOWED_CPUS, 1)))
+    save_superpixels(folder, 0, compute_superpixels(img_arr))
+    labelled = label > 0
+
+    segs: Dict[str, np.ndarray] = {}
+    results: Dict[str, Dict[str, float]] = {}
+    for mode, superpixels, refine in [("pixel", False, False), ("superpixel", True, False), ("refined", True, True)]:
+        (probs, model, _), segment_t = _time(
+            lambda: segment_with_features([label], folder, superpixels=superpixels, refine_boundaries=refine)
+        )
+        segs[mode] = model.classes_[np.argmax(probs[0], axis=0)]
+        dice = dice_scores(segs[mode], segs["pixel"])
+        results[mode] = {
+            "segment": segment_t,
+            "dice": float(np.mean(list(dice.values()))),
+            "label accuracy": float(np.mean(segs[mode][labelled] == label[labelled])),
+        }
+    clear_training_set(folder)
+    return results
+
+
+def benchmark_sampling(fname: str) -> Dict[Tuple[str, int], Dict[str, float]]:
+    """Train on $n_points of the labels of micrograph $fname sampled with each sampler, for each n in SAMPLE_SIZES.
+
+    Dice is measured against a forest trained on N_POINTS randomly sampled points.
+
+    :param fname: micrograph filename (without extension) in test_resources
+    :type fname: str
+    :return: dict of (sampler, n_points): dict of fit time, mean Dice vs reference and accuracy on labels
+    :rtype: Dict[Tuple[str, int], Dict[str, float]]
+    """
+    img_arr = imread(f"backend{sep}test_resources{sep}{fname}.tif")
+    label = get_label_arr(f"backend{sep}test_resources{sep}{fname}_roi_config.txt", img_arr)
+    feature_stack = multiscale_advanced_features(img_arr, DEAFAULT_FEATURES, max(N_ALLOWED_CPUS, 1))
+    h, w, feat = feature_stack.shape
+    flat_data = feature_stack.reshape((h * w, feat))
+    flat_labels = label.reshape(-1)
+    pixels = np.flatnonzero(flat_labels > 0)
+    fit_data, target_data = flat_data[pixels], flat_labels[pixels]
+    pixel_data = (np.zeros_like(pixels, dtype=np.int32), pixels)
+    widths = np.array([w])
+
+    def _train_segment(n_points: int, sampler: SamplerName) -> Tuple[np.ndarray, float]:
+        sample = sample_training_data_with_sampler(fit_data, target_data, n_points, sampler, pixel_data, widths)
+        model, fit_t = _time(fit, get_model("FRF"), sample[0], sample[1], get_class_weights(sample[1])[0])
+        probs = get_predictor(model)(flat_data)
+        return model.classes_[np.argmax(probs, axis=1)], fit_t
+
+    reference, _ = _train_segment(N_POINTS, "random")
+    results: Dict[Tuple[str, int], Dict[str, float]] = {}
+    for n_points in SAMPLE_SIZES:
+        for sampler in SAMPLERS:
+            seg, fit_t = _train_segment(n_points, sampler)  # type: ignore
+            results[(sampler, n_points)] = {
+                "fit": fit_t,
+                "dice": float(np.mean(list(dice_scores(seg, reference).values()))),
+                "label accuracy": float(np.mean(seg[pixels] == target_data)),
+            }
+    return results
+
+
+def benchmark_pruning(fname: str, folder: str) -> Dict[str, Dict[str, float]]:
+    """Segment micrograph $fname with the full feature stack, then with pruning, timing featurising and predicting.
+
+    :param fname: micrograph filename (without extension) in test_resources
+    :type fname: str
+    :param folder: folder to cache the features in (acts as the session folder)
+    :type folder: str
+    :return: dict of "full"/"pruned": dict of features computed, features predicted on, featurise and predict time,
+        mean Dice vs full and accuracy on labels
+    :rtype: Dict[str, Dict[str, float]]
+    """
+    img_arr = imread(f"backend{sep}test_resources{sep}{fname}.tif")
+    label = get_label_arr(f"backend{sep}test_resources{sep}{fname}_roi_config.txt", img_arr)
+    labelled = label > 0
+    n_workers = max(N_ALLOWED_CPUS, 1)
+    feature_stack, _ = _time(multiscale_advanced_features, img_arr, DEAFAULT_FEATURES, n_workers)
+    save_features(folder, 0, feature_stack)
+    get_features_to_compute(folder, DEAFAULT_FEATURES)
+
+    segs: Dict[str, np.ndarray] = {}
+    results: Dict[str, Dict[str, float]] = {}
+    for mode, prune in [("full", False), ("pruned", True)]:
+        _, model, _ = segment_with_features([label], folder, prune=prune)
+        features = get_session_features(folder)
+        stack, featurise_t = _time(multiscale_advanced_features, img_arr, features, n_workers)
+        flat = stack.reshape((-1, stack.shape[-1]))
+        probs, predict_t = _time(get_predictor(model), flat)
+        segs[mode] = model.classes_[np.argmax(probs, axis=1)].reshape(label.shape)
+        results[mode] = {
+            "computed": stack.shape[-1],
+            "predicted": get_kept_columns(model).shape[0] if is_pruned_model(model) else model.n_features_in_,
+            "featurise": featurise_t,
+            "predict": predict_t,
+            "dice": float(np.mean(list(dice_scores(segs[mode], segs["full"]).values()))),
+            "label accuracy": float(np.mean(segs[mode][labelled] == label[labelled])),
+        }
+    clear_training_set(folder)
+    clear_session_features(folder)
+    return results
+
+
+def benchmark_compression(fname: str, folder: str) -> Dict[str, Dict[str, float]]:
+    """Segment micrograph $fname's weka default features uncompressed then compressed with each of COMPRESSIONS.
+
+    :param fname: micrograph filename (without extension) in test_resources
+    :type fname: str
+    :param folder: folder to cache the features in (acts as the session folder)
+    :type folder: str
+    :return: dict of compression: dict of compress time, cached stack MB, segment time (train + apply), explained
+        variance (PCA only, else nan), mean Dice vs uncompressed and accuracy on labels
+    :rtype: Dict[str, Dict[str, float]]
+    """
+    img_arr = imread(f"backend{sep}test_resources{sep}{fname}.tif")
+    label = get_label_arr(f"backend{sep}test_resources{sep}{fname}_roi_config.txt", img_arr)
+    labelled = label > 0
+    feature_stack = multiscale_advanced_features(img_arr, DEAFAULT_WEKA_FEATURES, max(N_ALLOWED_CPUS, 1))
+
+    segs: Dict[str, np.ndarray] = {}
+    results: Dict[str, Dict[str, float]] = {}
+    for method, n_components in COMPRESSIONS:
+        mode = "none" if method is None else f"{method}-{n_components}"
+        compressed, compress_t = _time(compress_features, folder, feature_stack, method, n_components, True)
+        save_features(folder, 0, compressed)
+        (probs, model, _), segment_t = _time(segment_with_features, [label], folder)
+        clear_training_set(folder)
+        projection = get_projection(folder)
+        segs[mode] = model.classes_[np.argmax(probs[0], axis=0)]
+        results[mode] = {
+            "compress": compress_t,
+            "MB": os.path.getsize(get_features_path(folder, 0)) / 1e6,
+            "segment": segment_t,
+            "explained": explained_variance([feature_stack], projection) if method == "pca" else float("nan"),
+            "dice": float(np.mean(list(dice_scores(segs[mode], segs["none"]).values()))),
+            "label accuracy": float(np.mean(segs[mode][labelled] == label[labelled])),
+        }
+    return results
+
+
+def benchmark_distillation(fname: str, folder: str) -> Dict[str, Dict[str, float]]:
+    """Train a forest on micrograph $fname then distill it, comparing predict time, .skops size and segmentations.
+
+    :param fname: micrograph filename (without extension) in test_resources
+    :type fname: str
+    :param folder: folder to cache the features in (acts as the session folder)
+    :type folder: str
+    :return: dict of "full"/"distilled": dict of distill time, predict time, .skops MB, mean Dice vs full and
+        accuracy on labels
+    :rtype: Dict[str, Dict[str, float]]
+    """
+    img_arr = imread(f"backend{sep}test_resources{sep}{fname}.tif")
+    label = get_label_arr(f"backend{sep}test_resources{sep}{fname}_roi_config.txt", img_arr)
+    labelled = label > 0
+    feature_stack = multiscale_advanced_features(img_arr, DEAFAULT_FEATURES, max(N_ALLOWED_CPUS, 1))
+    save_features(folder, 0, feature_stack)
+    flat = feature_stack.reshape((-1, feature_stack.shape[-1]))
+    _, model, _ = segment_with_features([label], folder)
+    clear_training_set(folder)
+    (student, _), distill_t = _time(distill, model, folder, 1)
+
+    segs: Dict[str, np.ndarray] = {}
+    results: Dict[str, Dict[str, float]] = {}
+    for mode, classifier, t in [("full", model, 0.0), ("distilled", student, distill_t)]:
+        if classifier is None:
+            continue
+        probs, predict_t = _time(get_predictor(classifier), flat)
+        segs[mode] = classifier.classes_[np.argmax(probs, axis=1)].reshape(label.shape)
+        results[mode] = {
+            "distill": t,
+            "predict": predict_t,
+            "MB": len(encode_model(classifier, ".skops")) / 1e6,
+            "dice": float(np.mean(list(dice_scores(segs[mode], segs["full"]).values()))),
+            "label accuracy": float(np.mean(segs[mode][labelled] == label[labelled])),
+        }
+    return results
+
+
+def benchmark_early_exit(fname: str, folder: str) -> Dict[str, Dict[str, float]]:
+    """Train a forest on micrograph $fname then predict it with every tree and in early exit mode for each delta.
+
+    :param fname: micrograph filename (without extension) in test_resources
+    :type fname: str
+    :param folder: folder to cache the features in (acts as the session folder)
+    :type folder: str
+    :return: dict of "full"/"delta=...": dict of predict time, fraction of tree evaluations saved, fraction of
+        pixels with the full forest's class and accuracy on labels
+    :rtype: Dict[str, Dict[str, float]]
+    """
+    img_arr = imread(f"backend{sep}test_resources{sep}{fname}.tif")
+    label = get_label_arr(f"backend{sep}test_resources{sep}{fname}_roi_config.txt", img_arr)
+    labelled = label > 0
+    feature_stack = multiscale_advanced_features(img_arr, DEAFAULT_FEATURES, max(N_ALLOWED_CPUS, 1))
+    save_features(folder, 0, feature_stack)
+    flat = feature_stack.reshape((-1, feature_stack.shape[-1]))
+    _, model, _ = segment_with_features([label], folder)
+    clear_training_set(folder)
+    forest = compile_forest(model)
+    forest.predict_proba(flat[:1000])  # jit warm up
+
+    predictors: List[Tuple[str, Callable[[np.ndarray], np.ndarray]]] = [("full", forest.predict_proba)]
+    predictors += [(f"delta={delta:g}", EarlyExitPredictor(forest, delta)) for delta in EARLY_EXIT_DELTAS]
+    full_classes = np.array([])
+    results: Dict[str, Dict[str, float]] = {}
+    for mode, predictor in predictors:
+        probs, predict_t = _time(predictor, flat)
+        classes = np.argmax(probs, axis=1)
+        if mode == "full":
+            full_classes = classes
+        seg = model.classes_[classes].reshape(label.shape)
+        results[mode] = {
+            "predict": predict_t,
+            "saved": predictor.saved_frac if isinstance(predictor, EarlyExitPredictor) else 0.0,
+            "agreement": float(np.mean(classes == full_classes)),
+            "label accuracy": float(np.mean(seg[labelled] == label[labelled])),
+        }
+    return results
+
+
+def _each_micrograph(
+    benchmark: Callable[[str, str], Dict[str, Dict[str, float]]]
+) -> List[Tuple[str, str, Dict[str, float]]]:
+    """Run $benchmark on each test micrograph in a temporary folder.
+
+    :param benchmark: benchmark function taking a micrograph filename and a folder
+    :type benchmark: Callable[[str, str], Dict[str, Dict[str, float]]]
+    :return: list of (micrograph, mode, results) of every mode of every micrograph
+    :rtype: List[Tuple[str, str, Dict[str, float]]]
+    """
+    rows: List[Tuple[str, str, Dict[str, float]]] = []
+    for n in range(2, 5):
+        fname = f"{n}_phase"
+        with tempfile.TemporaryDirectory() as folder:
+            results = benchmark(fname, folder)
+        rows += [(fname, mode, r) for mode, r in results.items()]
+    return rows
+
+
+if __name__ == "__main__":
+    print(f"{'micrograph':<12}{'model':<8}{'fit (s)':>10}{'predict (s)':>14}{'score':>8}{'label acc':>12}")
+    for fname, model_name, r in _each_micrograph(benchmark_micrograph):
+        print(
+            f"{fname:<12}{model_name:<8}{r['fit']:>10.2f}{r['predict']:>14.2f}"
+            f"{r['score']:>8.3f}{r['label accuracy']:>12.3f}"
+        )
+
+    print(f"\n{'micrograph':<12}{'mode':<12}{'segment (s)':>14}{'dice':>8}{'label acc':>12}")
+    for fname, mode, r in _each_micrograph(benchmark_superpixels):
+        print(f"{fname:<12}{mode:<12}{r['segment']:>14.2f}{r['dice']:>8.3f}{r['label accuracy']:>12.3f}")
+
+    print(f"\n{'micrograph':<12}{'sampler':<10}{'n_points':>10}{'fit (s)':>10}{'dice':>8}{'label acc':>12}")
+    for n in range(2, 5):
+        fname = f"{n}_phase"
+        for (sampler, n_points), r in benchmark_sampling(fname).items():
+            print(
+                f"{fname:<12}{sampler:<10}{n_points:>10}{r['fit']:>10.2f}{r['dice']:>8.3f}{r['label accuracy']:>12.3f}"
+            )
+
+    print(
+        f"\n{'micrograph':<12}{'mode':<8}{'computed':>10}{'predicted':>11}{'featurise (s)':>15}{'predict (s)':>13}"
+        f"{'dice':>8}{'label acc':>12}"
+    )
+    for fname, mode, r in _each_micrograph(benchmark_pruning):
+        print(
+            f"{fname:<12}{mode:<8}{r['computed']:>10}{r['predicted']:>11}{r['featurise']:>15.2f}"
+            f"{r['predict']:>13.2f}{r['dice']:>8.3f}{r['label accuracy']:>12.3f}"
+        )
+
+    print(
+        f"\n{'micrograph':<12}{'compression':<12}{'compress (s)':>14}{'MB':>8}{'segment (s)':>13}{'explained':>11}"
+        f"{'dice':>8}{'label acc':>12}"
+    )
+    for fname, mode, r in _each_micrograph(benchmark_compression):
+        print(
+            f"{fname:<12}{mode:<12}{r['compress']:>14.2f}{r['MB']:>8.1f}{r['segment']:>13.2f}"
+            f"{r['explained']:>11.3f}{r['dice']:>8.3f}{r['label accuracy']:>12.3f}"
+        )
+
+    print(
+        f"\n{'micrograph':<12}{'model':<11}{'distill (s)':>13}{'predict (s)':>13}{'MB':>8}{'dice':>8}{'label acc':>12}"
+    )
+    for fname, mode, r in _each_micrograph(benchmark_distillation):
+        print(
+            f"{fname:<12}{mode:<11}{r['distill']:>13.2f}{r['predict']:>13.2f}{r['MB']:>8.2f}{r['dice']:>8.3f}"
+            f"{r['label accuracy']:>12.3f}"
+        )
+
+    print(f"\n{'micrograph':<12}{'mode':<12}{'predict (s)':>13}{'saved':>8}{'agreement':>11}{'label acc':>12}")
+    for fname, mode, r in _each_micrograph(benchmark_early_exit):
+        print(
+            f"{fname:<12}{mode:<12}{r['predict']:>13.2f}{r['saved']:>8.3f}{r['agreement']:>11.3f}"
+            f"{r['label accuracy']:>12.3f}"
+        )
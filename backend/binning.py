@@ -0,0 +1,239 @@
+"""Histogram-binned features for the gradient boosting ("LGBM") backend.
+
+Histogram gradient boosting trains on features quantized to at most 255 bins per column, so the split search
+runs over bin counts rather than sorted floats. Bin edges only depend on the distribution of the features, not
+on the labels, so they're computed once per session from a random sample of pixels of the cached feature stacks
+and reused for every retrain. Training rows are quantized to uint8 bin codes before fitting and the fitted
+booster is saved in a Pipeline behind the same binner, so it always predicts on the bins (including after
+being saved, downloaded and re-applied).
+
+For prediction in the app the booster's trees are flattened into the compiled engine in compiled_forest.py
+(when numba is available) and run directly on the uint8 bin codes.
+"""
+import numpy as np
+import warnings
+from threading import Lock
+from types import SimpleNamespace
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import KBinsDiscretizer
+from sklearn.ensemble import HistGradientBoostingClassifier
+from typing import Dict, List, Tuple
+
+from file_handling import get_features_signature, load_features
+from compiled_forest import CompiledForest
+
+N_BINS = 255
+# max number of pixels (spread over all images) used to find bin edges, same as the booster's own subsample
+BIN_SAMPLE_PIXELS = 200000
+# sklearn internals of a fitted booster that skops won't load unless told to trust them
+SKOPS_TRUSTED_TYPES = [
+    "sklearn._loss._loss.CyHalfBinomialLoss",
+    "sklearn._loss._loss.CyHalfMultinomialLoss",
+    "sklearn._loss.link.Interval",
+    "sklearn._loss.link.LogitLink",
+    "sklearn._loss.link.MultinomialLogit",
+    "sklearn._loss.loss.HalfBinomialLoss",
+    "sklearn._loss.loss.HalfMultinomialLoss",
+    "sklearn.ensemble._hist_gradient_boosting.binning._BinMapper",
+    "sklearn.ensemble._hist_gradient_boosting.predictor.TreePredictor",
+    "sklearn.metrics._classification.accuracy_score",
+    "sklearn.metrics._scorer._PredictScorer",
+]
+
+
+def fit_binner(folder_name: str, n_imgs: int, seed: int = 0) -> KBinsDiscretizer:
+    """Find quantile bin edges of each feature from a random sample of pixels of cached feature stacks 0..$n_imgs-1.
+
+    :param folder_name: user data folder where features are cached
+    :type folder_name: str
+    :param n_imgs: number of images to sample from
+    :type n_imgs: int
+    :param seed: random seed for the pixel sample, defaults to 0
+    :type seed: int, optional
+    :return: fitted binner mapping features to (ordinal) bin codes
+    :rtype: KBinsDiscretizer
+    """
+    rng = np.random.default_rng(seed)
+    n_per_img = max(1, BIN_SAMPLE_PIXELS // max(n_imgs, 1))
+    samples = []
+    for i in range(n_imgs):
+        feature_stack = load_features(folder_name, i)
+        h, w, feat = feature_stack.shape
+        flat = feature_stack.reshape((h * w, feat))
+        pixels = np.sort(rng.choice(h * w, size=min(n_per_img, h * w), replace=False))
+        samples.append(np.take(flat, pixels, axis=0))
+    sample = np.concatenate(samples, axis=0)
+    binner = KBinsDiscretizer(n_bins=N_BINS, encode="ordinal", strategy="quantile", subsample=None)
+    with warnings.catch_warnings():
+        # features with fewer than N_BINS distinct values just get fewer bins
+        warnings.simplefilter("ignore", UserWarning)
+        binner.fit(sample)
+    return binner
+
+
+def bin_features(binner: KBinsDiscretizer, flat_data: np.ndarray) -> np.ndarray:
+    """Quantize each column of $flat_data to its uint8 bin code.
+
+    :param binner: fitted binner, from fit_binner()
+    :type binner: KBinsDiscretizer
+    :param flat_data: flat (n_pixels, n_features) arr
+    :type flat_data: np.ndarray
+    :return: (n_pixels, n_features) uint8 arr of bin codes
+    :rtype: np.ndarray
+    """
+    return binner.transform(flat_data).astype(np.uint8)
+
+
+def make_binned_model(binner: KBinsDiscretizer, booster: HistGradientBoostingClassifier) -> Pipeline:
+    """Put a booster trained on bin codes behind its binner so it can predict directly on features.
+
+    :param binner: fitted binner the booster's training data was quantized with
+    :type binner: KBinsDiscretizer
+    :param booster: booster trained on bin codes
+    :type booster: HistGradientBoostingClassifier
+    :return: pipeline of binner then booster
+    :rtype: Pipeline
+    """
+    return Pipeline([("bins", binner), ("model", booster)])
+
+
+def is_binned_model(model: object) -> bool:
+    """Whether $model is a booster behind a binner, from make_binned_model().
+
+    :param model: any (trained) model
+    :type model: object
+    :return: true if binned booster
+    :rtype: bool
+    """
+    if not isinstance(model, Pipeline) or len(model.steps) != 2:
+        return False
+    return isinstance(model.steps[0][1], KBinsDiscretizer) and isinstance(
+        model.steps[1][1], HistGradientBoostingClassifier
+    )
+
+
+def _as_sklearn_tree(nodes: np.ndarray, class_idx: int, n_outputs: int) -> SimpleNamespace:
+    """View the node array of one of the booster's trees like a (fitted) sklearn decision tree, for CompiledForest.
+
+    The leaf value is put in column $class_idx of an otherwise zero value vector, so summing the 'votes' of every
+    tree gives the booster's raw predictions.
+    """
+    n = nodes.shape[0]
+    is_leaf = nodes["is_leaf"].astype(bool)
+    value = np.zeros((n, 1, n_outputs))
+    value[:, 0, class_idx] = nodes["value"]
+    tree_ = SimpleNamespace(
+        node_count=n,
+        children_left=np.where(is_leaf, -1, nodes["left"].astype(np.int64)),
+        children_right=np.where(is_leaf, -1, nodes["right"].astype(np.int64)),
+        feature=nodes["feature_idx"].astype(np.int64),
+        threshold=nodes["num_threshold"],
+        value=value,
+        max_depth=int(np.max(nodes["depth"])),
+    )
+    return SimpleNamespace(tree_=tree_)
+
+
+class CompiledBooster:
+    """A binned booster with its trees flattened into a CompiledForest that predicts on uint8 bin codes."""
+
+    def __init__(self, model: Pipeline) -> None:
+        """Flatten the trees of binned booster $model.
+
+        :param model: trained binned booster, from make_binned_model()
+        :type model: Pipeline
+        """
+        self.binner: KBinsDiscretizer = model.steps[0][1]
+        booster: HistGradientBoostingClassifier = model.steps[1][1]
+        self.classes_ = booster.classes_
+        n_outputs = booster.n_trees_per_iteration_
+        trees: List[SimpleNamespace] = []
+        for iteration in booster._predictors:
+            for class_idx, predictor in enumerate(iteration):
+                trees.append(_as_sklearn_tree(predictor.nodes, class_idx, n_outputs))
+        self.forest = CompiledForest(trees, self.classes_, normalize=False)
+        self.baseline = np.asarray(booster._baseline_prediction, dtype=np.float64).reshape((1, n_outputs))
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        """Bin each row of $X, sum the raw tree outputs on the bin codes and convert them to class probabilities.
+
+        :param X: flat (n_pixels, n_features) arr of features
+        :type X: np.ndarray
+        :return: (n_pixels, n_classes) arr of class probabilities
+        :rtype: np.ndarray
+        """
+        codes = bin_features(self.binner, X)
+        raw = self.forest.predict_votes(codes) + self.baseline
+        if raw.shape[1] == 1:
+            # binary: single raw output is the logit of the second class
+            p = 1 / (1 + np.exp(-raw[:, 0]))
+            return np.stack([1 - p, p], axis=1)
+        raw -= np.amax(raw, axis=1, keepdims=True)
+        exp = np.exp(raw)
+        return exp / np.sum(exp, axis=1, keepdims=True)
+
+
+class SessionBinner:
+    """A user's bin edges, refit only when the features they were sampled from change."""
+
+    def __init__(self) -> None:
+        """Create empty store."""
+        self.lock = Lock()
+        self.binner: KBinsDiscretizer | None = None
+        self._signatures: Tuple[Tuple[int, int, int], ...] = ()
+
+    def get(self, folder_name: str, n_imgs: int) -> KBinsDiscretizer:
+        """Get bin edges for the features in $folder_name, fitting them if there are none or they are stale.
+
+        Images added after the bins were fit don't trigger a refit (they're assumed to be similar), but
+        re-featurised or deleted images (i.e a feature change) do.
+
+        :param folder_name: user data folder where features are cached
+        :type folder_name: str
+        :param n_imgs: number of images
+        :type n_imgs: int
+        :return: fitted binner
+        :rtype: KBinsDiscretizer
+        """
+        with self.lock:
+            n_sampled = len(self._signatures)
+            stale = self.binner is None or n_sampled > n_imgs
+            if not stale:
+                current = tuple(get_features_signature(folder_name, i) for i in range(n_sampled))
+                stale = current != self._signatures
+            if stale:
+                self.binner = fit_binner(folder_name, n_imgs)
+                self._signatures = tuple(get_features_signature(folder_name, i) for i in range(n_imgs))
+            assert self.binner is not None
+            return self.binner
+
+
+_BINNERS: Dict[str, SessionBinner] = {}
+_REGISTRY_LOCK = Lock()
+
+
+def get_binner(UID: str, n_imgs: int) -> KBinsDiscretizer:
+    """Get (fitting if needed) the bin edges of user $UID's cached features.
+
+    :param UID: user ID, whose features are cached in folder $UID
+    :type UID: str
+    :param n_imgs: number of images
+    :type n_imgs: int
+    :return: fitted binner
+    :rtype: KBinsDiscretizer
+    """
+    with _REGISTRY_LOCK:
+        if UID not in _BINNERS:
+            _BINNERS[UID] = SessionBinner()
+        session_binner = _BINNERS[UID]
+    return session_binner.get(UID, n_imgs)
+
+
+def clear_binner(UID: str) -> None:
+    """Forget bin edges of user $UID.
+
+    :param UID: user ID
+    :type UID: str
+    """
+    with _REGISTRY_LOCK:
+        _BINNERS.pop(UID, None)
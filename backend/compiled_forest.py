@@ -0,0 +1,421 @@
+"""Compiled flat-array random forest inference.
+
+sklearn's predict_proba evaluates a forest one tree at a time over *every* pixel, so the whole (h*w, N) feature
+arr is streamed through memory once per tree and a float64 (h*w, n_classes) arr is allocated per tree. Here a
+trained forest is flattened into contiguous node arrays (feature, float32 threshold, child and float32 leaf
+class probabilities) and evaluated block by block: a small block of pixels (transposed so each feature is
+contiguous) stays in cache while every tree is run over it, accumulating into one output buffer. Blocks are
+spread over threads.
+
+Nodes of each tree are relaid so a node's children are adjacent, which makes traversal branchless
+(child = left + (x > threshold)), and every pixel walks max_depth steps (leaves point to themselves).
+Thresholds are rounded down to the float32 below, so comparisons with float32 features are exactly the same as
+sklearn's float64 comparisons and leaves (hence class maps) match.
+
+Early exit mode evaluates trees in batches of EARLY_EXIT_BATCH and freezes pixels whose vote margin (top class
+votes minus runner up) after t trees already decides their class: either exactly, if the remaining trees can't
+overturn it, or with probability at least 1 - delta by Hoeffding's bound on the mean per-tree margin (in [-1, 1]),
+margin > sqrt(2 t ln((n_classes - 1) / delta)). Only undecided pixels, mostly at phase boundaries, go on through
+the rest of the forest, and a frozen pixel's probabilities are its mean over the trees it was evaluated on.
+
+The block kernels are compiled with numba if it's installed, otherwise (slower) numpy versions are used.
+"""
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from typing import List, Tuple
+
+from features import N_ALLOWED_CPUS
+
+try:
+    from numba import njit, prange, set_num_threads
+
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+BLOCK_SIZE = 512
+# trees evaluated between early exit checks
+EARLY_EXIT_BATCH = 16
+# max probability a pixel frozen by the statistical bound would be classified differently by the full forest
+EARLY_EXIT_DELTA = 1e-3
+
+
+class CompiledForest:
+    """Flattened, contiguous node arrays of a set of trees, ready for block-wise prediction."""
+
+    def __init__(self, trees: List, classes: np.ndarray | None = None, normalize: bool = True) -> None:
+        """Flatten $trees (fitted sklearn decision trees, i.e forest.estimators_) into node arrays.
+
+        :param trees: fitted trees that share the same classes
+        :type trees: List
+        :param classes: class values of the trees (forest.classes_), defaults to None
+        :type classes: np.ndarray | None, optional
+        :param normalize: whether to normalize leaf values (class counts) to probabilities, defaults to True
+        :type normalize: bool, optional
+        """
+        self.classes_ = classes
+        self.n_trees = len(trees)
+        feats, thresholds, children, values, roots = [], [], [], [], []
+        offset = 0
+        max_depth = 0
+        for tree in trees:
+            t = tree.tree_
+            n = t.node_count
+            left, right = t.children_left, t.children_right
+            internal = left != -1
+            # new ids: root is 0, then the children of the k-th internal node (in sklearn's pre-order) are 2k+1, 2k+2
+            pair_idx = np.arange(int(np.sum(internal)))
+            new_id = np.zeros(n, dtype=np.int64)
+            new_id[left[internal]] = 1 + 2 * pair_idx
+            new_id[right[internal]] = 2 + 2 * pair_idx
+            order = np.empty(n, dtype=np.int64)
+            order[new_id] = np.arange(n)
+
+            is_leaf = ~internal[order]
+            child = np.where(is_leaf, np.arange(n), new_id[np.maximum(left[order], 0)]) + offset
+            threshold_64 = t.threshold[order]
+            threshold = threshold_64.astype(np.float32)
+            rounded_up = threshold.astype(np.float64) > threshold_64
+            threshold[rounded_up] = np.nextafter(threshold[rounded_up], np.float32(-np.inf))
+            threshold[is_leaf] = np.inf
+            leaf_counts = t.value[order, 0, :]
+            normalizer = np.sum(leaf_counts, axis=1, keepdims=True) if normalize else np.ones((n, 1))
+            normalizer[normalizer == 0] = 1
+
+            feats.append(np.where(is_leaf, 0, t.feature[order]))
+            thresholds.append(threshold)
+            children.append(child)
+            values.append(leaf_counts / normalizer)
+            roots.append(offset)
+            max_depth = max(max_depth, t.max_depth)
+            offset += n
+
+        self.feature = np.concatenate(feats).astype(np.int32)
+        self.threshold = np.concatenate(thresholds).astype(np.float32)
+        self.child = np.concatenate(children).astype(np.int32)
+        self.value = np.concatenate(values).astype(np.float32)
+        self.roots = np.array(roots, dtype=np.int32)
+        self.max_depth = max_depth
+
+    def predict_votes(self, X: np.ndarray, block_size: int = BLOCK_SIZE, out: np.ndarray | None = None) -> np.ndarray:
+        """Sum of every tree's class probabilities for each row of $X (i.e predict_proba * n_trees).
+
+        :param X: flat (n_pixels, n_features) arr, converted to float32 if needed
+        :type X: np.ndarray
+        :param block_size: number of pixels per cache block, defaults to BLOCK_SIZE
+        :type block_size: int, optional
+        :param out: optional (n_pixels, n_classes) float32 arr to *add* votes into, defaults to None
+        :type out: np.ndarray | None, optional
+        :return: (n_pixels, n_classes) float32 arr of summed votes
+        :rtype: np.ndarray
+        """
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if out is None:
+            out = np.zeros((X.shape[0], self.value.shape[1]), dtype=np.float32)
+        args = (X, self.roots, self.feature, self.threshold, self.child, self.value, self.max_depth, out, block_size)
+        if NUMBA_AVAILABLE:
+            set_num_threads(max(N_ALLOWED_CPUS, 1))
+            _predict_blocks_numba(*args)
+        else:
+            _predict_blocks_numpy(*args)
+        return out
+
+    def predict_proba(self, X: np.ndarray, block_size: int = BLOCK_SIZE) -> np.ndarray:
+        """Mean class probabilities over trees for each row of $X, like forest.predict_proba but float32.
+
+        :param X: flat (n_pixels, n_features) arr
+        :type X: np.ndarray
+        :param block_size: number of pixels per cache block, defaults to BLOCK_SIZE
+        :type block_size: int, optional
+        :return: (n_pixels, n_classes) float32 arr of class probabilities
+        :rtype: np.ndarray
+        """
+        votes = self.predict_votes(X, block_size)
+        votes /= self.n_trees
+        return votes
+
+    def exit_bounds(self, delta: float = EARLY_EXIT_DELTA) -> np.ndarray:
+        """Vote margin above which a pixel is frozen after t trees, for each t = 0..n_trees.
+
+        :param delta: max probability a frozen pixel's class differs from the full forest's, 0 to only freeze pixels
+            whose class can't change, defaults to EARLY_EXIT_DELTA
+        :type delta: float, optional
+        :return: (n_trees + 1,) float32 arr of margin bounds
+        :rtype: np.ndarray
+        """
+        t = np.arange(self.n_trees + 1, dtype=np.float64)
+        exact = self.n_trees - t
+        if delta <= 0:
+            return exact.astype(np.float32)
+        n_classes = self.value.shape[1]
+        statistical = np.sqrt(2 * t * np.log(max(n_classes - 1, 1) / delta))
+        return np.minimum(exact, statistical).astype(np.float32)
+
+    def predict_proba_early_exit(
+        self,
+        X: np.ndarray,
+        batch_trees: int = EARLY_EXIT_BATCH,
+        delta: float = EARLY_EXIT_DELTA,
+        block_size: int = BLOCK_SIZE,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Class probabilities of each row of $X, freezing rows once their class is decided (see module docstring).
+
+        :param X: flat (n_pixels, n_features) arr
+        :type X: np.ndarray
+        :param batch_trees: number of trees evaluated between checks, defaults to EARLY_EXIT_BATCH
+        :type batch_trees: int, optional
+        :param delta: max probability a frozen pixel's class differs from the full forest's, defaults to
+            EARLY_EXIT_DELTA
+        :type delta: float, optional
+        :param block_size: number of pixels per cache block, defaults to BLOCK_SIZE
+        :type block_size: int, optional
+        :return: (n_pixels, n_classes) float32 arr of class probabilities and (n_pixels,) int32 arr of the number of
+            trees each pixel was evaluated on
+        :rtype: Tuple[np.ndarray, np.ndarray]
+        """
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        out = np.zeros((X.shape[0], self.value.shape[1]), dtype=np.float32)
+        n_evaluated = np.zeros(X.shape[0], dtype=np.int32)
+        args = (
+            X,
+            self.roots,
+            self.feature,
+            self.threshold,
+            self.child,
+            self.value,
+            self.max_depth,
+            self.exit_bounds(delta),
+            max(batch_trees, 1),
+            out,
+            n_evaluated,
+            block_size,
+        )
+        if NUMBA_AVAILABLE:
+            set_num_threads(max(N_ALLOWED_CPUS, 1))
+            _predict_blocks_early_exit_numba(*args)
+        else:
+            _predict_blocks_early_exit_numpy(*args)
+        return out, n_evaluated
+
+
+class EarlyExitPredictor:
+    """Prediction function of a compiled forest in early exit mode, counting the tree evaluations it saves."""
+
+    def __init__(self, forest: CompiledForest, delta: float = EARLY_EXIT_DELTA) -> None:
+        """Wrap $forest.
+
+        :param forest: compiled forest
+        :type forest: CompiledForest
+        :param delta: max probability a frozen pixel's class differs from the full forest's, defaults to
+            EARLY_EXIT_DELTA
+        :type delta: float, optional
+        """
+        self.forest = forest
+        self.delta = delta
+        self.n_rows = 0
+        self.n_tree_evals = 0
+
+    @property
+    def saved_frac(self) -> float:
+        """Fraction of (pixel, tree) evaluations skipped so far."""
+        return 1 - self.n_tree_evals / max(self.n_rows * self.forest.n_trees, 1)
+
+    def __call__(self, X: np.ndarray) -> np.ndarray:
+        """Class probabilities of each row of $X, see CompiledForest.predict_proba_early_exit().
+
+        :param X: flat (n_pixels, n_features) arr
+        :type X: np.ndarray
+        :return: (n_pixels, n_classes) float32 arr of class probabilities
+        :rtype: np.ndarray
+        """
+        probs, n_evaluated = self.forest.predict_proba_early_exit(X, delta=self.delta)
+        self.n_rows += X.shape[0]
+        self.n_tree_evals += int(np.sum(n_evaluated, dtype=np.int64))
+        return probs
+
+
+def compile_forest(model: RandomForestClassifier) -> CompiledForest:
+    """Flatten a trained RandomForestClassifier into a CompiledForest.
+
+    :param model: trained forest
+    :type model: RandomForestClassifier
+    :return: compiled forest with the same predictions
+    :rtype: CompiledForest
+    """
+    return CompiledForest(model.estimators_, model.classes_)
+
+
+def _predict_blocks_numpy(
+    X: np.ndarray,
+    roots: np.ndarray,
+    feature: np.ndarray,
+    threshold: np.ndarray,
+    child: np.ndarray,
+    value: np.ndarray,
+    max_depth: int,
+    out: np.ndarray,
+    block_size: int,
+) -> None:
+    """Numpy fallback of the block kernel: all trees step down one level at a time over a block of pixels."""
+    n = X.shape[0]
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        b = end - start
+        block_t = np.ascontiguousarray(X[start:end].T).reshape(-1)
+        pixel_idx = np.arange(b, dtype=np.int32)[np.newaxis, :]
+        nodes = np.repeat(roots[:, np.newaxis], b, axis=1)
+        for _ in range(max_depth):
+            go_right = block_t[feature[nodes] * b + pixel_idx] > threshold[nodes]
+            nodes = child[nodes] + go_right
+        out[start:end] += np.sum(value[nodes], axis=0)
+
+
+def _predict_blocks_early_exit_numpy(
+    X: np.ndarray,
+    roots: np.ndarray,
+    feature: np.ndarray,
+    threshold: np.ndarray,
+    child: np.ndarray,
+    value: np.ndarray,
+    max_depth: int,
+    bounds: np.ndarray,
+    batch_trees: int,
+    out: np.ndarray,
+    n_evaluated: np.ndarray,
+    block_size: int,
+) -> None:
+    """Numpy fallback of the early exit kernel: each batch of trees steps down over the block's undecided pixels."""
+    n = X.shape[0]
+    n_trees = roots.shape[0]
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        block = X[start:end]
+        acc = np.zeros((end - start, value.shape[1]), dtype=np.float32)
+        active = np.arange(end - start)
+        n_done = np.full(end - start, n_trees, dtype=np.int32)
+        for t0 in range(0, n_trees, batch_trees):
+            t1 = min(t0 + batch_trees, n_trees)
+            nodes = np.repeat(roots[t0:t1, np.newaxis], active.shape[0], axis=1)
+            for _ in range(max_depth):
+                nodes = child[nodes] + (block[active[np.newaxis, :], feature[nodes]] > threshold[nodes])
+            acc[active] += np.sum(value[nodes], axis=0)
+            if t1 < n_trees and active.shape[0] > 0:
+                active = _freeze_decided_numpy(acc, active, n_done, bounds[t1], t1)
+        out[start:end] = acc / n_done[:, np.newaxis]
+        n_evaluated[start:end] = n_done
+
+
+def _freeze_decided_numpy(
+    acc: np.ndarray, active: np.ndarray, n_done: np.ndarray, bound: float, n_trees_done: int
+) -> np.ndarray:
+    """Freeze the $active pixels whose vote margin in $acc exceeds $bound, returning those still undecided."""
+    top_two = np.sort(acc[active], axis=1)[:, -2:]
+    decided = top_two[:, 1] - top_two[:, 0] > bound
+    n_done[active[decided]] = n_trees_done
+    return active[~decided]
+
+
+# helpers of the numba kernels below, in plain python so they're compiled (and rebound) only if numba's installed
+
+
+def _walk_tree(block_t, root, feature, threshold, child, max_depth, active, n_active, nodes):
+    """Step the first $n_active pixels of $active down the tree at $root, leaving their leaves in $nodes."""
+    nodes[:n_active] = root
+    for _ in range(max_depth):
+        for a in range(n_active):
+            node = nodes[a]
+            nodes[a] = child[node] + (block_t[feature[node], active[a]] > threshold[node])
+
+
+def _add_leaves(acc, value, nodes, active, n_active):
+    """Add the class probabilities of the leaves in $nodes to the votes of the first $n_active pixels of $active."""
+    for a in range(n_active):
+        for c in range(value.shape[1]):
+            acc[active[a], c] += value[nodes[a], c]
+
+
+def _vote_margin(votes):
+    """Top class votes minus runner up's."""
+    top, second = -1.0, -1.0
+    for v in votes:
+        if v > top:
+            second = top
+            top = v
+        elif v > second:
+            second = v
+    return top - second
+
+
+def _freeze_decided(acc, active, n_active, n_done, bound, n_trees_done):
+    """Freeze the first $n_active pixels of $active whose vote margin exceeds $bound, moving the undecided ones to
+    the front of $active and returning how many there are."""
+    n_kept = 0
+    for a in range(n_active):
+        j = active[a]
+        if _vote_margin(acc[j]) > bound:
+            n_done[j] = n_trees_done
+        else:
+            active[n_kept] = j
+            n_kept += 1
+    return n_kept
+
+
+if NUMBA_AVAILABLE:
+    _walk_tree = njit(nogil=True, cache=True)(_walk_tree)
+    _add_leaves = njit(nogil=True, cache=True)(_add_leaves)
+    _vote_margin = njit(nogil=True, cache=True)(_vote_margin)
+    _freeze_decided = njit(nogil=True, cache=True)(_freeze_decided)
+
+    @njit(parallel=True, nogil=True, cache=True)
+    def _predict_blocks_numba(X, roots, feature, threshold, child, value, max_depth, out, block_size):
+        """Block kernel: for each block (in parallel) run every tree over the cached, transposed block."""
+        n = X.shape[0]
+        n_classes = value.shape[1]
+        n_blocks = (n + block_size - 1) // block_size
+        for block_idx in prange(n_blocks):
+            start = block_idx * block_size
+            end = min(start + block_size, n)
+            b = end - start
+            block_t = np.ascontiguousarray(X[start:end].T)
+            all_pixels = np.arange(b)
+            nodes = np.empty(b, np.int32)
+            acc = np.zeros((b, n_classes), np.float32)
+            for t in range(roots.shape[0]):
+                nodes[:] = roots[t]
+                for _ in range(max_depth):
+                    for j in range(b):
+                        node = nodes[j]
+                        nodes[j] = child[node] + (block_t[feature[node], j] > threshold[node])
+                _add_leaves(acc, value, nodes, all_pixels, b)
+            out[start:end] += acc
+
+    @njit(parallel=True, nogil=True, cache=True)
+    def _predict_blocks_early_exit_numba(
+        X, roots, feature, threshold, child, value, max_depth, bounds, batch_trees, out, n_evaluated, block_size
+    ):
+        """Early exit kernel: for each block (in parallel) run batches of trees over its still undecided pixels."""
+        n = X.shape[0]
+        n_trees = roots.shape[0]
+        n_classes = value.shape[1]
+        n_blocks = (n + block_size - 1) // block_size
+        for block_idx in prange(n_blocks):
+            start = block_idx * block_size
+            end = min(start + block_size, n)
+            b = end - start
+            block_t = np.ascontiguousarray(X[start:end].T)
+            acc = np.zeros((b, n_classes), np.float32)
+            active = np.arange(b)
+            n_done = np.full(b, n_trees, np.int32)
+            nodes = np.empty(b, np.int32)
+            n_active = b
+            for t in range(n_trees):
+                _walk_tree(block_t, roots[t], feature, threshold, child, max_depth, active, n_active, nodes)
+                _add_leaves(acc, value, nodes, active, n_active)
+                if (t + 1) % batch_trees == 0 and t + 1 < n_trees:
+                    n_active = _freeze_decided(acc, active, n_active, n_done, bounds[t + 1], t + 1)
+                    if n_active == 0:
+                        break
+            for j in range(b):
+                for c in range(n_classes):
+                    out[start + j, c] = acc[j, c] / n_done[j]
+                n_evaluated[start + j] = n_done[j]
@@ -0,0 +1,223 @@
+"""Optional compression of feature stacks to a few components.
+
+With every filter enabled a feature stack has 100+ channels per pixel, and disk, memory-mapped reads, fitting and
+predicting all scale with that. When a session enables compression, the first image it featurises is used to fit a
+linear projection of standardised features to N_COMPONENTS components, either principal components (an
+incremental PCA fit in batches on a pixel sample) or a Gaussian random projection. Every image's stack is then
+projected before being cached, so training and applying run in the reduced space unchanged. The projection is
+saved in the user's folder so later uploads are compressed consistently.
+
+Classifiers trained on compressed features take components, so they can't be applied to uncompressed features
+directly. Downloads are exported (see export_compressed_model()) with the projection as a first (sklearn PCA) step,
+so apply_classifier.py can apply them to the full stack. Superpixel classifiers of compressed features can't be
+exported, as the standard deviations of components aren't a projection of the features'.
+"""
+import numpy as np
+from sklearn.decomposition import IncrementalPCA, PCA
+from sklearn.pipeline import Pipeline
+from sklearn.random_projection import GaussianRandomProjection
+from typing import List, Literal, Tuple, TypeAlias
+
+from file_handling import save_projection, load_projection, delete_projection
+from superpixels import is_superpixel_model
+
+CompressionMethod: TypeAlias = Literal["pca", "random"]
+COMPRESSION_METHODS: Tuple[str, ...] = ("pca", "random")
+N_COMPONENTS = 16
+# max pixels sampled to fit the projection
+SAMPLE_PIXELS = 40000
+PCA_BATCH_SIZE = 4096
+
+
+class Projection:
+    """Linear projection of standardised features: ((x - mean) / scale) @ components.T"""
+
+    def __init__(self, mean: np.ndarray, scale: np.ndarray, components: np.ndarray) -> None:
+        """Store projection arrs as float32.
+
+        :param mean: (n_features,) arr of feature means
+        :type mean: np.ndarray
+        :param scale: (n_features,) arr of (non-zero) feature standard deviations
+        :type scale: np.ndarray
+        :param components: (n_components, n_features) projection arr
+        :type components: np.ndarray
+        """
+        self.mean = mean.astype(np.float32)
+        self.scale = scale.astype(np.float32)
+        self.components = components.astype(np.float32)
+        # fold the standardisation into the projection: x @ W - b
+        self._weights = np.ascontiguousarray((self.components / self.scale).T)
+        self._bias = (self.mean / self.scale) @ self.components.T
+
+    @property
+    def n_features_in(self) -> int:
+        """Number of features projected from."""
+        return self.components.shape[1]
+
+    @property
+    def n_components(self) -> int:
+        """Number of components projected to."""
+        return self.components.shape[0]
+
+    def transform(self, feature_stack: np.ndarray) -> np.ndarray:
+        """Project (h, w, n_features) $feature_stack to an (h, w, n_components) float32 arr.
+
+        :param feature_stack: feature stack from multiscale_advanced_features
+        :type feature_stack: np.ndarray
+        :return: compressed feature stack
+        :rtype: np.ndarray
+        """
+        h, w, feat = feature_stack.shape
+        flat = np.asarray(feature_stack, dtype=np.float32).reshape((h * w, feat))
+        out = flat @ self._weights
+        out -= self._bias
+        return out.reshape((h, w, self.n_components))
+
+
+def projection_to_pca(projection: Projection) -> PCA:
+    """Build an (already fitted) sklearn PCA computing $projection, with the standardisation folded in, so it can
+    be saved (with skops) as a step of a Pipeline.
+
+    :param projection: session's projection
+    :type projection: Projection
+    :return: PCA whose transform() is $projection on flat (n_pixels, n_features) arrs
+    :rtype: PCA
+    """
+    pca = PCA(n_components=projection.n_components)
+    # ((x - mean) / scale) @ C.T == (x - mean) @ (C / scale).T
+    pca.mean_ = projection.mean.astype(np.float64)
+    pca.components_ = (projection.components / projection.scale).astype(np.float64)
+    pca.n_components_ = projection.n_components
+    pca.n_features_in_ = projection.n_features_in
+    return pca
+
+
+def export_compressed_model(projection: Projection, model: object) -> Pipeline:
+    """Put $model, trained on features compressed by $projection, behind the projection so it predicts on full
+    (uncompressed) stacks, i.e for downloading to use with apply_classifier.py.
+
+    :param projection: session's projection
+    :type projection: Projection
+    :param model: classifier (or distilled student) trained on compressed features
+    :type model: object
+    :raises Exception: if $model is a superpixel classifier
+    :return: pipeline of the projection then $model
+    :rtype: Pipeline
+    """
+    if is_superpixel_model(model):
+        raise Exception("superpixel classifiers of compressed features can't be downloaded")
+    return Pipeline([("compress", projection_to_pca(projection)), ("model", model)])
+
+
+def _sample_pixels(feature_stack: np.ndarray, n_pixels: int, seed: int = 0) -> np.ndarray:
+    """Sample up to $n_pixels rows of flattened $feature_stack without replacement."""
+    h, w, feat = feature_stack.shape
+    flat = feature_stack.reshape((h * w, feat))
+    rng = np.random.default_rng(seed)
+    inds = np.sort(rng.choice(h * w, size=min(n_pixels, h * w), replace=False))
+    return np.asarray(flat[inds], dtype=np.float64)
+
+
+def fit_projection(
+    feature_stack: np.ndarray, method: CompressionMethod, n_components: int = N_COMPONENTS
+) -> Projection:
+    """Fit a $method projection to $n_components components on a pixel sample of $feature_stack.
+
+    :param feature_stack: (h, w, n_features) feature stack to sample
+    :type feature_stack: np.ndarray
+    :param method: "pca" (incremental PCA) or "random" (Gaussian random projection)
+    :type method: CompressionMethod
+    :param n_components: number of components, capped at the number of features, defaults to N_COMPONENTS
+    :type n_components: int, optional
+    :return: fitted projection
+    :rtype: Projection
+    """
+    if method not in COMPRESSION_METHODS:
+        raise Exception(f"unknown compression method {method}, expected one of {COMPRESSION_METHODS}")
+    sample = _sample_pixels(feature_stack, SAMPLE_PIXELS)
+    n_components = min(n_components, sample.shape[1])
+    mean = np.mean(sample, axis=0)
+    scale = np.std(sample, axis=0)
+    # constant features are zeroed by standardising whatever their scale
+    scale[scale == 0] = 1
+    standardised = (sample - mean) / scale
+    if method == "pca":
+        pca = IncrementalPCA(n_components=n_components, batch_size=max(PCA_BATCH_SIZE, n_components))
+        pca.fit(standardised)
+        # ipca centres again with its own mean, which is ~0 after standardising but fold it in to be exact
+        return Projection(mean + pca.mean_ * scale, scale, pca.components_)
+    else:
+        projector = GaussianRandomProjection(n_components=n_components, random_state=0)
+        projector.fit(standardised)
+        return Projection(mean, scale, projector.components_)
+
+
+def get_projection(folder_name: str) -> Projection | None:
+    """Get the saved projection of the session with data folder $folder_name, if its features are compressed.
+
+    :param folder_name: user data folder name
+    :type folder_name: str
+    :return: projection or None
+    :rtype: Projection | None
+    """
+    arrs = load_projection(folder_name)
+    return None if arrs is None else Projection(*arrs)
+
+
+def compress_features(
+    folder_name: str,
+    feature_stack: np.ndarray,
+    method: CompressionMethod | None,
+    n_components: int = N_COMPONENTS,
+    refit: bool = False,
+) -> np.ndarray:
+    """Compress $feature_stack of the session in $folder_name with its projection, fitting one first if needed.
+
+    A new projection is fit on $feature_stack (and saved) when compression is requested and the session has no
+    projection yet, has one for a different number of features, or if $refit (i.e when all the session's images
+    are being re-featurised). Otherwise an existing projection is always applied, so a session's cached stacks stay
+    consistent; with no compression requested and $refit the projection is deleted.
+
+    :param folder_name: user data folder name
+    :type folder_name: str
+    :param feature_stack: (h, w, n_features) feature stack from multiscale_advanced_features
+    :type feature_stack: np.ndarray
+    :param method: compression method or None to not compress
+    :type method: CompressionMethod | None
+    :param n_components: number of components, defaults to N_COMPONENTS
+    :type n_components: int, optional
+    :param refit: whether to fit a new projection (or stop compressing) regardless, defaults to False
+    :type refit: bool, optional
+    :return: compressed (or unchanged) feature stack
+    :rtype: np.ndarray
+    """
+    projection = None if refit else get_projection(folder_name)
+    if projection is not None and projection.n_features_in != feature_stack.shape[-1]:
+        projection = None
+    if projection is None and method is not None:
+        projection = fit_projection(feature_stack, method, n_components)
+        save_projection(folder_name, projection.mean, projection.scale, projection.components)
+    elif projection is None:
+        delete_projection(folder_name)
+    return feature_stack if projection is None else projection.transform(feature_stack)
+
+
+def explained_variance(feature_stacks: List[np.ndarray], projection: Projection) -> float:
+    """Fraction of the (standardised) variance of $feature_stacks that $projection preserves.
+
+    Only meaningful for PCA, where components are orthonormal.
+
+    :param feature_stacks: list of uncompressed (h, w, n_features) feature stacks
+    :type feature_stacks: List[np.ndarray]
+    :param projection: fitted projection
+    :type projection: Projection
+    :return: explained variance ratio
+    :rtype: float
+    """
+    total, explained = 0.0, 0.0
+    for feature_stack in feature_stacks:
+        sample = _sample_pixels(feature_stack, SAMPLE_PIXELS)
+        standardised = (sample - projection.mean) / projection.scale
+        total += float(np.sum(np.var(standardised, axis=0)))
+        explained += float(np.sum(np.var(standardised @ projection.components.T, axis=0)))
+    return explained / total
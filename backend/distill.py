@@ -0,0 +1,116 @@
+"""Distillation of a trained classifier into a small forest for bulk apply.
+
+The 200 tree forest (or booster) is heavy to apply over large stacks and to download. After training, a student
+forest of DISTILL_TREES deeper trees is fit to the trained model's predictions on DISTILL_PIXELS pixels sampled
+from all of the user's images, labelled or not. Each pixel's target is the model's most likely class, weighted by
+its probability so pixels the model is unsure of matter less. (Fitting the full soft labels instead, one row per
+class weighted by its probability, was slower and agreed less: the students learnt the model's noise near 0.5.)
+The student is kept (and saved alongside the full classifier) only if its classes agree with the
+full model's on at least DISTILL_AGREEMENT of a separate sample of pixels, in which case it's used for applying.
+Distilling runs on the background artifact worker after /segmenting responds, so until it's done (or if the
+student was rejected) the full classifier is applied.
+"""
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from time import perf_counter
+from typing import Callable, Tuple
+
+from file_handling import load_features
+from forest_based import get_model, fit, get_predictor, EnsembleMethod
+
+DISTILL_TREES = 8
+DISTILL_MAX_DEPTH = 20
+DISTILL_FEATURES = 8
+DISTILL_PIXELS = 50000
+DISTILL_HOLDOUT_PIXELS = 20000
+# min fraction of held out pixels the student must classify the same as the full model
+DISTILL_AGREEMENT = 0.98
+
+
+def sample_pixels(UID: str, n_imgs: int, n_pixels: int, seed: int = 0) -> np.ndarray:
+    """Sample $n_pixels feature rows uniformly from all pixels of cached images 0..$n_imgs-1.
+
+    :param UID: user ID pointing to folder with the features
+    :type UID: str
+    :param n_imgs: number of images
+    :type n_imgs: int
+    :param n_pixels: number of rows to sample (with replacement)
+    :type n_pixels: int
+    :param seed: random seed, defaults to 0
+    :type seed: int, optional
+    :return: (n_pixels, n_features) arr of sampled rows
+    :rtype: np.ndarray
+    """
+    rng = np.random.default_rng(seed)
+    stacks = [load_features(UID, i) for i in range(n_imgs)]
+    sizes = np.array([stack.shape[0] * stack.shape[1] for stack in stacks], dtype=np.int64)
+    img_inds = rng.choice(n_imgs, size=n_pixels, p=sizes / np.sum(sizes))
+    rows = []
+    for i, stack in enumerate(stacks):
+        h, w, feat = stack.shape
+        # sorted so the memory map is read in order
+        flat_inds = np.sort(rng.integers(0, h * w, size=np.sum(img_inds == i)))
+        rows.append(np.asarray(stack.reshape((h * w, feat))[flat_inds]))
+    # shuffled so any slice of the sample is spread over the images
+    return rng.permutation(np.concatenate(rows, axis=0), axis=0)
+
+
+def confidence_weighted_targets(probs: np.ndarray, classes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Most likely class of each row of $probs, weighted by its probability.
+
+    :param probs: (n_rows, n_classes) arr of class probabilities of each row
+    :type probs: np.ndarray
+    :param classes: class values of the columns of $probs
+    :type classes: np.ndarray
+    :return: tuple of target data and sample weights
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    return np.asarray(classes)[np.argmax(probs, axis=1)], np.amax(probs, axis=1)
+
+
+def agreement(predictor: Callable[[np.ndarray], np.ndarray], probs: np.ndarray, data: np.ndarray) -> float:
+    """Fraction of rows of $data where $predictor's most likely class matches that of reference $probs.
+
+    :param predictor: prediction function (with the same classes as $probs)
+    :type predictor: Callable[[np.ndarray], np.ndarray]
+    :param probs: (n_rows, n_classes) arr of reference class probabilities
+    :type probs: np.ndarray
+    :param data: (n_rows, n_features) arr of feature rows
+    :type data: np.ndarray
+    :return: agreement in [0, 1]
+    :rtype: float
+    """
+    return float(np.mean(np.argmax(predictor(data), axis=1) == np.argmax(probs, axis=1)))
+
+
+def distill(
+    model: EnsembleMethod, UID: str, n_imgs: int
+) -> Tuple[RandomForestClassifier | None, float]:
+    """Fit a small student forest to trained $model's predictions on pixels of the user's images.
+
+    :param model: a *trained* sklearn ensemble method (or pipeline)
+    :type model: EnsembleMethod
+    :param UID: user ID pointing to folder with the features
+    :type UID: str
+    :param n_imgs: number of images to sample pixels from
+    :type n_imgs: int
+    :return: the student, or None if its agreement with $model is below DISTILL_AGREEMENT, and its agreement
+    :rtype: Tuple[RandomForestClassifier | None, float]
+    """
+    start_t = perf_counter()
+    predictor = get_predictor(model)
+    data = sample_pixels(UID, n_imgs, DISTILL_PIXELS + DISTILL_HOLDOUT_PIXELS)
+    probs = predictor(data)
+    train_data, holdout_data = data[:DISTILL_PIXELS], data[DISTILL_PIXELS:]
+    train_probs, holdout_probs = probs[:DISTILL_PIXELS], probs[DISTILL_PIXELS:]
+
+    student = get_model("FRF", DISTILL_TREES, min(DISTILL_FEATURES, data.shape[1]), DISTILL_MAX_DEPTH)
+    # runs on the background worker, so fit on one core (see artifacts.py)
+    student.set_params(oob_score=False, n_jobs=1)
+    student = fit(student, train_data, *confidence_weighted_targets(train_probs, model.classes_))
+    if not np.array_equal(student.classes_, model.classes_):
+        # a class the full model is never most sure of can't be learnt
+        return None, 0
+    score = agreement(get_predictor(student), holdout_probs, holdout_data)
+    print(f"distilled to {DISTILL_TREES} trees in {perf_counter() - start_t:.2f}s, agreement {score:.4f}")
+    return (student if score >= DISTILL_AGREEMENT else None), score
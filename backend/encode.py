@@ -12,6 +12,9 @@ from tifffile import imwrite
 
 from test_resources.call_weka import sep
 from features import DEAFAULT_FEATURES, multiscale_advanced_features
+from file_handling import save_features, save_superpixels
+from superpixels import compute_superpixels
+from compression import compress_features, CompressionMethod, N_COMPONENTS
 
 DEBUG = False
 
@@ -57,6 +60,9 @@ async def featurise(
     UID: str,
     selected_features=DEAFAULT_FEATURES,
     offset: int = 0,
+    superpixels: bool = False,
+    compression: CompressionMethod | None = None,
+    n_components: int = N_COMPONENTS,
 ) -> int:
     """For each img in images, convert to np array then featurise, saving the result to the user's folder.
 
@@ -68,13 +74,25 @@ async def featurise(
     :type selected_features: _type_, optional
     :param offset: index offset in case images added later, defaults to 0
     :type offset: int, optional
+    :param superpixels: whether to also over-segment into superpixels for superpixel mode, defaults to False
+    :type superpixels: bool, optional
+    :param compression: compress features to components with "pca" or "random" projection (see compression.py), fit
+        when featurising from the first image, defaults to None (uncompressed)
+    :type compression: CompressionMethod | None, optional
+    :param n_components: number of components to compress to, defaults to N_COMPONENTS
+    :type n_components: int, optional
     :return: 0 for success
     :rtype: int
     """
     for i, img in enumerate(images):
         img_arr = np.array(img.convert("L"))
         feature_stack = multiscale_advanced_features(img_arr, selected_features)
-        np.savez_compressed(f"{CWD}{sep}{UID}{sep}features_{i + offset}", a=feature_stack)
+        feature_stack = compress_features(
+            f"{CWD}{sep}{UID}", feature_stack, compression, n_components, refit=i + offset == 0
+        )
+        save_features(f"{CWD}{sep}{UID}", i + offset, feature_stack)
+        if superpixels:
+            save_superpixels(f"{CWD}{sep}{UID}", i + offset, compute_superpixels(img_arr))
         if DEBUG:
             transpose = feature_stack.transpose((2, 0, 1))
             imwrite(f"{CWD}{sep}{UID}{sep}features_{i + offset}.tiff", transpose)
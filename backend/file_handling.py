@@ -1,8 +1,11 @@
 """File handling that works for either a local server or on the web app."""
 
 import os
+import json
+import numpy as np
 from time import time_ns
 from shutil import rmtree
+from typing import List, Tuple
 
 try:
     CWD = os.environ["APP_PATH"]
@@ -73,14 +76,17 @@ def _check_to_delete(old_timestamp_str: str, new_timestamp_str: str) -> bool:
         return False
 
 
-def delete_old_folders(UID: str) -> None:
+def delete_old_folders(UID: str) -> List[str]:
     """Call when new user connects: checks name of each folder (a timestamp + random UID) and if more han 2 hours old, delete.
 
     :param UID: user ID of new connection, which is taken as the current timestamp old folders are compared to.
     :type UID: str
+    :return: list of UIDs whose folders were deleted, so any in-memory state of theirs can be dropped too
+    :rtype: List[str]
     """
     current_timestamp = UID[:-5]
     subfolders = [f.path for f in os.scandir(CWD) if f.is_dir()]
+    deleted_UIDs: List[str] = []
     n_delete = 0
     for folder in subfolders:
         old_timestamp = _check_data_folder(folder)
@@ -90,10 +96,236 @@ def delete_old_folders(UID: str) -> None:
             delete = _check_to_delete(last_activity_timestamp, current_timestamp)
             if delete:
                 rmtree(folder)  # rmtree needed for proper delete
+                deleted_UIDs.append(os.path.basename(folder))
                 n_delete += 1
         else:
             pass
     print(f"Deleted {n_delete} old folders that were more than {DELETE_TIME_MS}ms old.")
+    return deleted_UIDs
+
+
+def _get_feature_idx_ext(feature_fp: str) -> Tuple[int, str]:
+    """Split feature file name of form features_{idx}.{ext} into its index and extension (with the dot)."""
+    idx_ext = feature_fp.split("_")[-1]
+    dot = idx_ext.index(".")
+    return int(idx_ext[:dot]), idx_ext[dot:]
+
+
+def get_features_path(folder_name: str, idx: int) -> str:
+    """Get path of the cached feature stack of image $idx, preferring the uncompressed (memory-mappable) .npy.
+
+    :param folder_name: user data folder name
+    :type folder_name: str
+    :param idx: index of image the features belong to
+    :type idx: int
+    :return: path to the .npy file if it exists, otherwise the legacy compressed .npz path
+    :rtype: str
+    """
+    npy_path = f"{folder_name}/features_{idx}.npy"
+    if os.path.exists(npy_path):
+        return npy_path
+    return f"{folder_name}/features_{idx}.npz"
+
+
+def get_file_signature(path: str) -> Tuple[int, int, int]:
+    """Get (inode, modified time, size) of file at $path. Changes if the file is rewritten or replaced.
+
+    :param path: path to file
+    :type path: str
+    :return: tuple of inode, modified time (ns) and size of the file
+    :rtype: Tuple[int, int, int]
+    """
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def get_features_signature(folder_name: str, idx: int) -> Tuple[int, int, int]:
+    """Get (inode, modified time, size) of cached features of image $idx. Changes if they're recomputed or renamed.
+
+    Used by in-memory caches derived from the features to check they're still valid.
+
+    :param folder_name: user data folder name
+    :type folder_name: str
+    :param idx: index of image the features belong to
+    :type idx: int
+    :return: tuple of inode, modified time (ns) and size of the features file
+    :rtype: Tuple[int, int, int]
+    """
+    return get_file_signature(get_features_path(folder_name, idx))
+
+
+def save_features(folder_name: str, idx: int, feature_stack: np.ndarray) -> str:
+    """Save (HxWxN) feature stack of image $idx as an uncompressed .npy so it can be memory-mapped later.
+
+    Written to a temp file then renamed so readers never see a partially written stack.
+
+    :param folder_name: user data folder name
+    :type folder_name: str
+    :param idx: index of image the features belong to
+    :type idx: int
+    :param feature_stack: feature stack from multiscale_advanced_features
+    :type feature_stack: np.ndarray
+    :return: path of saved file
+    :rtype: str
+    """
+    out_path = f"{folder_name}/features_{idx}.npy"
+    tmp_path = f"{folder_name}/tmp_feats_{idx}"
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.ascontiguousarray(feature_stack))
+    os.replace(tmp_path, out_path)
+    legacy_path = f"{folder_name}/features_{idx}.npz"
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+    return out_path
+
+
+def load_features(folder_name: str, idx: int, mmap: bool = True) -> np.ndarray:
+    """Load cached (HxWxN) feature stack of image $idx.
+
+    If stored as .npy and $mmap is true this is a read-only memory map, so indexing it only reads the pages
+    touched (i.e gathering labelled rows doesn't load the whole stack). Legacy .npz stacks are always fully loaded.
+
+    :param folder_name: user data folder name
+    :type folder_name: str
+    :param idx: index of image the features belong to
+    :type idx: int
+    :param mmap: whether to memory-map the stack, defaults to True
+    :type mmap: bool, optional
+    :return: feature stack arr (or memory map of it)
+    :rtype: np.ndarray
+    """
+    path = get_features_path(folder_name, idx)
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r" if mmap else None)
+    return np.load(path)["a"]
+
+
+def save_superpixels(folder_name: str, idx: int, superpixels: np.ndarray) -> str:
+    """Save (HxW) superpixel ids of image $idx (see superpixels.py), written to a temp file then renamed.
+
+    :param folder_name: user data folder name
+    :type folder_name: str
+    :param idx: index of image the superpixels belong to
+    :type idx: int
+    :param superpixels: arr of superpixel ids from compute_superpixels
+    :type superpixels: np.ndarray
+    :return: path of saved file
+    :rtype: str
+    """
+    out_path = f"{folder_name}/superpixels_{idx}.npy"
+    tmp_path = f"{folder_name}/tmp_superpixels_{idx}"
+    with open(tmp_path, "wb") as f:
+        np.save(f, superpixels)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def load_superpixels(folder_name: str, idx: int) -> np.ndarray:
+    """Load (HxW) superpixel ids of image $idx, raising if they weren't computed when it was featurised.
+
+    :param folder_name: user data folder name
+    :type folder_name: str
+    :param idx: index of image the superpixels belong to
+    :type idx: int
+    :return: arr of superpixel ids
+    :rtype: np.ndarray
+    """
+    path = f"{folder_name}/superpixels_{idx}.npy"
+    if not os.path.exists(path):
+        raise Exception(f"no superpixels for image {idx}, featurise with superpixels enabled")
+    return np.load(path)
+
+
+def save_projection(folder_name: str, mean: np.ndarray, scale: np.ndarray, components: np.ndarray) -> str:
+    """Save the session's feature compression (see compression.py), written to a temp file then renamed.
+
+    :param folder_name: user data folder name
+    :type folder_name: str
+    :param mean: (n_features,) arr of feature means subtracted before projecting
+    :type mean: np.ndarray
+    :param scale: (n_features,) arr of feature scales divided by before projecting
+    :type scale: np.ndarray
+    :param components: (n_components, n_features) projection arr
+    :type components: np.ndarray
+    :return: path of saved file
+    :rtype: str
+    """
+    out_path = f"{folder_name}/projection.npz"
+    tmp_path = f"{folder_name}/tmp_projection"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, mean=mean, scale=scale, components=components)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def load_projection(folder_name: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray] | None:
+    """Load the session's feature compression, or None if its features aren't compressed.
+
+    :param folder_name: user data folder name
+    :type folder_name: str
+    :return: tuple of mean, scale and components arrs, or None
+    :rtype: Tuple[np.ndarray, np.ndarray, np.ndarray] | None
+    """
+    path = f"{folder_name}/projection.npz"
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        return f["mean"], f["scale"], f["components"]
+
+
+def delete_projection(folder_name: str) -> None:
+    """Delete the session's feature compression, if any, so its features are stored uncompressed.
+
+    :param folder_name: user data folder name
+    :type folder_name: str
+    """
+    path = f"{folder_name}/projection.npz"
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def save_session_features(folder_name: str, requested: dict, computed: dict) -> str | None:
+    """Save the feature dict the user requested and the (possibly pruned, see pruning.py) one computed for them,
+    written to a temp file then renamed.
+
+    :param folder_name: user data folder name
+    :type folder_name: str
+    :param requested: feature dict sent by the user
+    :type requested: dict
+    :param computed: feature dict their images are featurised with
+    :type computed: dict
+    :return: path of saved file, or None if the folder doesn't exist
+    :rtype: str | None
+    """
+    if not os.path.isdir(folder_name):
+        return None
+    out_path = f"{folder_name}/session_features.json"
+    tmp_path = f"{folder_name}/tmp_session_features"
+    with open(tmp_path, "w") as f:
+        json.dump({"requested": requested, "computed": computed}, f)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def load_session_features(folder_name: str) -> Tuple[dict, dict] | None:
+    """Load the session's requested and computed feature dicts, or None if they haven't been saved.
+
+    :param folder_name: user data folder name
+    :type folder_name: str
+    :return: tuple of requested and computed feature dicts, or None
+    :rtype: Tuple[dict, dict] | None
+    """
+    path = f"{folder_name}/session_features.json"
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        saved = json.load(f)
+    return saved["requested"], saved["computed"]
+
+
+def _is_per_image_file(fp: str) -> bool:
+    """Whether $fp is a cached per-image file (features or superpixels) named {prefix}_{idx}.{ext}."""
+    return fp.startswith("features_") or fp.startswith("superpixels_")
 
 
 def delete_feature_file(folder_name: str, delete_idx: int) -> int:
@@ -109,19 +341,20 @@ def delete_feature_file(folder_name: str, delete_idx: int) -> int:
     """
     feature_file_paths = []
     for fp in os.listdir(folder_name):
-        if "features" in fp:
+        if _is_per_image_file(fp):
             feature_file_paths.append(fp)
 
     tmp_fps = []
     for i, feature_fp in enumerate(feature_file_paths):
-        file_idx = int(feature_fp.split("_")[-1][:-4])
+        file_idx, ext = _get_feature_idx_ext(feature_fp)
         print(feature_fp, file_idx, delete_idx)
         if file_idx == delete_idx:
             print("deleting")
             os.remove(f"{folder_name}/{feature_fp}")
         elif file_idx > delete_idx:
             # need to do it this way to avoid writing to file that already exists (file paths not ordered by index!)
-            new_fp = feature_fp[:-5] + f"{file_idx - 1}.npz_{i % 10}"
+            prefix = feature_fp[: feature_fp.rindex("_")]
+            new_fp = f"{prefix}_{file_idx - 1}{ext}_{i % 10}"
             os.rename(f"{folder_name}/{feature_fp}", f"{folder_name}/{new_fp}")
             tmp_fps.append(f"{folder_name}/{new_fp}")
     print(tmp_fps, os.listdir(folder_name))
@@ -131,7 +364,7 @@ def delete_feature_file(folder_name: str, delete_idx: int) -> int:
 
 
 def delete_all_features(folder_name: str) -> int:
-    """Delete all features files in a folder.
+    """Delete all features (and superpixels) files in a folder.
 
     :param folder_name: user data folder name
     :type folder_name: str
@@ -139,6 +372,6 @@ def delete_all_features(folder_name: str) -> int:
     :rtype: int
     """
     for fp in os.listdir(folder_name):
-        if "features" in fp:
+        if _is_per_image_file(fp):
             os.remove(f"{folder_name}/{fp}")
     return 0
@@ -12,20 +12,84 @@ memoise things like feature computation) that is part of a GUI app.
 """
 import numpy as np
 from features import multiscale_advanced_features, N_ALLOWED_CPUS, DEAFAULT_FEATURES, BACKEND
-from test_resources.call_weka import sep
+from file_handling import load_features, get_features_path
+from training_set import get_training_set
+from incremental import get_incremental_forest, clear_incremental_forest
+from compiled_forest import compile_forest, CompiledForest, EarlyExitPredictor, NUMBA_AVAILABLE
+from validation import (
+    ValidationMode,
+    add_oob_votes,
+    oob_accuracy,
+    compute_oob_score,
+    split_holdout,
+    holdout_accuracy,
+    defer_score,
+    clear_deferred,
+)
+from dedup import DedupPredictor, quantize_rows, hash_rows
+from superpixels import get_region_training_data, apply_superpixels, mark_superpixel_model
+from binning import get_binner, bin_features, make_binned_model, is_binned_model, CompiledBooster, N_BINS
+from compression import get_projection
+from pruning import (
+    get_session_features,
+    set_pruned_features,
+    prune_features,
+    prune_cached_features,
+    make_pruned_model,
+    is_pruned_model,
+    get_kept_columns,
+)
 from sklearn.utils import parallel_backend
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.ensemble import GradientBoostingClassifier
 from sklearn.ensemble import HistGradientBoostingClassifier
-from typing import List, Tuple, TypeAlias, Literal
+from sklearn.pipeline import Pipeline
+from collections import deque
+from time import perf_counter
+from mmap import PAGESIZE
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Deque, Iterator, List, Tuple, TypeAlias, Literal
 
 print(N_ALLOWED_CPUS)
 
 EnsembleMethod: TypeAlias = (
-    RandomForestClassifier | GradientBoostingClassifier | HistGradientBoostingClassifier
+    RandomForestClassifier | GradientBoostingClassifier | HistGradientBoostingClassifier | Pipeline
 )
 
 EnsembleMethodName: TypeAlias = Literal["FRF", "XGB", "LGBM"]
+SamplerName: TypeAlias = Literal["random", "thinned", "diverse"]
+SAMPLERS: List[str] = ["random", "thinned", "diverse"]
+
+# approx number of pixels predicted at once when streaming an image
+STREAM_BLOCK_PIXELS = 2**16
+# max bytes of feature stacks loaded ahead of (or being) predicted when applying a classifier to many images
+APPLY_MEMORY_BUDGET = 2 * 1024**3
+# number of threads loading (reading/decompressing) feature stacks ahead of prediction
+N_LOAD_WORKERS = 2
+# time-budgeted training: trees are grown in batches until the budget runs out or the OOB score converges
+BUDGET_BATCH_TREES = 16
+BUDGET_MIN_TREES = 32
+BUDGET_MAX_TREES = 400
+# OOB score is converged once it changes by less than this for BUDGET_CONVERGED_BATCHES batches in a row
+BUDGET_CONVERGENCE_TOL = 0.002
+BUDGET_CONVERGED_BATCHES = 2
+# "diverse" sampler: thin to this many times the points, then drop near-duplicate features (quantized to these bits)
+DIVERSE_OVERSAMPLE = 2
+DIVERSE_MANTISSA_BITS = 4
+
+
+def get_class_counts(target_data: np.ndarray) -> np.ndarray:
+    """Count occurences of each class value in $target_data with a single bincount.
+
+    Class values are used directly as bins, so the returned arr has length max(class) + 1 and
+    absent (or sparse) class ids simply have a count of 0.
+
+    :param target_data: flat arr of (non-negative integer) class values of labelled pixels
+    :type target_data: np.ndarray
+    :return: arr where entry c is number of pixels with class value c
+    :rtype: np.ndarray
+    """
+    return np.bincount(target_data.astype(np.intp, copy=False))
 
 
 def get_class_weights(target_data: np.ndarray) -> Tuple[np.ndarray, List[int]]:
@@ -33,24 +97,20 @@ def get_class_weights(target_data: np.ndarray) -> Tuple[np.ndarray, List[int]]:
 
     Given flat array of label data ($target_data), create arr of same shape where
     each entry is the class weight corresponding to the class present at the entry
-    in target data. Used for balancing training.
+    in target data. Used for balancing training. Weights are computed per class from
+    one bincount then broadcast with a lookup table, so this is O(N) in the number of points.
 
     :param target_data: flat arr of class values corresponding to labelled pixels
     :type target_data: np.ndarray
     :return: tuple of arrs, same shape as $target_data of both the weights and frequencies of each class
     :rtype: Tuple[np.ndarray, List[int]]
     """
-    weights_arr = np.ones_like(target_data)
-    unique_classes = np.unique(target_data)
-    class_freqs: List[int] = []
-    for class_val in unique_classes:
-        matches = np.where(target_data == class_val, 1, 0)
-        class_freq = np.sum(matches)
-        class_freqs.append(class_freq)
-    class_weights = [max(class_freqs) / i for i in class_freqs]
-
-    for i, class_val in enumerate(unique_classes):
-        weights_arr = np.where(target_data == class_val, class_weights[i], weights_arr)
+    counts = get_class_counts(target_data)
+    present = counts > 0
+    weight_lut = np.zeros(counts.shape[0], dtype=np.float64)
+    weight_lut[present] = np.amax(counts) / counts[present]
+    weights_arr = weight_lut[target_data.astype(np.intp, copy=False)]
+    class_freqs: List[int] = counts[present].tolist()
     return weights_arr, class_freqs
 
 
@@ -84,7 +144,11 @@ def get_training_data(
 def get_training_data_features_done(
     labels: List[np.ndarray], UID: str
 ) -> Tuple[np.ndarray, np.ndarray]:
-    """For each img, load cached features. Check if img is labelled and if it is get the training data and concat.
+    """For each labelled img, gather its labelled rows from the cached features into one preallocated arr.
+
+    The labelled (flat) pixel indices of every image are found first so the exact output size is known.
+    Rows are then gathered straight from the memory-mapped feature stacks, so peak memory is proportional
+    to the number of labelled pixels rather than the number (and size) of the images.
 
     :param labels: label arr
     :type labels: List[np.ndarray]
@@ -93,21 +157,26 @@ def get_training_data_features_done(
     :return: tuple of fit data and target data over all (labelled) imgs
     :rtype: Tuple[np.ndarray, np.ndarray]
     """
-    fit_data_set = False
-    all_fit_data: np.ndarray
-    all_target_data: np.ndarray
-    for i, label in enumerate(labels):
-        is_labelled = np.sum(label) >= 1
-        if is_labelled:
-            feature_stack = np.load(f"{UID}{sep}features_{i}.npz")["a"]  # need to index
-            fit_data, target_data = get_training_data(feature_stack, label)
-            if fit_data_set is False:
-                all_fit_data = fit_data
-                all_target_data = target_data
-                fit_data_set = True
-            else:
-                all_fit_data = np.concatenate((all_fit_data, fit_data), axis=0)
-                all_target_data = np.concatenate((all_target_data, target_data), axis=0)
+    labelled_inds = [np.flatnonzero(label) for label in labels]
+    n_rows = sum(inds.shape[0] for inds in labelled_inds)
+    labelled_imgs = [i for i, inds in enumerate(labelled_inds) if inds.shape[0] > 0]
+    if len(labelled_imgs) == 0:
+        raise Exception("no labelled pixels to train on")
+
+    first_stack = load_features(UID, labelled_imgs[0])
+    n_feat = first_stack.shape[-1]
+    all_fit_data = np.empty((n_rows, n_feat), dtype=first_stack.dtype)
+    all_target_data = np.empty((n_rows,), dtype=labels[labelled_imgs[0]].dtype)
+    row = 0
+    for i in labelled_imgs:
+        inds = labelled_inds[i]
+        n = inds.shape[0]
+        feature_stack = load_features(UID, i)
+        h, w, feat = feature_stack.shape
+        flat_features = feature_stack.reshape((h * w, feat))
+        np.take(flat_features, inds, axis=0, out=all_fit_data[row : row + n])
+        all_target_data[row : row + n] = labels[i].reshape((h * w))[inds]
+        row += n
     return (all_fit_data, all_target_data)
 
 
@@ -129,58 +198,193 @@ def _shuffle_fit_target(
     return fit[all_shuffle_inds], target[all_shuffle_inds]
 
 
+def sample_training_inds(target_data: np.ndarray, n_points: int) -> np.ndarray:
+    """Get (shuffled) indices of a class-stratified random sample of $target_data. See sample_training_data() for details.
+
+    :param target_data: flat target data arr
+    :type target_data: np.ndarray
+    :param n_points: total number of points to sample over all classes
+    :type n_points: int
+    :return: indices into $target_data of sampled points, in random order
+    :rtype: np.ndarray
+    """
+    n_total = target_data.shape[0]
+    counts = get_class_counts(target_data)
+    n_points_per_class = (n_points * counts / n_total).astype(np.intp)
+    class_starts = np.cumsum(counts) - counts
+
+    perm = np.random.permutation(n_total)
+    permuted_targets = target_data[perm]
+    # counting sort: scatter each point's permuted position into its class's run, in permutation order
+    order = np.empty(n_total, dtype=np.intp)
+    for c in np.flatnonzero(counts):
+        order[class_starts[c] : class_starts[c] + counts[c]] = np.flatnonzero(permuted_targets == c)
+
+    # a point's position within its class run is its random rank within its class, so keep each run's head
+    keep = np.zeros(n_total, dtype=bool)
+    for c in np.flatnonzero(n_points_per_class):
+        keep[order[class_starts[c] : class_starts[c] + n_points_per_class[c]]] = True
+    return perm[keep]
+
+
 def sample_training_data(
     fit_data: np.ndarray,
     target_data: np.ndarray,
-    class_counts: List[int],
     n_points: int,
 ) -> Tuple[np.ndarray, np.ndarray]:
     """Sample training data randomly up to n_points.
 
-    Given flat arrays of fit and target data, class frequencies and desired number of points, loop through each class,
-    sample class_freq * $n_points randomly of each class, put into array then shuffle once all classes sampled from.
+    Given flat arrays of fit and target data and desired number of points, sample class_freq * $n_points
+    randomly of each class. Rather than shuffling per class, take one global random permutation, counting sort it
+    by class (bincount, cumsum offsets, then scatter, O(n_classes * N)) and keep the first n_points_per_class of
+    each class run. Mapping the kept mask back to permutation order means the output is already globally shuffled.
 
     :param fit_data: flat fit data arr
     :type fit_data: np.ndarray
     :param target_data: flat target data arr
     :type target_data: np.ndarray
-    :param class_counts: frequencies of each class
-    :type class_counts: List[int]
     :param n_points: total number of points to sample over all classes
     :type n_points: int
     :return: tuple of shuffled and sampled flat fit data and target data arrs
     :rtype: Tuple[np.ndarray, np.ndarray]
     """
-    sampled_fit_data: np.ndarray
-    sampled_target_data: np.ndarray
-    class_freqs = [i / sum(class_counts) for i in class_counts]
-    for i, freq in enumerate(class_freqs):
-        class_val = i + 1
-        n_points_per_class = int(n_points * freq)
-
-        matching_inds = np.nonzero(np.where(target_data == class_val, 1, 0))
-        class_filtered_fit = fit_data[matching_inds]
-        class_filtered_target = (
-            np.zeros(shape=(class_filtered_fit.shape[0],)) + class_val
-        )
-        print(f"sampling up to {n_points_per_class} points for class {class_val}")
+    inds = sample_training_inds(target_data, n_points)
+    print(f"sampled and shuffled {len(inds)} points")
+    return fit_data[inds], target_data[inds]
+
+
+def _thin_rows(rows: np.ndarray, img_idx: np.ndarray, ys: np.ndarray, xs: np.ndarray, n_keep: int) -> np.ndarray:
+    """Keep one random row of $rows per cell of the coarsest square grid with no more than $n_keep occupied cells.
+
+    :param rows: candidate row indices
+    :type rows: np.ndarray
+    :param img_idx: image index of each row (all rows, not just $rows)
+    :type img_idx: np.ndarray
+    :param ys: y coord of each row
+    :type ys: np.ndarray
+    :param xs: x coord of each row
+    :type xs: np.ndarray
+    :param n_keep: max rows to keep
+    :type n_keep: int
+    :return: kept rows, in random order
+    :rtype: np.ndarray
+    """
+    rows = np.random.permutation(rows)
+    if rows.shape[0] <= n_keep:
+        return rows
+    img, y, x = img_idx[rows].astype(np.int64), ys[rows], xs[rows]
 
-        shuffle_inds = np.arange(0, len(class_filtered_fit), 1)
-        np.random.shuffle(shuffle_inds)
-        shuffled_fit = class_filtered_fit[shuffle_inds]
+    def _cells(size: int) -> np.ndarray:
+        return (img << 42) | ((y // size) << 21) | (x // size)
 
-        sampled_fit = shuffled_fit[:n_points_per_class]
-        sampled_target: np.ndarray = class_filtered_target[:n_points_per_class]
-        if i == 0:
-            sampled_fit_data = sampled_fit
-            sampled_target_data = sampled_target
+    # smallest cell size with few enough occupied cells (occupancy falls as cells grow)
+    lo, hi = 1, int(max(np.amax(y), np.amax(x))) + 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if np.unique(_cells(mid)).shape[0] <= n_keep:
+            hi = mid
         else:
-            sampled_fit_data = np.concatenate((sampled_fit_data, sampled_fit), axis=0)
-            sampled_target_data = np.concatenate(
-                (sampled_target_data, sampled_target), axis=0
-            )
-    # now globally shuffle our data
-    return _shuffle_fit_target(sampled_fit_data, sampled_target_data)
+            lo = mid + 1
+    # rows are in random order so the first row of each cell is a random one
+    _, first = np.unique(_cells(lo), return_index=True)
+    # cells never span images, so with more images than $n_keep even the coarsest grid has too many: keep a random
+    # subset of the cells' rows
+    return rows[np.sort(first)][:n_keep]
+
+
+def sample_training_inds_thinned(
+    fit_data: np.ndarray,
+    target_data: np.ndarray,
+    n_points: int,
+    img_idx: np.ndarray,
+    pix_idx: np.ndarray,
+    widths: np.ndarray,
+    diverse: bool = False,
+) -> np.ndarray:
+    """Get (shuffled) indices of a class-stratified, spatially thinned sample of labelled pixels.
+
+    Brush strokes label runs of adjacent, near-identical pixels, so a uniform sample spends most of its points on
+    redundant neighbours. Instead, each class's pixels are binned into the coarsest square grid (per image) that
+    has at most its share of $n_points occupied cells, and one random pixel is kept per cell, spreading the points
+    evenly along the strokes. If $diverse, twice as many pixels are thinned out, those with near-duplicate
+    (coarsely quantized) features dropped (see dedup.py) and a random subset kept.
+
+    :param fit_data: flat fit data arr
+    :type fit_data: np.ndarray
+    :param target_data: flat target data arr
+    :type target_data: np.ndarray
+    :param n_points: max total number of points to sample over all classes
+    :type n_points: int
+    :param img_idx: image index of each row
+    :type img_idx: np.ndarray
+    :param pix_idx: flat pixel index (in its image) of each row
+    :type pix_idx: np.ndarray
+    :param widths: width of each image
+    :type widths: np.ndarray
+    :param diverse: whether to also drop near-duplicates in feature space, defaults to False
+    :type diverse: bool, optional
+    :return: indices into $target_data of sampled points, in random order
+    :rtype: np.ndarray
+    """
+    n_total = target_data.shape[0]
+    counts = get_class_counts(target_data)
+    n_points_per_class = (n_points * counts / n_total).astype(np.intp)
+    row_widths = widths[img_idx].astype(np.int64)
+    ys, xs = pix_idx // row_widths, pix_idx % row_widths
+
+    kept: List[np.ndarray] = []
+    for c in np.flatnonzero(n_points_per_class):
+        rows = np.flatnonzero(target_data == c)
+        n_keep = int(n_points_per_class[c])
+        if not diverse:
+            kept.append(_thin_rows(rows, img_idx, ys, xs, n_keep))
+            continue
+        candidates = _thin_rows(rows, img_idx, ys, xs, DIVERSE_OVERSAMPLE * n_keep)
+        hashes = hash_rows(quantize_rows(fit_data[candidates], DIVERSE_MANTISSA_BITS))
+        _, distinct = np.unique(hashes, return_index=True)
+        candidates = candidates[distinct]
+        kept.append(np.random.permutation(candidates)[:n_keep])
+    if len(kept) == 0:
+        return np.empty((0,), dtype=np.intp)
+    return np.random.permutation(np.concatenate(kept))
+
+
+def sample_training_data_with_sampler(
+    fit_data: np.ndarray,
+    target_data: np.ndarray,
+    n_points: int,
+    sampler: SamplerName,
+    pixel_data: Tuple[np.ndarray, np.ndarray],
+    widths: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Sample up to $n_points training points with $sampler: "random" (sample_training_data()), "thinned" or
+    "diverse" (sample_training_inds_thinned()).
+
+    :param fit_data: flat fit data arr
+    :type fit_data: np.ndarray
+    :param target_data: flat target data arr
+    :type target_data: np.ndarray
+    :param n_points: total number of points to sample over all classes
+    :type n_points: int
+    :param sampler: sampler name
+    :type sampler: SamplerName
+    :param pixel_data: tuple of (image index, flat pixel index) of each row
+    :type pixel_data: Tuple[np.ndarray, np.ndarray]
+    :param widths: width of each image
+    :type widths: np.ndarray
+    :return: tuple of shuffled and sampled flat fit data and target data arrs
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    if sampler not in SAMPLERS:
+        raise Exception(f"unknown sampler {sampler}, must be one of {SAMPLERS}")
+    elif sampler == "random":
+        return sample_training_data(fit_data, target_data, n_points)
+    img_idx, pix_idx = pixel_data
+    inds = sample_training_inds_thinned(
+        fit_data, target_data, n_points, img_idx, pix_idx, widths, diverse=sampler == "diverse"
+    )
+    print(f"sampled ({sampler}) and shuffled {len(inds)} points")
+    return fit_data[inds], target_data[inds]
 
 
 def fit(
@@ -210,8 +414,367 @@ def fit(
     return model
 
 
+def fit_time_budgeted(
+    model: RandomForestClassifier,
+    train_data: np.ndarray,
+    target_data: np.ndarray,
+    weights: np.ndarray | None,
+    time_budget_ms: float,
+) -> Tuple[RandomForestClassifier, float]:
+    """Grow $model's trees in batches until $time_budget_ms of training is used up or the OOB score converges.
+
+    Trees are added BUDGET_BATCH_TREES at a time with warm_start. The OOB score is kept up to date from running
+    sums of each new tree's votes on its out-of-bag rows (see validation.py) rather than sklearn re-scoring every
+    tree each batch.
+    Training stops once the next batch (timed from the previous ones) wouldn't fit in the budget, the OOB score has
+    changed by less than BUDGET_CONVERGENCE_TOL for BUDGET_CONVERGED_BATCHES batches (after at least BUDGET_MIN_TREES
+    trees) or BUDGET_MAX_TREES is reached. At least one batch is always grown.
+
+    :param model: untrained random forest with the desired parameters (from get_model)
+    :type model: RandomForestClassifier
+    :param train_data: flat train (fit) data arr
+    :type train_data: np.ndarray
+    :param target_data: flat target data arr
+    :type target_data: np.ndarray
+    :param weights: flat weights arr
+    :type weights: np.ndarray | None
+    :param time_budget_ms: training time budget in milliseconds
+    :type time_budget_ms: float
+    :return: trained forest (with oob_score_ set) and its OOB score
+    :rtype: Tuple[RandomForestClassifier, float]
+    """
+    start_t = perf_counter()
+    budget_s = time_budget_ms / 1000
+    oob_score = model.oob_score
+    model.set_params(warm_start=True, oob_score=False, n_estimators=0)
+    oob_votes: np.ndarray | None = None
+    score, n_converged, batch_s = 0.0, 0, 0.0
+    while model.n_estimators < BUDGET_MAX_TREES:
+        batch_start_t = perf_counter()
+        n_prev = model.n_estimators
+        model.set_params(n_estimators=min(n_prev + BUDGET_BATCH_TREES, BUDGET_MAX_TREES))
+        model = fit(model, train_data, target_data, weights)
+        if oob_votes is None:
+            oob_votes = np.zeros((train_data.shape[0], len(model.classes_)), dtype=np.float64)
+        add_oob_votes(model.estimators_[n_prev:], train_data, oob_votes, model.max_samples)
+        new_score = oob_accuracy(oob_votes, model.classes_, target_data)
+
+        n_converged = n_converged + 1 if abs(new_score - score) < BUDGET_CONVERGENCE_TOL else 0
+        score = new_score
+        batch_s = perf_counter() - batch_start_t
+        elapsed_s = perf_counter() - start_t
+        if model.n_estimators >= BUDGET_MIN_TREES and n_converged >= BUDGET_CONVERGED_BATCHES:
+            break
+        if elapsed_s + batch_s > budget_s:
+            break
+    model.set_params(warm_start=False, oob_score=oob_score)
+    model.oob_score_ = score
+    print(f"grew {model.n_estimators} trees in {perf_counter() - start_t:.2f}s, OOB score {score:.4f}")
+    return model, score
+
+
+def get_predictor(model: EnsembleMethod) -> Callable[[np.ndarray], np.ndarray]:
+    """Get function mapping flat (n_pixels, n_features) arrs to (n_pixels, n_classes) class probabilities.
+
+    Random forests and binned boosters (see binning.py) are flattened (once) and run with the compiled, cache-blocked
+    engine in compiled_forest.py when numba is available (same class maps, float32 probabilities), otherwise the
+    model's own predict_proba is used. Pruned forests (see pruning.py) select their kept columns then predict
+    with their forest's predictor.
+
+    :param model: a *trained* sklearn ensemble method
+    :type model: EnsembleMethod
+    :return: prediction function
+    :rtype: Callable[[np.ndarray], np.ndarray]
+    """
+    if NUMBA_AVAILABLE and isinstance(model, RandomForestClassifier):
+        return compile_forest(model).predict_proba
+    elif NUMBA_AVAILABLE and is_binned_model(model):
+        return CompiledBooster(model).predict_proba
+    elif is_pruned_model(model):
+        forest_predictor = get_predictor(model.steps[-1][1])
+        kept = get_kept_columns(model)
+
+        def _predict_kept(flat_apply_data: np.ndarray) -> np.ndarray:
+            return forest_predictor(np.take(flat_apply_data, kept, axis=1))
+
+        return _predict_kept
+
+    def _predict_proba(flat_apply_data: np.ndarray) -> np.ndarray:
+        with parallel_backend(BACKEND, n_jobs=N_ALLOWED_CPUS):
+            return model.predict_proba(flat_apply_data)
+
+    return _predict_proba
+
+
+def get_early_exit_predictor(
+    model: EnsembleMethod, predictor: Callable[[np.ndarray], np.ndarray] | None = None
+) -> EarlyExitPredictor | None:
+    """Get early exit prediction function of random forest $model (see compiled_forest.py), None for other models.
+
+    :param model: a *trained* sklearn ensemble method
+    :type model: EnsembleMethod
+    :param predictor: prediction function of $model if already built (reusing its compiled forest), defaults to None
+    :type predictor: Callable[[np.ndarray], np.ndarray] | None, optional
+    :return: early exit predictor or None
+    :rtype: EarlyExitPredictor | None
+    """
+    if not isinstance(model, RandomForestClassifier):
+        return None
+    forest = getattr(predictor, "__self__", None)
+    if not isinstance(forest, CompiledForest):
+        forest = compile_forest(model)
+    return EarlyExitPredictor(forest)
+
+
+def predict_proba(model: EnsembleMethod, flat_apply_data: np.ndarray) -> np.ndarray:
+    """Get class probabilities of each row of $flat_apply_data, see get_predictor().
+
+    :param model: a *trained* sklearn ensemble method
+    :type model: EnsembleMethod
+    :param flat_apply_data: flat (n_pixels, n_features) arr
+    :type flat_apply_data: np.ndarray
+    :return: (n_pixels, n_classes) arr of class probabilities
+    :rtype: np.ndarray
+    """
+    return get_predictor(model)(flat_apply_data)
+
+
+def probs_to_uint8(probs: np.ndarray, class_lut: np.ndarray, axis: int = -1) -> Tuple[np.ndarray, np.ndarray]:
+    """Most likely class value and uncertainty (1 - max prob) * 255 of each pixel of $probs, both uint8.
+
+    Class indices are remapped to class values with lookup table $class_lut rather than a one-hot, and the
+    uncertainty is computed in place on the max probabilities in $probs' own dtype (float32 from the compiled
+    engines), so no (.., n_classes) float64 temporaries are made.
+
+    :param probs: arr of class probabilities, classes along $axis
+    :type probs: np.ndarray
+    :param class_lut: uint8 class value of each class index (model.classes_)
+    :type class_lut: np.ndarray
+    :param axis: class axis of $probs, defaults to -1
+    :type axis: int, optional
+    :return: tuple of uint8 class values and uint8 uncertainties, shaped as $probs without $axis
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    classes = class_lut[np.argmax(probs, axis=axis)]
+    uncertainty = np.amax(probs, axis=axis)
+    np.subtract(1, uncertainty, out=uncertainty)
+    uncertainty *= 255
+    return classes, uncertainty.astype(np.uint8)
+
+
+def predict_image_streaming(
+    predictor: Callable[[np.ndarray], np.ndarray],
+    classes: np.ndarray,
+    feature_stack: np.ndarray,
+    block_pixels: int = STREAM_BLOCK_PIXELS,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Predict an image block of rows by block of rows, writing uint8 class values and uncertainties directly.
+
+    Each block of rows is read from the (memory-mapped) $feature_stack by a prefetch thread whilst the previous
+    block is being predicted, so I/O overlaps with compute. The predictor is internally parallel, so blocks are
+    predicted one after another. Only two blocks are ever in memory alongside the (h, w) uint8 outputs, so memory
+    is constant in image size rather than a (n_pixels, n_classes) float64 arr.
+
+    :param predictor: prediction function from get_predictor()
+    :type predictor: Callable[[np.ndarray], np.ndarray]
+    :param classes: class values the predictor's columns correspond to (model.classes_)
+    :type classes: np.ndarray
+    :param feature_stack: (h, w, n_features) arr or memory map of features
+    :type feature_stack: np.ndarray
+    :param block_pixels: approx number of pixels per block, defaults to STREAM_BLOCK_PIXELS
+    :type block_pixels: int, optional
+    :return: tuple of (h, w) uint8 arr of class values and (h, w) uint8 arr of uncertainty (1 - max prob) * 255
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    h, w, feat = feature_stack.shape
+    rows_per_block = max(1, block_pixels // w)
+    class_lut = np.asarray(classes).astype(np.uint8)
+    classes_out = np.empty((h, w), dtype=np.uint8)
+    uncertainty_out = np.empty((h, w), dtype=np.uint8)
+
+    def _read_block(y0: int) -> np.ndarray:
+        return np.array(feature_stack[y0 : y0 + rows_per_block]).reshape((-1, feat))
+
+    block_starts = list(range(0, h, rows_per_block))
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        next_block = prefetcher.submit(_read_block, block_starts[0])
+        for n, y0 in enumerate(block_starts):
+            flat_block = next_block.result()
+            if n + 1 < len(block_starts):
+                next_block = prefetcher.submit(_read_block, block_starts[n + 1])
+            block_classes, block_uncertainty = probs_to_uint8(predictor(flat_block), class_lut, axis=1)
+            y1 = y0 + flat_block.shape[0] // w
+            classes_out[y0:y1] = block_classes.reshape((-1, w))
+            uncertainty_out[y0:y1] = block_uncertainty.reshape((-1, w))
+    return classes_out, uncertainty_out
+
+
+def _predicts_in_parallel(model: EnsembleMethod) -> bool:
+    """Whether $model's prediction already uses every core, in which case images are predicted one at a time."""
+    if isinstance(model, Pipeline):
+        model = model.steps[-1][1]
+    return isinstance(model, (RandomForestClassifier, HistGradientBoostingClassifier))
+
+
+def _estimate_stack_nbytes(folder_name: str, idx: int, fallback: int) -> int:
+    """Size of cached feature stack $idx read from its .npy header, or $fallback for (compressed) .npz stacks."""
+    path = get_features_path(folder_name, idx)
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r").nbytes
+    return fallback
+
+
+def pipeline_images(
+    UID: str,
+    n_imgs: int,
+    load_fn: Callable[[int], np.ndarray],
+    predict_fn: Callable[[np.ndarray], object],
+    n_workers: int = 1,
+    memory_budget: int = APPLY_MEMORY_BUDGET,
+) -> Iterator:
+    """Load and predict images 0..$n_imgs-1 with loading of later images overlapping prediction of earlier ones.
+
+    If $n_workers is 1 (the predictor is internally parallel) images are loaded by background threads and predicted
+    one at a time on this thread, otherwise up to $n_workers images are loaded *and* predicted at once. Images are
+    only submitted whilst the (estimated) feature bytes in flight fit in $memory_budget, though at least one is
+    always in flight. Results are yielded in image order as soon as each is ready.
+
+    :param UID: user ID pointing to folder where data stored
+    :type UID: str
+    :param n_imgs: number of images to loop over
+    :type n_imgs: int
+    :param load_fn: function from image index to its feature stack
+    :type load_fn: Callable[[int], np.ndarray]
+    :param predict_fn: function from feature stack to prediction result
+    :type predict_fn: Callable[[np.ndarray], object]
+    :param n_workers: number of images predicted at once, defaults to 1
+    :type n_workers: int, optional
+    :param memory_budget: max bytes of feature stacks in flight, defaults to APPLY_MEMORY_BUDGET
+    :type memory_budget: int, optional
+    :yield: result of $predict_fn for each image, in order
+    :rtype: Iterator
+    """
+    inline = n_workers <= 1
+    max_in_flight = max(n_workers, 1) + N_LOAD_WORKERS
+
+    def _task(idx: int) -> object:
+        feature_stack = load_fn(idx)
+        return feature_stack if inline else predict_fn(feature_stack)
+
+    pool = ThreadPoolExecutor(max_workers=max(n_workers, N_LOAD_WORKERS))
+    in_flight: Deque[Tuple[Future, int]] = deque()
+    in_flight_bytes, next_idx, last_nbytes = 0, 0, 0
+    try:
+        for _ in range(n_imgs):
+            while next_idx < n_imgs and len(in_flight) < max_in_flight:
+                nbytes = _estimate_stack_nbytes(UID, next_idx, last_nbytes)
+                if len(in_flight) > 0 and in_flight_bytes + nbytes > memory_budget:
+                    break
+                in_flight.append((pool.submit(_task, next_idx), nbytes))
+                in_flight_bytes += nbytes
+                last_nbytes = nbytes
+                next_idx += 1
+            future, nbytes = in_flight.popleft()
+            result = future.result()
+            if inline:
+                result = predict_fn(result)
+            in_flight_bytes -= nbytes
+            yield result
+    finally:
+        for future, _ in in_flight:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
+def _report_dedup(results: Iterator, predictor: DedupPredictor) -> Iterator:
+    """Pass through $results, printing the dedup ratio of $predictor once they are all yielded."""
+    yield from results
+    print(f"Dedup: predicted {predictor.n_predicted} of {predictor.n_rows} rows ({predictor.dedup_ratio:.3f})")
+
+
+def _report_early_exit(results: Iterator, predictor: EarlyExitPredictor) -> Iterator:
+    """Pass through $results, printing the fraction of tree evaluations $predictor saved once they are all yielded."""
+    yield from results
+    print(f"Early exit: skipped {predictor.saved_frac:.3f} of tree evaluations over {predictor.n_rows} rows")
+
+
+def _wrap_predictor(
+    model: EnsembleMethod, predictor: Callable[[np.ndarray], np.ndarray] | None, dedup: bool, early_exit: bool
+) -> Tuple[Callable[[np.ndarray], np.ndarray], Callable[[Iterator], Iterator]]:
+    """Get prediction function of $model in the requested modes, and a function adding their reports to results."""
+    if predictor is None:
+        predictor = get_predictor(model)
+    early_exit_predictor = get_early_exit_predictor(model, predictor) if early_exit else None
+    if early_exit and early_exit_predictor is None:
+        print("Early exit only applies to random forests")
+    elif early_exit_predictor is not None:
+        predictor = early_exit_predictor
+    dedup_predictor = DedupPredictor(predictor) if dedup else None
+    if dedup_predictor is not None:
+        predictor = dedup_predictor
+
+    def _report(results: Iterator) -> Iterator:
+        if early_exit_predictor is not None:
+            results = _report_early_exit(results, early_exit_predictor)
+        if dedup_predictor is not None:
+            results = _report_dedup(results, dedup_predictor)
+        return results
+
+    return predictor, _report
+
+
+def iter_apply_features_done(
+    model: EnsembleMethod,
+    UID: str,
+    n_imgs: int,
+    reorder: bool = True,
+    dedup: bool = False,
+    early_exit: bool = False,
+) -> Iterator[np.ndarray]:
+    """Pipelined apply_features_done(): yield each image's class probabilities in order as they are ready.
+
+    :param model: a *trained* sklearn ensemble method
+    :type model: EnsembleMethod
+    :param UID: user ID pointing to folder where data stroed
+    :type UID: str
+    :param n_imgs: number of images to loop over
+    :type n_imgs: int
+    :param reorder: reorder for sending to GUI, defaults to True
+    :type reorder: bool, optional
+    :param dedup: only predict distinct (quantized) feature rows, see dedup.py, defaults to False
+    :type dedup: bool, optional
+    :param early_exit: stop evaluating a forest's trees on pixels once their class is decided, see
+        compiled_forest.py, defaults to False
+    :type early_exit: bool, optional
+    :yield: arr of predictions for each image
+    :rtype: Iterator[np.ndarray]
+    """
+    predictor, report = _wrap_predictor(model, None, dedup, early_exit)
+
+    def _load(idx: int) -> np.ndarray:
+        # read in full here so page faults/decompression happen off the predicting thread
+        return np.asarray(load_features(UID, idx, mmap=False))
+
+    def _predict(feature_stack: np.ndarray) -> np.ndarray:
+        h, w, feat = feature_stack.shape
+        out_probs = predictor(feature_stack.reshape((h * w, feat)))
+        _, n_classes = out_probs.shape
+        # gui expects arr in form (n_classes, h, w)
+        if reorder:
+            return out_probs.T.reshape((n_classes, h, w))
+        return out_probs
+
+    n_workers = 1 if _predicts_in_parallel(model) else max(N_ALLOWED_CPUS, 1)
+    return report(pipeline_images(UID, n_imgs, _load, _predict, n_workers))
+
+
 def apply_features_done(
-    model: EnsembleMethod, UID: str, n_imgs: int, reorder: bool = True
+    model: EnsembleMethod,
+    UID: str,
+    n_imgs: int,
+    reorder: bool = True,
+    dedup: bool = False,
+    early_exit: bool = False,
 ) -> List[np.ndarray]:
     """Assuming feature stacks saved in folder, decompress each one, apply trained classifier and return segmentation.
 
@@ -223,24 +786,65 @@ def apply_features_done(
     :type n_imgs: int
     :param reorder: reorder for sending to GUI, defaults to True
     :type reorder: bool, optional
+    :param dedup: only predict distinct (quantized) feature rows, see dedup.py, defaults to False
+    :type dedup: bool, optional
+    :param early_exit: stop evaluating a forest's trees on decided pixels, see compiled_forest.py, defaults to False
+    :type early_exit: bool, optional
     :return: np array of predictions for all images
     :rtype: List[np.ndarray]
     """
-    out: List[np.ndarray] = []
-    for i in range(n_imgs):
-        feature_stack = np.load(f"{UID}{sep}features_{i}.npz")["a"]
-        h, w, feat = feature_stack.shape
-        flat_apply_data = feature_stack.reshape((h * w, feat))
-        with parallel_backend(BACKEND, n_jobs=N_ALLOWED_CPUS):
-            out_probs = model.predict_proba(flat_apply_data)
-        _, n_classes = out_probs.shape
-        # gui expects arr in form (n_classes, h, w)
-        if reorder:
-            out_probs_arr = out_probs.T.reshape((n_classes, h, w))
-        else:
-            out_probs_arr = out_probs
-        out.append(out_probs_arr)
-    return out
+    return list(iter_apply_features_done(model, UID, n_imgs, reorder, dedup, early_exit))
+
+
+def _touch_pages(arr: np.memmap) -> None:
+    """Read one element of every page of memory map $arr so the OS reads the whole file into its page cache."""
+    flat = arr.reshape(-1)
+    step = max(PAGESIZE // arr.itemsize, 1)
+    np.sum(flat[::step])
+
+
+def apply_features_done_streaming(
+    model: EnsembleMethod,
+    UID: str,
+    n_imgs: int,
+    predictor: Callable[[np.ndarray], np.ndarray] | None = None,
+    dedup: bool = False,
+    early_exit: bool = False,
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Like iter_apply_features_done() but streams each image in blocks, yielding uint8 class values and uncertainties.
+
+    Each stack is read ahead whilst the previous image is predicted: a memory-mapped .npy stack has every page
+    faulted into the page cache (without copying it into memory, so only a block at a time is held), and a
+    legacy .npz stack is decompressed. Reading from disk then overlaps prediction rather than stalling each block.
+
+    :param model: a *trained* sklearn ensemble method
+    :type model: EnsembleMethod
+    :param UID: user ID pointing to folder where data stroed
+    :type UID: str
+    :param n_imgs: number of images to loop over
+    :type n_imgs: int
+    :param predictor: prediction function of $model if already built (see get_predictor()), defaults to None
+    :type predictor: Callable[[np.ndarray], np.ndarray] | None, optional
+    :param dedup: only predict distinct (quantized) feature rows of each block, see dedup.py, defaults to False
+    :type dedup: bool, optional
+    :param early_exit: stop evaluating a forest's trees on decided pixels, see compiled_forest.py, defaults to False
+    :type early_exit: bool, optional
+    :yield: tuple of (h, w) uint8 class values and (h, w) uint8 uncertainties for each image
+    :rtype: Iterator[Tuple[np.ndarray, np.ndarray]]
+    """
+    predictor, report = _wrap_predictor(model, predictor, dedup, early_exit)
+
+    def _load(idx: int) -> np.ndarray:
+        feature_stack = load_features(UID, idx)
+        if isinstance(feature_stack, np.memmap):
+            _touch_pages(feature_stack)
+        return feature_stack
+
+    def _predict(feature_stack: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return predict_image_streaming(predictor, model.classes_, feature_stack)
+
+    n_workers = 1 if _predicts_in_parallel(model) else max(N_ALLOWED_CPUS, 1)
+    return report(pipeline_images(UID, n_imgs, _load, _predict, n_workers))
 
 
 def get_model(
@@ -277,11 +881,130 @@ def get_model(
         model = GradientBoostingClassifier(
             n_estimators=n_trees, max_features=n_features, max_depth=depth
         )
-    elif model_name == "LGBM_cpu":
-        model = HistGradientBoostingClassifier()
+    elif model_name == "LGBM":
+        # trained on uint8 bin codes (see binning.py), validation score on a held out 10% replaces the OOB score
+        model = HistGradientBoostingClassifier(
+            max_iter=n_trees,
+            max_depth=depth,
+            max_bins=N_BINS,
+            early_stopping=True,
+            scoring="accuracy",
+            validation_fraction=0.1,
+        )
+    else:
+        raise Exception(f"unknown model {model_name}")
     return model
 
 
+def get_score(model: EnsembleMethod) -> float:
+    """Get validation score of trained $model: OOB accuracy for forests, held out accuracy for binned boosting.
+
+    :param model: a *trained* sklearn ensemble method
+    :type model: EnsembleMethod
+    :return: accuracy score, or 0 if the model has none
+    :rtype: float
+    """
+    if isinstance(model, Pipeline):
+        model = model.steps[-1][1]
+    if isinstance(model, RandomForestClassifier) and model.oob_score:
+        return model.oob_score_
+    elif isinstance(model, HistGradientBoostingClassifier) and len(model.validation_score_) > 0:
+        return float(model.validation_score_[-1])
+    return 0
+
+
+def get_n_trees(model: EnsembleMethod) -> int:
+    """Get number of trees (forests) or boosting iterations (boosters) of trained $model.
+
+    :param model: a *trained* sklearn ensemble method
+    :type model: EnsembleMethod
+    :return: number of trees/iterations
+    :rtype: int
+    """
+    if isinstance(model, Pipeline):
+        model = model.steps[-1][1]
+    if isinstance(model, HistGradientBoostingClassifier):
+        return model.n_iter_
+    return len(model.estimators_)
+
+
+def _fit_validated(
+    model: EnsembleMethod,
+    train_data: np.ndarray,
+    target_data: np.ndarray,
+    weights: np.ndarray | None,
+    time_budget_ms: float | None,
+    validation: ValidationMode,
+    UID: str,
+) -> Tuple[EnsembleMethod, float | None]:
+    """Fit $model (within $time_budget_ms if given) and score it with validation mode $validation.
+
+    Only random forests use the validation modes (see validation.py): time-budgeted forests always have an OOB
+    score as it's needed to decide when to stop, other models use get_score().
+
+    :return: trained model and its score, or None if not (yet) computed
+    :rtype: Tuple[EnsembleMethod, float | None]
+    """
+    if not isinstance(model, RandomForestClassifier):
+        model = fit(model, train_data, target_data, weights)
+        return model, get_score(model)
+    elif time_budget_ms is not None:
+        return fit_time_budgeted(model, train_data, target_data, weights, time_budget_ms)
+
+    model.set_params(oob_score=validation == "oob")
+    if validation == "holdout":
+        train_data, target_data, weights, holdout_data, holdout_target = split_holdout(
+            train_data, target_data, weights
+        )
+        model = fit(model, train_data, target_data, weights)
+        return model, holdout_accuracy(predict_proba(model, holdout_data), model.classes_, holdout_target)
+
+    model = fit(model, train_data, target_data, weights)
+    if validation == "oob":
+        return model, model.oob_score_
+    elif validation == "deferred":
+        trees, classes, max_samples = list(model.estimators_), model.classes_, model.max_samples
+        defer_score(UID, lambda: compute_oob_score(trees, classes, max_samples, train_data, target_data))
+    return model, None
+
+
+def _prune_and_refit(
+    model: RandomForestClassifier,
+    train_data: np.ndarray,
+    target_data: np.ndarray,
+    weights: np.ndarray | None,
+    time_budget_ms: float | None,
+    validation: ValidationMode,
+    UID: str,
+    n_imgs: int,
+) -> Tuple[EnsembleMethod, float | None] | None:
+    """Prune columns of trained forest $model by importance, then refit on the kept ones (see pruning.py).
+
+    Filters with no kept columns are switched off for the user's future uploads and their columns removed from
+    the cached feature stacks of images 0..$n_imgs-1.
+
+    :return: pruned model and its score, or None if nothing could be pruned
+    :rtype: Tuple[EnsembleMethod, float | None] | None
+    """
+    feature_dict = get_session_features(UID)
+    if feature_dict is None:
+        print("No session features to prune")
+        return None
+    elif get_projection(UID) is not None:
+        print("Compressed features can't be pruned")
+        return None
+    kept, pruned_dict, surviving = prune_features(model.feature_importances_, feature_dict)
+    if kept.shape[0] == train_data.shape[1]:
+        return None
+    prune_cached_features(UID, n_imgs, surviving)
+    set_pruned_features(UID, pruned_dict)
+    forest, score = _fit_validated(
+        get_model("FRF"), train_data[:, kept], target_data, weights, time_budget_ms, validation, UID
+    )
+    print(f"Pruned to {kept.shape[0]} of {train_data.shape[1]} features, computing {surviving.shape[0]}")
+    return make_pruned_model(np.searchsorted(surviving, kept), surviving.shape[0], forest), score
+
+
 def segment_with_features(
     labels: List[np.ndarray],
     UID: str,
@@ -289,9 +1012,27 @@ def segment_with_features(
     n_points: int = 40000,
     balance_classes: bool = True,
     train_all: bool = False,
-) -> Tuple[List[np.ndarray], EnsembleMethod, float]:
+    incremental: bool = False,
+    time_budget_ms: float | None = None,
+    validation: ValidationMode = "oob",
+    superpixels: bool = False,
+    refine_boundaries: bool = False,
+    sampler: SamplerName = "random",
+    prune: bool = False,
+) -> Tuple[List[np.ndarray], EnsembleMethod, float | None]:
     """Assuming a list of feature stacks are saved at the folder, get training data, fit then apply.
 
+    If $incremental, the user's previous forest is kept and updated by replacing a fraction of its trees
+    proportional to the label change (see incremental.py), falling back to a full retrain when needed. This
+    only applies to the "FRF" model. The "LGBM" model is trained on the user's per-session feature bins
+    (see binning.py) and returned as a Pipeline that bins then predicts. If $time_budget_ms is given, full "FRF"
+    fits grow as many trees as fit in the budget (see fit_time_budgeted()) rather than a fixed 200. Random
+    forests are scored according to $validation (see validation.py). If $superpixels, an "FRF" is trained and
+    applied on the region features of each image's superpixels instead of its pixels (see superpixels.py), with
+    boundaries between predicted phases re-predicted by a per-pixel forest if $refine_boundaries. If $prune, a full
+    "FRF" fit is refit on only its most important feature columns, and unused filters are no longer computed (see
+    pruning.py).
+
     :param labels: list of label arrs
     :type labels: List[np.ndarray]
     :param UID: user ID pointing to a folder with the features
@@ -304,34 +1045,110 @@ def segment_with_features(
     :type balance_classes: bool, optional
     :param train_all: whether to train on all data, defaults to False
     :type train_all: bool, optional
-    :return: list of all segmentations (as class probabilities), the sklearn ensemble method and the out-of-bag-score
-    :rtype: Tuple[List[np.ndarray], EnsembleMethod, float]
+    :param incremental: whether to warm-start from the user's previous forest, defaults to False
+    :type incremental: bool, optional
+    :param time_budget_ms: training time budget in milliseconds for random forests, defaults to None (no budget)
+    :type time_budget_ms: float | None, optional
+    :param validation: how to score random forests: "none", "oob", "holdout" or "deferred", defaults to "oob"
+    :type validation: ValidationMode, optional
+    :param superpixels: whether to train and predict per superpixel, defaults to False
+    :type superpixels: bool, optional
+    :param refine_boundaries: whether to refine superpixel boundaries per pixel, defaults to False
+    :type refine_boundaries: bool, optional
+    :param sampler: how to sample $n_points training points, "random", "thinned" or "diverse" (see
+        sample_training_data_with_sampler()), defaults to "random"
+    :type sampler: SamplerName, optional
+    :param prune: whether to prune unimportant feature columns and refit, defaults to False
+    :type prune: bool, optional
+    :return: list of all segmentations (as class probabilities), the sklearn ensemble method and the validation score
+        (None if not computed yet)
+    :rtype: Tuple[List[np.ndarray], EnsembleMethod, float | None]
     """
-    fit_data, target_data = get_training_data_features_done(labels, UID)
+    # a pending deferred score belongs to the previous classifier: only a new deferred fit registers one again
+    clear_deferred(UID)
     model = get_model(model_name)
     weights: np.ndarray | None
     new_weights: np.ndarray | None
-    weights, class_counts = get_class_weights(target_data)
-    if train_all or target_data.shape[0] < n_points:
-        print("all")
-        sample_fit_data, sample_target_data = _shuffle_fit_target(
-            fit_data,
-            target_data,
-        )
-        new_weights = weights
-    else:
-        sample_fit_data, sample_target_data = sample_training_data(
-            fit_data, target_data, class_counts, n_points
-        )
-        new_weights, _ = get_class_weights(sample_target_data)
+    # rows persist between calls and are updated from the label diff, then copied out by (re)sampling
+    training_set = get_training_set(UID)
+    with training_set.lock:
+        n_changed = training_set.update(labels)
+        change_frac = n_changed / max(training_set.n_rows, 1)
+        fit_data, target_data = training_set.fit_data, training_set.target_data
+        weights, _ = get_class_weights(target_data)
+        if train_all or target_data.shape[0] < n_points:
+            print("all")
+            sample_fit_data, sample_target_data = _shuffle_fit_target(
+                fit_data,
+                target_data,
+            )
+            new_weights = weights
+        else:
+            widths = np.array([label.shape[1] for label in labels], dtype=np.int64)
+            sample_fit_data, sample_target_data = sample_training_data_with_sampler(
+                fit_data, target_data, n_points, sampler, training_set.pixel_data, widths
+            )
+            new_weights, _ = get_class_weights(sample_target_data)
 
     if balance_classes is False:
         new_weights = None
 
-    model = fit(model, sample_fit_data, sample_target_data, new_weights)
-    print(model.oob_score_)
-    out_data = apply_features_done(model, UID, len(labels))
-    return out_data, model, model.oob_score_
+    score: float | None
+    use_incremental = incremental and model_name == "FRF" and not superpixels
+    if not use_incremental:
+        # a kept forest would miss this fit's label changes, so updating it when incremental is next on would be stale
+        clear_incremental_forest(UID)
+    if superpixels:
+        if model_name != "FRF":
+            raise Exception("superpixel mode only supports the FRF model")
+        region_fit_data, region_target_data = _shuffle_fit_target(*get_region_training_data(UID, labels))
+        region_weights = get_class_weights(region_target_data)[0] if balance_classes else None
+        model, score = _fit_validated(
+            model, region_fit_data, region_target_data, region_weights, time_budget_ms, validation, UID
+        )
+        mark_superpixel_model(model)
+        pixel_predictor: Callable[[np.ndarray], np.ndarray] | None = None
+        if refine_boundaries:
+            pixel_model = fit(get_model(model_name), sample_fit_data, sample_target_data, new_weights)
+            # regions' majority labels can miss a class present in the pixel labels
+            if np.array_equal(pixel_model.classes_, model.classes_):
+                pixel_predictor = get_predictor(pixel_model)
+        out_data = apply_superpixels(get_predictor(model), UID, len(labels), pixel_predictor)
+    elif use_incremental:
+        forest = get_incremental_forest(UID)
+        config = (model_name, n_points, balance_classes, train_all, time_budget_ms, validation, sampler)
+        with forest.lock:
+            n_replace = forest.plan_update(model, sample_target_data, change_frac, config)
+            retired: List = []
+            added: List = []
+            if n_replace < 0:
+                model, score = _fit_validated(
+                    model, sample_fit_data, sample_target_data, new_weights, time_budget_ms, validation, UID
+                )
+                forest.set_model(model, score, config)
+            else:
+                model, retired, added = forest.replace_trees(n_replace, sample_fit_data, sample_target_data, new_weights)
+            score = forest.score
+            out_data = forest.apply(UID, len(labels), retired, added)
+    elif model_name == "LGBM":
+        binner = get_binner(UID, len(labels))
+        booster = fit(model, bin_features(binner, sample_fit_data), sample_target_data, new_weights)
+        model = make_binned_model(binner, booster)
+        score = get_score(model)
+        out_data = apply_features_done(model, UID, len(labels))
+    else:
+        model, score = _fit_validated(
+            model, sample_fit_data, sample_target_data, new_weights, time_budget_ms, validation, UID
+        )
+        if prune and isinstance(model, RandomForestClassifier):
+            pruned = _prune_and_refit(
+                model, sample_fit_data, sample_target_data, new_weights, time_budget_ms, validation, UID, len(labels)
+            )
+            if pruned is not None:
+                model, score = pruned
+        out_data = apply_features_done(model, UID, len(labels))
+    print(score)
+    return out_data, model, score
 
 
 def segment_no_features_get_arr(
@@ -352,7 +1169,7 @@ def segment_no_features_get_arr(
     model = fit(model, fit_data, target_data, None)
     h, w, feat = feature_stack.shape
     flat_apply_data = feature_stack.reshape((h * w, feat))
-    out_probs = model.predict_proba(flat_apply_data)
+    out_probs = predict_proba(model, flat_apply_data)
     _, n_classes = out_probs.shape
     out_probs = out_probs.T.reshape((n_classes, h, w))
     classes = np.argmax(out_probs, axis=0).astype(np.uint8)
@@ -0,0 +1,260 @@
+"""Incremental (warm-start) random forest updates between segment calls.
+
+Training a fresh 200 tree forest every time the user presses 'segment' is wasteful when they have only added
+a stroke or two. Instead keep each user's previous forest: if the label change is small, retire the oldest
+fraction of its trees and grow replacements on the updated training data with sklearn's warm_start. The
+fraction replaced grows with the size of the change, so interactive latency scales with the edit. A full
+retrain happens when there's no previous forest, the classes/features/settings changed, the change is large
+or after enough incremental updates in a row that the forest may have drifted.
+
+Prediction is incremental too: a forest's class probabilities are the mean of its trees' probabilities, so
+each image's probability map is kept as a running sum of per-tree votes. After an update only the retired and
+new trees are evaluated and their votes subtracted or added, rather than re-running all the trees.
+"""
+import numpy as np
+from copy import copy
+from math import ceil
+from threading import Lock
+from joblib import Parallel, delayed
+from sklearn.utils import parallel_backend
+from sklearn.ensemble import RandomForestClassifier
+from typing import Dict, List, Tuple
+
+from features import N_ALLOWED_CPUS, BACKEND
+from file_handling import get_features_signature, load_features
+from compiled_forest import CompiledForest, NUMBA_AVAILABLE
+
+# if more than this fraction of labelled pixels changed, retrain from scratch
+FULL_RETRAIN_CHANGE_FRAC = 0.2
+# fraction of trees replaced is REPLACE_SCALE * change fraction, clamped to [MIN, MAX]
+REPLACE_SCALE = 2.0
+MIN_REPLACE_FRAC = 0.05
+MAX_REPLACE_FRAC = 0.5
+# after this many incremental updates in a row, retrain from scratch
+MAX_INCREMENTAL_UPDATES = 10
+# max size of the per-image vote sums kept per user - images past this are predicted in full each time
+MAX_VOTE_CACHE_BYTES = 1024**3
+
+
+def _accumulate_tree_votes(tree, X: np.ndarray, out: np.ndarray, sign: float, lock: Lock) -> None:
+    """Add $sign * the class probabilities of $tree on $X to $out."""
+    probs = tree.predict_proba(X, check_input=False)
+    with lock:
+        out += sign * probs
+
+
+def add_tree_votes(trees: List, X: np.ndarray, out: np.ndarray, sign: float = 1) -> np.ndarray:
+    """Add (or subtract if $sign=-1) the summed class probabilities of each tree in $trees on $X to $out.
+
+    Trees are run with the compiled engine in compiled_forest.py if numba is available, otherwise they are evaluated
+    in parallel threads (tree prediction releases the GIL), like the forest's own predict_proba.
+
+    :param trees: fitted trees (i.e a subset of forest.estimators_)
+    :type trees: List
+    :param X: flat (n_pixels, n_features) float32 arr
+    :type X: np.ndarray
+    :param out: (n_pixels, n_classes) arr of running vote sums to update in place
+    :type out: np.ndarray
+    :param sign: 1 to add votes, -1 to subtract, defaults to 1
+    :type sign: float, optional
+    :return: $out
+    :rtype: np.ndarray
+    """
+    if len(trees) == 0:
+        return out
+    if NUMBA_AVAILABLE:
+        votes = CompiledForest(trees).predict_votes(X)
+        out += sign * votes
+        return out
+    lock = Lock()
+    Parallel(n_jobs=max(N_ALLOWED_CPUS, 1), prefer="threads")(
+        delayed(_accumulate_tree_votes)(tree, X, out, sign, lock) for tree in trees
+    )
+    return out
+
+
+class IncrementalForest:
+    """A user's random forest, kept between segment calls so small label edits only replace some trees."""
+
+    def __init__(self) -> None:
+        """Create empty store. Hold $lock whilst planning and applying an update."""
+        self.lock = Lock()
+        self.model: RandomForestClassifier | None = None
+        self.score: float | None = None
+        self.n_incremental_updates: int = 0
+        self._config: tuple = ()
+        # per image running sums of tree votes (n_pixels, n_classes) and signatures of the features they came from
+        self._vote_sums: Dict[int, np.ndarray] = {}
+        self._signatures: Dict[int, Tuple[int, int, int]] = {}
+
+    def plan_update(
+        self, template: RandomForestClassifier, target_data: np.ndarray, change_frac: float, config: tuple = ()
+    ) -> int:
+        """Decide how to update the forest given the fraction of labelled pixels that changed.
+
+        :param template: untrained forest with the desired parameters (from get_model)
+        :type template: RandomForestClassifier
+        :param target_data: flat target data the forest will be trained on
+        :type target_data: np.ndarray
+        :param change_frac: number of changed pixels / number of labelled pixels
+        :type change_frac: float
+        :param config: any other settings that require a retrain if changed (i.e n_points, balance), defaults to ()
+        :type config: tuple, optional
+        :return: number of trees to replace, or -1 if a full retrain is needed
+        :rtype: int
+        """
+        model = self.model
+        if model is None or not isinstance(template, RandomForestClassifier):
+            return -1
+        # n_estimators isn't compared: time-budgeted forests have a variable number of trees (the budget is in config)
+        params = ["max_features", "max_depth", "bootstrap"]
+        same_params = all(template.get_params()[p] == model.get_params()[p] for p in params)
+        same_classes = np.array_equal(np.unique(target_data), model.classes_)
+        if not same_params or not same_classes or config != self._config:
+            return -1
+        if change_frac > FULL_RETRAIN_CHANGE_FRAC or self.n_incremental_updates >= MAX_INCREMENTAL_UPDATES:
+            return -1
+        if change_frac == 0:
+            return 0
+        replace_frac = min(max(REPLACE_SCALE * change_frac, MIN_REPLACE_FRAC), MAX_REPLACE_FRAC)
+        return ceil(replace_frac * len(model.estimators_))
+
+    def set_model(self, model: RandomForestClassifier, score: float | None, config: tuple = ()) -> None:
+        """Store a (fully) retrained forest and its validation score.
+
+        :param model: trained forest
+        :type model: RandomForestClassifier
+        :param score: its validation score, None if not computed (see validation.py)
+        :type score: float | None
+        :param config: settings it was trained with, see plan_update(), defaults to ()
+        :type config: tuple, optional
+        """
+        self.model = model
+        self.score = score
+        self.n_incremental_updates = 0
+        self._config = config
+        self._vote_sums = {}
+        self._signatures = {}
+
+    def replace_trees(
+        self, n_replace: int, fit_data: np.ndarray, target_data: np.ndarray, weights: np.ndarray | None
+    ) -> Tuple[RandomForestClassifier, List, List]:
+        """Retire the $n_replace oldest trees and grow the same number on the new training data with warm_start.
+
+        Trees are kept oldest first, so repeated updates cycle through the whole forest. OOB scoring is skipped
+        here (it would cost a predict over every training sample) so $score stays that of the last full retrain.
+        The update is made on a (shallow) copy of the forest, so the previous one, which may still be being written
+        or distilled in the background (see artifacts.py), is never modified.
+
+        :param n_replace: number of trees to replace, from plan_update()
+        :type n_replace: int
+        :param fit_data: flat fit data arr
+        :type fit_data: np.ndarray
+        :param target_data: flat target data arr
+        :type target_data: np.ndarray
+        :param weights: flat weights arr
+        :type weights: np.ndarray | None
+        :return: tuple of updated forest, list of retired trees and list of new trees
+        :rtype: Tuple[RandomForestClassifier, List, List]
+        """
+        model = self.model
+        assert model is not None
+        if n_replace == 0:
+            return model, [], []
+        retired = model.estimators_[:n_replace]
+        # trees are shared, but the copy gets its own list of them and its own fitted attributes
+        model = copy(model)
+        model.estimators_ = model.estimators_[n_replace:]
+        oob_score = model.oob_score
+        model.set_params(warm_start=True, oob_score=False)
+        with parallel_backend(BACKEND, n_jobs=N_ALLOWED_CPUS):
+            model.fit(fit_data, target_data, weights)
+        model.set_params(warm_start=False, oob_score=oob_score)
+        added = model.estimators_[-n_replace:]
+        self.model = model
+        self.n_incremental_updates += 1
+        print(f"replaced {n_replace} of {len(model.estimators_)} trees")
+        return model, retired, added
+
+    def apply(self, folder_name: str, n_imgs: int, retired: List, added: List) -> List[np.ndarray]:
+        """Get class probabilities of each image, updating cached vote sums with only the retired and new trees.
+
+        Images with no (valid) cached sums are evaluated with every tree. Sums are stored in float32 and are
+        recomputed from scratch on every full retrain, so rounding drift from repeated updates is bounded.
+
+        :param folder_name: user data folder where features are cached
+        :type folder_name: str
+        :param n_imgs: number of images to loop over
+        :type n_imgs: int
+        :param retired: trees removed by the last update, from replace_trees()
+        :type retired: List
+        :param added: trees grown by the last update, from replace_trees()
+        :type added: List
+        :return: list of (n_classes, h, w) arrs of class probabilities, as in apply_features_done()
+        :rtype: List[np.ndarray]
+        """
+        model = self.model
+        assert model is not None
+        n_trees, n_classes = len(model.estimators_), len(model.classes_)
+        for i in [i for i in self._vote_sums if i >= n_imgs]:
+            self._drop_votes(i)
+        cached_bytes = sum(s.nbytes for s in self._vote_sums.values())
+
+        out: List[np.ndarray] = []
+        for i in range(n_imgs):
+            feature_stack = load_features(folder_name, i)
+            h, w, feat = feature_stack.shape
+            flat_apply_data = np.asarray(feature_stack.reshape((h * w, feat)), dtype=np.float32)
+            signature = get_features_signature(folder_name, i)
+            vote_sums = self._vote_sums.get(i)
+            if vote_sums is not None and (vote_sums.shape[0] != h * w or self._signatures[i] != signature):
+                cached_bytes -= vote_sums.nbytes
+                self._drop_votes(i)
+                vote_sums = None
+
+            if vote_sums is None:
+                vote_sums = np.zeros((h * w, n_classes), dtype=np.float32)
+                add_tree_votes(model.estimators_, flat_apply_data, vote_sums)
+                if cached_bytes + vote_sums.nbytes <= MAX_VOTE_CACHE_BYTES:
+                    self._vote_sums[i] = vote_sums
+                    self._signatures[i] = signature
+                    cached_bytes += vote_sums.nbytes
+            else:
+                add_tree_votes(added, flat_apply_data, vote_sums, 1)
+                add_tree_votes(retired, flat_apply_data, vote_sums, -1)
+            # gui expects arr in form (n_classes, h, w)
+            out.append((vote_sums / n_trees).T.reshape((n_classes, h, w)))
+        return out
+
+    def _drop_votes(self, idx: int) -> None:
+        """Forget cached vote sums of image $idx."""
+        self._vote_sums.pop(idx, None)
+        self._signatures.pop(idx, None)
+
+
+_FORESTS: Dict[str, IncrementalForest] = {}
+_REGISTRY_LOCK = Lock()
+
+
+def get_incremental_forest(UID: str) -> IncrementalForest:
+    """Get (or create) the incremental forest store of user $UID.
+
+    :param UID: user ID
+    :type UID: str
+    :return: the user's incremental forest
+    :rtype: IncrementalForest
+    """
+    with _REGISTRY_LOCK:
+        if UID not in _FORESTS:
+            _FORESTS[UID] = IncrementalForest()
+        return _FORESTS[UID]
+
+
+def clear_incremental_forest(UID: str) -> None:
+    """Forget forest of user $UID.
+
+    :param UID: user ID
+    :type UID: str
+    """
+    with _REGISTRY_LOCK:
+        _FORESTS.pop(UID, None)
@@ -0,0 +1,401 @@
+"""In-memory registry of trained/loaded classifiers.
+
+Loading a classifier.skops unzips and rebuilds every tree of the forest, and flattening it for the compiled
+predictor costs about the same again, so doing both on every apply request (i.e whilst uploading more slices of
+a stack) is wasteful. The registry keeps each user's latest classifier (and its predictor, once built) in memory,
+keyed by UID and version, where the version is the signature of the classifier file it was saved to/loaded from.
+A stale version (the file was replaced) or a miss falls back to loading from disk.
+
+Serialization is off the critical path: a newly trained classifier is registered 'dirty' (not yet on disk) rather
+than being pickled and zipped before /segmenting responds, and its write to the user folder is queued on the
+background artifact worker (see artifacts.py), so it's on disk to apply after a restart. The encoded bytes are
+cached for downloads until the next retrain replaces the entry. Evicted entries are written back on the same
+worker, and a miss waits for a pending write before loading from disk.
+
+Registered models are owned by the registry: they must never be modified after put() (i.e an incremental update
+grows a copy of the forest, see incremental.py), as the background write encodes them without holding a lock
+callers could respect. This is enforced when writing: the trees of the model and student are fingerprinted when
+registered and the write fails, rather than saving a torn classifier, if they've changed.
+
+An entry can also hold a distilled student of the classifier (see distill.py), saved alongside it as
+classifier_distilled.{pkl,skops} and used instead of it for applying.
+
+Entries are evicted least recently used first once their total (estimated) size exceeds MAX_REGISTRY_BYTES.
+"""
+import numpy as np
+import os
+from collections import OrderedDict
+from io import BytesIO
+from pickle import dumps
+from threading import Lock
+from zipfile import ZIP_DEFLATED
+from skops.io import dump as skdump
+from sklearn.pipeline import Pipeline
+from sklearn.ensemble import RandomForestClassifier, HistGradientBoostingClassifier
+from typing import Callable, Dict, List, Tuple
+
+from test_resources.call_weka import sep
+from file_handling import get_file_signature
+from artifacts import queue_artifact, wait_for_artifacts
+
+MAX_REGISTRY_BYTES = 1024**3
+CLASSIFIER_FORMATS = [".pkl", ".skops"]
+
+Version = Tuple[int, int, int]
+
+
+def estimate_model_nbytes(model: object) -> int:
+    """Estimate the in-memory size of (trained) $model from its trees' node and value arrays.
+
+    :param model: a trained sklearn ensemble method
+    :type model: object
+    :return: approx size in bytes
+    :rtype: int
+    """
+    if isinstance(model, Pipeline):
+        return sum(estimate_model_nbytes(step) for _, step in model.steps)
+    elif isinstance(model, RandomForestClassifier):
+        total = 0
+        for tree in model.estimators_:
+            state = tree.tree_.__getstate__()
+            total += state["nodes"].nbytes + state["values"].nbytes
+        return total
+    elif isinstance(model, HistGradientBoostingClassifier):
+        return sum(predictor.nodes.nbytes for iteration in model._predictors for predictor in iteration)
+    return sum(v.nbytes for v in vars(model).values() if isinstance(v, np.ndarray))
+
+
+def encode_model(model: object, file_format: str) -> bytes:
+    """Serialize $model in $file_format, either ".pkl" (pickle) or ".skops" (zip deflated skops).
+
+    :param model: trained classifier
+    :type model: object
+    :param file_format: ".pkl" or ".skops"
+    :type file_format: str
+    :return: encoded model
+    :rtype: bytes
+    """
+    if file_format == ".pkl":
+        return dumps(model)
+    elif file_format == ".skops":
+        buffer = BytesIO()
+        skdump(model, buffer, compression=ZIP_DEFLATED, compresslevel=9)
+        return buffer.getvalue()
+    raise Exception(f"classifier format must be one of {CLASSIFIER_FORMATS}")
+
+
+def _get_version(folder_name: str) -> Version | None:
+    """Signature of the classifier.skops file in user folder $folder_name, None if there is none."""
+    path = get_classifier_path(folder_name)
+    return get_file_signature(path) if os.path.exists(path) else None
+
+
+def get_classifier_path(folder_name: str, file_format: str = ".skops", distilled: bool = False) -> str:
+    """Get path of classifier (or its $distilled student) file in $file_format in user folder $folder_name."""
+    name = "classifier_distilled" if distilled else "classifier"
+    return f"{folder_name}{sep}{name}{file_format}"
+
+
+def _fingerprint(model: object | None) -> Tuple[int, ...]:
+    """Identities of the trees (or boosting predictors) of $model, which change if it's refit or updated in place."""
+    if isinstance(model, Pipeline):
+        return _fingerprint(model.steps[-1][1])
+    trees = getattr(model, "estimators_", None)
+    if trees is None:
+        trees = getattr(model, "_predictors", [])
+    return tuple(id(tree) for tree in trees)
+
+
+def _check_unmodified(model: object, distilled: object | None, fingerprint: Tuple) -> None:
+    """Raise if $model or its $distilled student no longer have the $fingerprint they were registered with."""
+    if (_fingerprint(model), _fingerprint(distilled)) != fingerprint:
+        raise Exception("classifier was modified after it was registered")
+
+
+class RegistryEntry:
+    """A registered classifier, its version, distilled student, (lazily built) predictor and (lazily) encoded bytes."""
+
+    def __init__(
+        self,
+        model: object,
+        folder_name: str,
+        version: Version | None,
+        encoded: Dict[str, bytes] | None = None,
+        distilled: object | None = None,
+        token: int = 0,
+    ) -> None:
+        """Wrap $model.
+
+        :param model: trained classifier
+        :type model: object
+        :param folder_name: user data folder the classifier is (to be) saved in
+        :type folder_name: str
+        :param version: signature of the file the model is stored in, None if not yet saved (dirty)
+        :type version: Version | None
+        :param encoded: already encoded bytes of the model per format, defaults to None
+        :type encoded: Dict[str, bytes] | None, optional
+        :param distilled: distilled student of the model, defaults to None
+        :type distilled: object | None, optional
+        :param token: number identifying this registration, increasing with each put(), defaults to 0
+        :type token: int, optional
+        """
+        self.model = model
+        self.token = token
+        self.distilled = distilled
+        self.folder_name = folder_name
+        self.version = version
+        self.predictor: Callable[[np.ndarray], np.ndarray] | None = None
+        self.encoded: Dict[str, bytes] = {} if encoded is None else encoded
+        self.lock = Lock()
+        self.fingerprint = (_fingerprint(model), _fingerprint(distilled))
+        self.model_nbytes = estimate_model_nbytes(model)
+        if distilled is not None:
+            self.model_nbytes += estimate_model_nbytes(distilled)
+
+    @property
+    def dirty(self) -> bool:
+        """Whether the model differs from (or is missing from) the classifier files on disk."""
+        return self.version is None
+
+    @property
+    def nbytes(self) -> int:
+        """Estimated size of model and cached encodings."""
+        return self.model_nbytes + sum(len(b) for b in self.encoded.values())
+
+    def encode(self, file_format: str, distilled: bool = False) -> bytes:
+        """Get model (or its $distilled student) encoded in $file_format, encoding (and caching) it if needed.
+
+        :param file_format: ".pkl" or ".skops"
+        :type file_format: str
+        :param distilled: whether to encode the distilled student, defaults to False
+        :type distilled: bool, optional
+        :return: encoded model
+        :rtype: bytes
+        """
+        key = f"distilled{file_format}" if distilled else file_format
+        with self.lock:
+            if key not in self.encoded:
+                model = self.distilled if distilled else self.model
+                if model is None:
+                    raise Exception("classifier has no distilled model")
+                data = encode_model(model, file_format)
+                _check_unmodified(self.model, self.distilled, self.fingerprint)
+                self.encoded[key] = data
+            return self.encoded[key]
+
+    def write(self) -> None:
+        """Write the model (and student) to the classifier files (atomically via temp files) if it's dirty.
+
+        :raises Exception: if the model or student was modified after being registered, without writing it
+        """
+        if not self.dirty or not os.path.isdir(self.folder_name):
+            return
+        # consistent model and student pair, as a student can be attached whilst writing
+        with self.lock:
+            model, student, fingerprint = self.model, self.distilled, self.fingerprint
+        _check_unmodified(model, student, fingerprint)
+        # student written first so the classifier's version never pairs with a stale student
+        for distilled in (True, False):
+            for file_format in CLASSIFIER_FORMATS:
+                path = get_classifier_path(self.folder_name, file_format, distilled)
+                if distilled and student is None:
+                    if os.path.exists(path):
+                        os.remove(path)
+                    continue
+                key = f"distilled{file_format}" if distilled else file_format
+                # not cached, so written entries don't hold both the model and its encodings in memory
+                data = self.encoded.get(key) or encode_model(student if distilled else model, file_format)
+                # i.e modified whilst being encoded
+                _check_unmodified(model, student, fingerprint)
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+        self.version = get_file_signature(get_classifier_path(self.folder_name))
+
+
+class ModelRegistry:
+    """Byte-size aware LRU cache of classifiers keyed by UID, each with a version."""
+
+    def __init__(self, max_bytes: int = MAX_REGISTRY_BYTES) -> None:
+        """Create empty registry holding at most (approx) $max_bytes of models.
+
+        :param max_bytes: max total estimated size of held models, defaults to MAX_REGISTRY_BYTES
+        :type max_bytes: int, optional
+        """
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, RegistryEntry] = OrderedDict()
+        self._lock = Lock()
+        self._last_token = 0
+
+    @property
+    def nbytes(self) -> int:
+        """Total estimated size of held models and their cached encodings."""
+        with self._lock:
+            return sum(entry.nbytes for entry in self._entries.values())
+
+    def put(
+        self,
+        UID: str,
+        model: object,
+        folder_name: str,
+        version: Version | None = None,
+        encoded: Dict[str, bytes] | None = None,
+        distilled: object | None = None,
+    ) -> RegistryEntry:
+        """Register $model as user $UID's classifier, replacing any previous one (and its cached encodings).
+
+        :param UID: user ID
+        :type UID: str
+        :param model: trained classifier
+        :type model: object
+        :param folder_name: user data folder the classifier is (to be) saved in
+        :type folder_name: str
+        :param version: signature of the file the model was loaded from, defaults to None (dirty, not saved yet)
+        :type version: Version | None, optional
+        :param encoded: already encoded bytes of the model per format, defaults to None
+        :type encoded: Dict[str, bytes] | None, optional
+        :param distilled: distilled student of the classifier, defaults to None
+        :type distilled: object | None, optional
+        :return: the new entry
+        :rtype: RegistryEntry
+        """
+        with self._lock:
+            self._last_token += 1
+            entry = RegistryEntry(model, folder_name, version, encoded, distilled, self._last_token)
+            self._entries.pop(UID, None)
+            self._entries[UID] = entry
+        if entry.dirty:
+            queue_artifact(UID, "classifier", entry.write)
+        self._evict(keep=UID)
+        return entry
+
+    def get(self, UID: str, version: Version | None) -> RegistryEntry | None:
+        """Get user $UID's entry if it's dirty (newer than disk) or has $version, marking it most recently used.
+
+        :param UID: user ID
+        :type UID: str
+        :param version: signature of the classifier file currently on disk, None if there is none
+        :type version: Version | None
+        :return: the entry, or None on a miss or if it's stale
+        :rtype: RegistryEntry | None
+        """
+        with self._lock:
+            entry = self._entries.get(UID)
+            if entry is None:
+                return None
+            elif not entry.dirty and entry.version != version:
+                del self._entries[UID]
+                return None
+            self._entries.move_to_end(UID)
+            return entry
+
+    def get_or_load(self, UID: str, folder_name: str, load_fn: Callable[[str], object]) -> RegistryEntry:
+        """Get user $UID's classifier, calling $load_fn on the classifier.skops path on a miss and registering it
+        (along with its distilled student, if saved).
+
+        :param UID: user ID
+        :type UID: str
+        :param folder_name: user data folder the classifier is saved in
+        :type folder_name: str
+        :param load_fn: function loading the classifier from the given path
+        :type load_fn: Callable[[str], object]
+        :return: the (possibly new) entry
+        :rtype: RegistryEntry
+        """
+        entry = self.get(UID, _get_version(folder_name))
+        if entry is None:
+            # it may have been evicted whilst its write is still queued
+            wait_for_artifacts(UID, ["classifier"])
+            version = _get_version(folder_name)
+            if version is None:
+                raise Exception("no classifier to apply")
+            distilled_path = get_classifier_path(folder_name, distilled=True)
+            distilled = load_fn(distilled_path) if os.path.exists(distilled_path) else None
+            entry = self.put(UID, load_fn(get_classifier_path(folder_name)), folder_name, version, distilled=distilled)
+        return entry
+
+    def attach_distilled(self, UID: str, token: int, distilled: object) -> bool:
+        """Attach $distilled student to user $UID's classifier, if it's still the one registered with $token (not
+        retrained or updated since), and queue writing it alongside the classifier.
+
+        :param UID: user ID
+        :type UID: str
+        :param token: token of the entry of the classifier the student was distilled from
+        :type token: int
+        :param distilled: distilled student
+        :type distilled: object
+        :return: whether it was attached
+        :rtype: bool
+        """
+        with self._lock:
+            entry = self._entries.get(UID)
+            if entry is None or entry.token != token:
+                return False
+            with entry.lock:
+                entry.distilled = distilled
+                entry.fingerprint = (entry.fingerprint[0], _fingerprint(distilled))
+                entry.model_nbytes += estimate_model_nbytes(distilled)
+                # so the next apply builds the student's predictor
+                entry.predictor = None
+                # the files on disk lack the student
+                entry.version = None
+        queue_artifact(UID, "classifier", entry.write)
+        self._evict(keep=UID)
+        return True
+
+    def get_bytes(self, UID: str, folder_name: str, file_format: str, distilled: bool = False) -> bytes:
+        """Get user $UID's classifier (or its $distilled student) encoded in $file_format, from the (cached) registry
+        entry or from disk.
+
+        :param UID: user ID
+        :type UID: str
+        :param folder_name: user data folder the classifier is saved in
+        :type folder_name: str
+        :param file_format: ".pkl" or ".skops"
+        :type file_format: str
+        :param distilled: whether to get the distilled student, defaults to False
+        :type distilled: bool, optional
+        :return: encoded classifier
+        :rtype: bytes
+        """
+        entry = self.get(UID, _get_version(folder_name))
+        if entry is not None:
+            data = entry.encode(file_format, distilled)
+            self._evict(keep=UID)
+            return data
+        wait_for_artifacts(UID, ["classifier"])
+        file_path = get_classifier_path(folder_name, file_format, distilled)
+        if distilled and not os.path.exists(file_path):
+            raise Exception("classifier has no distilled model")
+        with open(file_path, "rb") as f:
+            return f.read()
+
+    def forget(self, UID: str) -> None:
+        """Drop user $UID's entry without saving it (i.e when their data folder is deleted).
+
+        :param UID: user ID
+        :type UID: str
+        """
+        with self._lock:
+            self._entries.pop(UID, None)
+
+    def _evict(self, keep: str) -> None:
+        """Drop least recently used entries (other than $keep) until under max_bytes, queueing write back of dirty
+        ones."""
+        evicted: List[Tuple[str, RegistryEntry]] = []
+        with self._lock:
+            total = sum(entry.nbytes for entry in self._entries.values())
+            for UID in list(self._entries.keys()):
+                if total <= self.max_bytes:
+                    break
+                if UID != keep:
+                    entry = self._entries.pop(UID)
+                    total -= entry.nbytes
+                    evicted.append((UID, entry))
+        for UID, entry in evicted:
+            if entry.dirty:
+                queue_artifact(UID, "classifier", entry.write)
+
+
+MODEL_REGISTRY = ModelRegistry()
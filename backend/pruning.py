@@ -0,0 +1,322 @@
+"""Feature-importance-driven pruning of the feature stack.
+
+A trained random forest's feature_importances_ show most of the N feature columns barely contribute, yet every
+apply reads and predicts on all of them and every new upload computes all of them. When pruning is requested,
+columns with importance below PRUNE_IMPORTANCE_FRAC of the mean are dropped and the forest is refit on the rest.
+Filters (i.e "Hessian") and sigmas at the ends of the range all of whose columns were dropped are switched off in
+the user's session feature dict, so they're no longer computed for subsequently uploaded images, and the cached
+feature stacks are rewritten without their columns. The refit forest goes in a Pipeline behind a column selector of
+the surviving stack's kept columns, so it predicts directly on the (reduced) cached stacks. The session's feature
+dicts are saved in the user folder, so pruning survives a restart. Downloaded classifiers are rebuilt against the
+requested features' layout (see export_model()), as that's what apply_classifier.py computes.
+
+Which columns each filter and sigma produces depends on the rest of the feature dict, so it's found by featurising
+a small random probe image with and without them.
+"""
+import numpy as np
+from threading import Lock
+from sklearn.compose import ColumnTransformer
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.pipeline import Pipeline
+from typing import Dict, Iterator, List, Tuple
+
+from features import multiscale_advanced_features
+from file_handling import load_features, save_features, save_session_features, load_session_features
+from superpixels import is_superpixel_model, mark_superpixel_model
+
+# columns with importance below this fraction of the mean importance are dropped
+PRUNE_IMPORTANCE_FRAC = 0.5
+# always keep at least this many of the most important columns
+MIN_KEPT_FEATURES = 4
+PROBE_SIZE = 64
+# switchable filters of a feature dict (the rest of its keys are parameters)
+FILTERS: List[str] = [
+    "Gaussian Blur",
+    "Sobel Filter",
+    "Hessian",
+    "Difference of Gaussians",
+    "Membrane Projections",
+    "Mean",
+    "Minimum",
+    "Maximum",
+    "Median",
+    "Bilateral",
+    "Derivatives",
+    "Structure",
+    "Entropy",
+    "Neighbours",
+]
+
+
+def _probe_key(feature_dict: dict) -> Tuple:
+    """Hashable key of $feature_dict."""
+    return tuple(sorted((k, float(v)) for k, v in feature_dict.items()))
+
+
+_PROBE_CACHE: Dict[Tuple, np.ndarray | None] = {}
+_CACHE_LOCK = Lock()
+
+
+def _probe_stack(feature_dict: dict) -> np.ndarray | None:
+    """Features of a fixed random probe image with $feature_dict as (n_features, n_pixels), None if invalid."""
+    key = _probe_key(feature_dict)
+    with _CACHE_LOCK:
+        if key in _PROBE_CACHE:
+            return _PROBE_CACHE[key]
+    rng = np.random.default_rng(0)
+    probe = rng.integers(0, 256, (PROBE_SIZE, PROBE_SIZE)).astype(np.uint8)
+    stack: np.ndarray | None
+    try:
+        stack = multiscale_advanced_features(probe, feature_dict, 1)
+        stack = stack.reshape((-1, stack.shape[-1])).T
+    except Exception:
+        # i.e difference of gaussians with no singlescale filters
+        stack = None
+    with _CACHE_LOCK:
+        _PROBE_CACHE[key] = stack
+    return stack
+
+
+def computed_columns(feature_dict: dict, candidate: dict) -> np.ndarray | None:
+    """Get the columns of the feature stack of $feature_dict that featurising with $candidate computes.
+
+    Columns are matched by featurising a small random probe image with both, so this finds which columns a filter
+    or sigma produces without mirroring the layout logic of features.py.
+
+    :param feature_dict: feature dict of the full stack, in the format of features.DEAFAULT_FEATURES
+    :type feature_dict: dict
+    :param candidate: feature dict to compute instead
+    :type candidate: dict
+    :return: increasing column indices, or None if $candidate computes any column not in (or out of order with)
+        the full stack
+    :rtype: np.ndarray | None
+    """
+    full, reduced = _probe_stack(feature_dict), _probe_stack(candidate)
+    if full is None or reduced is None or reduced.shape[0] == 0:
+        return None
+    index: Dict[bytes, int] = {}
+    for j, col in enumerate(full):
+        index.setdefault(col.tobytes(), j)
+    cols = np.array([index.get(col.tobytes(), -1) for col in reduced], dtype=np.intp)
+    if np.any(cols < 0) or np.any(np.diff(cols) <= 0):
+        return None
+    return cols
+
+
+def _candidates(feature_dict: dict) -> Iterator[dict]:
+    """Feature dicts computing less than $feature_dict: each enabled filter switched off, then narrower sigmas."""
+    for name in FILTERS:
+        if int(feature_dict.get(name, 0)) == 1:
+            yield {**feature_dict, name: 0}
+    sigma_min, sigma_max = float(feature_dict["Minimum Sigma"]), float(feature_dict["Maximum Sigma"])
+    # -1 is the 0.5 scale and 0 the (weka) 0 scale, both followed by 1
+    raised_min = 1 if sigma_min <= 0 else 2 * sigma_min
+    if raised_min <= sigma_max:
+        yield {**feature_dict, "Minimum Sigma": raised_min}
+    if sigma_max / 2 >= max(sigma_min, 1):
+        yield {**feature_dict, "Maximum Sigma": sigma_max / 2}
+
+
+def prune_features(importances: np.ndarray, feature_dict: dict) -> Tuple[np.ndarray, dict, np.ndarray]:
+    """Pick columns to keep from their $importances, and the least features that still compute all of them.
+
+    Filters are greedily switched off and the sigma range narrowed whilst the kept columns are still computed.
+
+    :param importances: importance of each column (forest.feature_importances_)
+    :type importances: np.ndarray
+    :param feature_dict: feature dict the stack was computed with
+    :type feature_dict: dict
+    :return: tuple of kept columns, pruned feature dict and the columns of the current stack it computes, which
+        always include the kept columns
+    :rtype: Tuple[np.ndarray, dict, np.ndarray]
+    """
+    keep = importances >= PRUNE_IMPORTANCE_FRAC * np.mean(importances)
+    keep[np.argsort(importances)[::-1][:MIN_KEPT_FEATURES]] = True
+    kept = np.flatnonzero(keep)
+
+    pruned_dict, surviving = dict(feature_dict), np.arange(importances.shape[0])
+    pruning = True
+    while pruning:
+        pruning = False
+        for candidate in _candidates(pruned_dict):
+            cols = computed_columns(feature_dict, candidate)
+            if cols is not None and np.all(np.isin(kept, cols)):
+                pruned_dict, surviving, pruning = candidate, cols, True
+                break
+    return kept, pruned_dict, surviving
+
+
+def prune_cached_features(folder_name: str, n_imgs: int, surviving: np.ndarray) -> None:
+    """Rewrite cached feature stacks 0..$n_imgs-1 with only their $surviving columns.
+
+    :param folder_name: user data folder where features are cached
+    :type folder_name: str
+    :param n_imgs: number of images
+    :type n_imgs: int
+    :param surviving: columns to keep
+    :type surviving: np.ndarray
+    """
+    for i in range(n_imgs):
+        feature_stack = load_features(folder_name, i, mmap=False)
+        if feature_stack.shape[-1] > surviving.shape[0]:
+            save_features(folder_name, i, feature_stack[:, :, surviving])
+
+
+def make_pruned_model(kept: np.ndarray, n_features: int, forest: RandomForestClassifier) -> Pipeline:
+    """Put a forest trained on columns $kept of $n_features column stacks behind a selector of those columns.
+
+    :param kept: columns of the stack the forest was trained on
+    :type kept: np.ndarray
+    :param n_features: number of columns of the stack
+    :type n_features: int
+    :param forest: trained forest
+    :type forest: RandomForestClassifier
+    :return: pipeline of column selector then forest
+    :rtype: Pipeline
+    """
+    selector = ColumnTransformer([("kept", "passthrough", kept.tolist())])
+    selector.fit(np.zeros((1, n_features), dtype=np.float32))
+    return Pipeline([("prune", selector), ("model", forest)])
+
+
+def is_pruned_model(model: object) -> bool:
+    """Whether $model is a forest behind a column selector, from make_pruned_model().
+
+    :param model: any (trained) model
+    :type model: object
+    :return: true if pruned forest
+    :rtype: bool
+    """
+    if not isinstance(model, Pipeline) or len(model.steps) != 2:
+        return False
+    return isinstance(model.steps[0][1], ColumnTransformer)
+
+
+def get_kept_columns(model: Pipeline) -> np.ndarray:
+    """Columns of the feature stack that pruned $model predicts on.
+
+    :param model: pruned forest, from make_pruned_model()
+    :type model: Pipeline
+    :return: column indices
+    :rtype: np.ndarray
+    """
+    return np.array(model.steps[0][1].transformers_[0][2], dtype=np.intp)
+
+
+class SessionFeatures:
+    """The feature dict a user requested, and the (possibly pruned) one actually computed for them."""
+
+    def __init__(self, requested: dict) -> None:
+        """Store $requested as both requested and computed.
+
+        :param requested: feature dict sent by the user
+        :type requested: dict
+        """
+        self.requested = requested
+        self.computed = requested
+
+
+_SESSION_FEATURES: Dict[str, SessionFeatures] = {}
+_REGISTRY_LOCK = Lock()
+
+
+def _get_session(UID: str) -> SessionFeatures | None:
+    """Get user $UID's session features, loading them from their folder after a restart. Call with the lock held."""
+    session = _SESSION_FEATURES.get(UID)
+    if session is None:
+        saved = load_session_features(UID)
+        if saved is not None:
+            session = SessionFeatures(saved[0])
+            session.computed = saved[1]
+            _SESSION_FEATURES[UID] = session
+    return session
+
+
+def get_features_to_compute(UID: str, requested: dict) -> dict:
+    """Get the feature dict to featurise user $UID's images with: the pruned one if they haven't changed their
+    requested features since it was pruned, otherwise $requested.
+
+    :param UID: user ID
+    :type UID: str
+    :param requested: feature dict sent by the user
+    :type requested: dict
+    :return: feature dict to compute
+    :rtype: dict
+    """
+    with _REGISTRY_LOCK:
+        session = _get_session(UID)
+        if session is None or session.requested != requested:
+            session = SessionFeatures(requested)
+            _SESSION_FEATURES[UID] = session
+            save_session_features(UID, session.requested, session.computed)
+        return session.computed
+
+
+def get_session_features(UID: str) -> dict | None:
+    """Get the feature dict user $UID's cached stacks were computed with, or None if they haven't featurised.
+
+    :param UID: user ID
+    :type UID: str
+    :return: feature dict
+    :rtype: dict | None
+    """
+    with _REGISTRY_LOCK:
+        session = _get_session(UID)
+        return None if session is None else session.computed
+
+
+def set_pruned_features(UID: str, pruned: dict) -> None:
+    """Compute $pruned features (instead of the requested ones) for user $UID's future uploads.
+
+    :param UID: user ID
+    :type UID: str
+    :param pruned: pruned feature dict, from prune_features()
+    :type pruned: dict
+    """
+    with _REGISTRY_LOCK:
+        session = _get_session(UID)
+        if session is not None:
+            session.computed = pruned
+            save_session_features(UID, session.requested, session.computed)
+
+
+def export_model(UID: str, model: object) -> object:
+    """Rebuild $model, trained on user $UID's (possibly pruned) cached stacks, to predict on stacks of the features
+    they requested, i.e for downloading to use with apply_classifier.py.
+
+    :param UID: user ID
+    :type UID: str
+    :param model: trained classifier (or distilled student) of the user
+    :type model: object
+    :raises Exception: if the pruned stack's columns can't be found in the requested stack
+    :return: $model if their features weren't pruned, otherwise a column selector (of the requested stack) then
+        its forest
+    :rtype: object
+    """
+    with _REGISTRY_LOCK:
+        session = _get_session(UID)
+    if session is None or session.computed == session.requested:
+        return model
+    cols = computed_columns(session.requested, session.computed)
+    requested_stack = _probe_stack(session.requested)
+    if cols is None or requested_stack is None:
+        raise Exception("pruned classifier can't be exported")
+    n_features = requested_stack.shape[0]
+    if is_superpixel_model(model):
+        # region features are each feature's means then standard deviations
+        cols, n_features = np.concatenate((cols, cols + n_features)), 2 * n_features
+    if is_pruned_model(model):
+        exported = make_pruned_model(cols[get_kept_columns(model)], n_features, model.steps[-1][1])
+    else:
+        exported = make_pruned_model(cols, n_features, model)
+    return mark_superpixel_model(exported) if is_superpixel_model(model) else exported
+
+
+def clear_session_features(UID: str) -> None:
+    """Forget feature dicts of user $UID.
+
+    :param UID: user ID
+    :type UID: str
+    """
+    with _REGISTRY_LOCK:
+        _SESSION_FEATURES.pop(UID, None)
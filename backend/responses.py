@@ -0,0 +1,136 @@
+"""Preallocated response body of /segmenting.
+
+The body is every image's flattened uint8 uncertainties followed by every image's flattened uint8 class values.
+It used to be built by concatenating each image onto a growing array (O(N^2) copying for N images, twice) and then
+joining the two arrays' bytes. Instead one buffer of the final length is allocated up front from the image
+dimensions and each image's results are written into their slices as they're ready. The buffer is then sent in
+RESPONSE_CHUNK_BYTES chunks, as WSGI servers only accept bytes (not views of an arr), so it's never copied whole.
+
+Applying to a stack can instead be streamed (the "stream" key of /segmenting), so the GUI can show each image as soon
+as it's predicted rather than after the whole stack. The body is then a sequence of frames, one per image in the
+order they finish: a FRAME_HEADER of little-endian uint32 image index, height and width, followed by the image's
+h * w uint8 uncertainties then its h * w uint8 class values. The stream always ends with a header whose index is
+END_FRAME (and height and width 0), or ERROR_FRAME if prediction failed part way, with width the length of the
+UTF-8 error message that follows it. A body without either was truncated.
+"""
+import numpy as np
+import struct
+from typing import Iterator, List, Tuple
+
+RESPONSE_CHUNK_BYTES = 1 << 20
+# image index, height, width
+FRAME_HEADER = struct.Struct("<III")
+# image indices of the frames ending a stream
+END_FRAME = 0xFFFFFFFF
+ERROR_FRAME = 0xFFFFFFFE
+
+
+class ResponseBuffer:
+    """Flat uint8 uncertainties then class values of every image of a request, in one preallocated arr."""
+
+    def __init__(self, img_dims: List[Tuple[int, int]]) -> None:
+        """Allocate the buffer for images of $img_dims.
+
+        :param img_dims: (h, w) of each image
+        :type img_dims: List[Tuple[int, int]]
+        """
+        self.img_dims = img_dims
+        self.offsets = np.cumsum([0] + [h * w for h, w in img_dims])
+        self.n_pixels = int(self.offsets[-1])
+        self.buffer = np.empty(2 * self.n_pixels, dtype=np.uint8)
+
+    @property
+    def uncertainties(self) -> np.ndarray:
+        """Flat uint8 uncertainties of every image (a view of the buffer)."""
+        return self.buffer[: self.n_pixels]
+
+    @property
+    def classes(self) -> np.ndarray:
+        """Flat uint8 class values of every image (a view of the buffer)."""
+        return self.buffer[self.n_pixels :]
+
+    @property
+    def nbytes(self) -> int:
+        """Length of the response body."""
+        return self.buffer.shape[0]
+
+    def write(self, i: int, classes: np.ndarray, uncertainties: np.ndarray) -> np.ndarray:
+        """Write image $i's (h, w) class values and uncertainties into their slices of the buffer.
+
+        :param i: image index
+        :type i: int
+        :param classes: (h, w) arr of class values
+        :type classes: np.ndarray
+        :param uncertainties: (h, w) arr of uncertainties
+        :type uncertainties: np.ndarray
+        :return: (h, w) view of the image's class values in the buffer
+        :rtype: np.ndarray
+        """
+        h, w = self.img_dims[i]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        self.uncertainties[start:end].reshape((h, w))[:] = uncertainties
+        class_view = self.classes[start:end].reshape((h, w))
+        class_view[:] = classes
+        return class_view
+
+    def chunks(self, chunk_bytes: int = RESPONSE_CHUNK_BYTES) -> Iterator[bytes]:
+        """Yield the response body in chunks of $chunk_bytes.
+
+        :param chunk_bytes: bytes per chunk, defaults to RESPONSE_CHUNK_BYTES
+        :type chunk_bytes: int, optional
+        :yield: bytes of the next chunk of the buffer
+        :rtype: Iterator[bytes]
+        """
+        view = memoryview(self.buffer)
+        for start in range(0, self.nbytes, chunk_bytes):
+            yield view[start : start + chunk_bytes].tobytes()
+
+
+def encode_frames(results: Iterator[Tuple[int, np.ndarray, np.ndarray]]) -> Iterator[bytes]:
+    """Yield the frames of streamed $results: each image's header, uncertainties then class values, then an end
+    frame, or an error frame if $results raises.
+
+    :param results: iterator of (image index, (h, w) uint8 class values, (h, w) uint8 uncertainties)
+    :type results: Iterator[Tuple[int, np.ndarray, np.ndarray]]
+    :yield: bytes of the next part of a frame
+    :rtype: Iterator[bytes]
+    """
+    try:
+        for i, classes, uncertainties in results:
+            h, w = classes.shape
+            yield FRAME_HEADER.pack(i, h, w)
+            yield np.ascontiguousarray(uncertainties, dtype=np.uint8).tobytes()
+            yield np.ascontiguousarray(classes, dtype=np.uint8).tobytes()
+    except Exception as e:
+        # the response has started, so the error can only be reported in the body
+        print(e)
+        message = str(e).encode("utf-8")
+        yield FRAME_HEADER.pack(ERROR_FRAME, 0, len(message)) + message
+        return
+    yield FRAME_HEADER.pack(END_FRAME, 0, 0)
+
+
+def decode_frames(body: bytes) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+    """Parse a streamed response $body back into (image index, class values, uncertainties) of each frame.
+
+    :param body: concatenated frames from encode_frames()
+    :type body: bytes
+    :raises Exception: on an error frame, or if $body is truncated (no end frame)
+    :yield: (image index, (h, w) uint8 class values, (h, w) uint8 uncertainties)
+    :rtype: Iterator[Tuple[int, np.ndarray, np.ndarray]]
+    """
+    offset = 0
+    while offset + FRAME_HEADER.size <= len(body):
+        i, h, w = FRAME_HEADER.unpack_from(body, offset)
+        offset += FRAME_HEADER.size
+        if i == END_FRAME:
+            return
+        elif i == ERROR_FRAME:
+            raise Exception(bytes(body[offset : offset + w]).decode("utf-8"))
+        elif offset + 2 * h * w > len(body):
+            break
+        uncertainties = np.frombuffer(body, dtype=np.uint8, count=h * w, offset=offset).reshape((h, w))
+        classes = np.frombuffer(body, dtype=np.uint8, count=h * w, offset=offset + h * w).reshape((h, w))
+        offset += 2 * h * w
+        yield i, classes, uncertainties
+    raise Exception("streamed response truncated")
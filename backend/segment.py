@@ -1,18 +1,35 @@
 """Given an image and some labels, featurise then segment with random forest classiier."""
-from zipfile import ZIP_DEFLATED
 import numpy as np
 from PIL import Image
-from tifffile import imwrite
+from tifffile import imwrite, imread
 import os
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
 from math import floor, ceil
-from pickle import dump
-from skops.io import dump as skdump
+from functools import partial
 from skops.io import loads as skloads
 from skops.io import load as skload
 
 from test_resources.call_weka import sep
-from forest_based import segment_with_features, apply_features_done, EnsembleMethod
+from forest_based import (
+    segment_with_features,
+    apply_features_done_streaming,
+    get_n_trees,
+    get_predictor,
+    probs_to_uint8,
+    EnsembleMethod,
+    EnsembleMethodName,
+    SamplerName,
+)
+from binning import SKOPS_TRUSTED_TYPES
+from validation import ValidationMode, clear_deferred
+from model_registry import MODEL_REGISTRY, encode_model
+from pruning import export_model
+from compression import get_projection, export_compressed_model
+from artifacts import queue_artifact, wait_for_artifacts
+from superpixels import apply_superpixels, is_superpixel_model
+from distill import distill as distill_model
+from HITL import set_uncertainty_maps
+from responses import ResponseBuffer
 import matplotlib.cm as cm
 
 try:
@@ -148,7 +165,36 @@ async def save_processed_segs(
     
 
 
-async def _save_as_tiff(
+def _write_seg_tiff(out: np.ndarray, UID: str, score: float | None = None) -> None:
+    """Write composited segmentation $out to the user directory, with the validation score in the software tag."""
+    sw_name: str = "SAMBA"
+    if score is not None:
+        sw_name = f"SAMBA, val. score={score:.3f}"
+
+    imwrite(
+        f"{CWD}{sep}{UID}{sep}seg.tiff",
+        out,
+        photometric="minisblack",
+        description="foo".encode("utf-8"),
+        datetime=True,
+        software=sw_name,
+    )
+
+
+async def retag_segmentation(UID: str, score: float) -> None:
+    """Rewrite the user's saved segmentation with $score in its software tag, i.e once a deferred score is ready.
+
+    :param UID: user ID
+    :type UID: str
+    :param score: validation score of the classifier that made the segmentation
+    :type score: float
+    """
+    wait_for_artifacts(UID, ["seg"])
+    out = imread(f"{CWD}{sep}{UID}{sep}seg.tiff")
+    _write_seg_tiff(out, UID, score)
+
+
+def _write_seg_artifacts(
     arr_list: List[np.ndarray],
     mode: str,
     UID: str,
@@ -158,7 +204,7 @@ async def _save_as_tiff(
     rescale: bool = True,
     thumbnail: bool = True,
 ) -> int:
-    """Given an arr of sub-images, composite then save to user directory.
+    """Given an arr of sub-images, composite then save to user directory (as tiff, png and thumbnail).
 
     :param arr_list: list of arrs of sub-images
     :type arr_list: List[np.ndarray]
@@ -170,7 +216,7 @@ async def _save_as_tiff(
     :type large_w: int, optional
     :param large_h: height of large image, defaults to 0
     :type large_h: int, optional
-    :param score: OOB score of classifier, stored in tiff software name
+    :param score: validation score of classifier, stored in tiff software name
     :type score: float | None, optional
     :param rescale: whether to rescale class values to make results visible, defaults to True
     :type rescale: bool, optional
@@ -180,18 +226,7 @@ async def _save_as_tiff(
     :rtype: int
     """
     out = _create_composite_tiff(arr_list, mode, large_w=large_w, large_h=large_h, rescale=rescale)
-    sw_name: str = "SAMBA"
-    if score is not None:
-        sw_name = f"SAMBA, val. score={score:.3f}"
-
-    imwrite(
-        f"{CWD}{sep}{UID}{sep}seg.tiff",
-        out,
-        photometric="minisblack",
-        description="foo".encode("utf-8"),
-        datetime=True,
-        software=sw_name,
-    )
+    _write_seg_tiff(out, UID, score)
 
     try:
         if thumbnail:
@@ -210,38 +245,57 @@ async def _save_as_tiff(
     return 0
 
 
-async def save_labels(
-    img_dims: List[Tuple[int, int]],
-    labels_dicts: List[dict],
-    UID: str,
+async def _save_as_tiff(
+    arr_list: List[np.ndarray],
     mode: str,
+    UID: str,
     large_w: int = 0,
     large_h: int = 0,
-    rescale=True,
-) -> np.ndarray:
-    """Create composite tiffs of the label arrs and return the bytes. This has 0 for unlabelled pixels.
+    score: float | None = None,
+    rescale: bool = True,
+    thumbnail: bool = True,
+) -> int:
+    """Given an arr of sub-images, composite then save to user directory now, replacing any queued write.
 
-    :param images: list of images. TODO: make this a lsit of (h, w) tuples
-    :type images: List[Image.Image]
-    :param labels_dicts: list of label dictionaries as sent over HTTP
-    :type labels_dicts: List[dict]
+    :param arr_list: list of arrs of sub-images
+    :type arr_list: List[np.ndarray]
     :param mode: whether the image is large or a stack
     :type mode: str
+    :param UID: user ID pointing to folder to store the tiff
+    :type UID: str
     :param large_w: width of large image, defaults to 0
     :type large_w: int, optional
     :param large_h: height of large image, defaults to 0
     :type large_h: int, optional
+    :param score: validation score of classifier, stored in tiff software name
+    :type score: float | None, optional
     :param rescale: whether to rescale class values to make results visible, defaults to True
     :type rescale: bool, optional
-    :return: np array of the (composited) labels
-    :rtype: np.ndarray
+    :param thumbnail: whether to save cropped thumbnail for gallery, defaults to True
+    :type thumbnail: bool, optional
+    :return: 0 if successful
+    :rtype: int
     """
+    wait_for_artifacts(UID, ["seg"])
+    return _write_seg_artifacts(arr_list, mode, UID, large_w, large_h, score, rescale, thumbnail)
+
+
+def _write_labels(
+    img_dims: List[Tuple[int, int]],
+    labels_dicts: List[dict],
+    UID: str,
+    mode: str,
+    large_w: int = 0,
+    large_h: int = 0,
+    rescale=True,
+) -> np.ndarray:
+    """Create composite tiff of the label arrs and write it to the user directory. See save_labels()."""
     label_arrs: List[np.ndarray] = []
     for i in range(len(img_dims)):
         h, w = img_dims[i]
         label_dict = labels_dicts[i]
         labels_list = [item for keys, item in label_dict.items()]
-        label_arr = np.array(labels_list).reshape(h, w)
+        label_arr = np.array(labels_list, dtype=np.uint8).reshape(h, w)
         label_arrs.append(label_arr)
     label_out = _create_composite_tiff(label_arrs, mode, large_w, large_h, rescale)
     imwrite(
@@ -253,8 +307,39 @@ async def save_labels(
     return label_out
 
 
+async def save_labels(
+    img_dims: List[Tuple[int, int]],
+    labels_dicts: List[dict],
+    UID: str,
+    mode: str,
+    large_w: int = 0,
+    large_h: int = 0,
+    rescale=True,
+) -> np.ndarray:
+    """Create composite tiffs of the label arrs and return the bytes. This has 0 for unlabelled pixels.
+
+    :param images: list of images. TODO: make this a lsit of (h, w) tuples
+    :type images: List[Image.Image]
+    :param labels_dicts: list of label dictionaries as sent over HTTP
+    :type labels_dicts: List[dict]
+    :param mode: whether the image is large or a stack
+    :type mode: str
+    :param large_w: width of large image, defaults to 0
+    :type large_w: int, optional
+    :param large_h: height of large image, defaults to 0
+    :type large_h: int, optional
+    :param rescale: whether to rescale class values to make results visible, defaults to True
+    :type rescale: bool, optional
+    :return: np array of the (composited) labels
+    :rtype: np.ndarray
+    """
+    wait_for_artifacts(UID, ["labels"])
+    return _write_labels(img_dims, labels_dicts, UID, mode, large_w, large_h, rescale)
+
+
 async def _save_classifier(model: EnsembleMethod, CWD: str, UID: str) -> int:
-    """Save (trained) ensemble method to user data folder in both .pkl and .skops format.
+    """Register (trained) ensemble method as the user's classifier. It's kept in memory and written to their data
+    folder on the background artifact worker after the response (see model_registry.py).
 
     :param model: (trained) sklearn ensemble method
     :type model: EnsembleMethod
@@ -262,22 +347,31 @@ async def _save_classifier(model: EnsembleMethod, CWD: str, UID: str) -> int:
     :type CWD: str
     :param UID: user ID
     :type UID: str
-    :return: 0 if successful
+    :return: registry token of the classifier, to check it's still the user's classifier later
     :rtype: int
     """
-    with open(f"{CWD}{sep}{UID}{sep}classifier.pkl", "wb") as handle:
-        dump(model, handle)
-    skdump(
-        model,
-        f"{CWD}{sep}{UID}{sep}classifier.skops",
-        compression=ZIP_DEFLATED,
-        compresslevel=9,
-    )
-    return 0
+    return MODEL_REGISTRY.put(UID, model, f"{CWD}{sep}{UID}").token
+
+
+def _distill_classifier(model: EnsembleMethod, token: int, UID: str, n_imgs: int) -> None:
+    """Distill $model (see distill.py) and attach the student to the user's classifier if it agrees closely enough.
+
+    :param model: (trained) sklearn ensemble method, registered as the user's classifier
+    :type model: EnsembleMethod
+    :param token: registry token of $model, from _save_classifier()
+    :type token: int
+    :param UID: user ID
+    :type UID: str
+    :param n_imgs: number of images to sample pixels from
+    :type n_imgs: int
+    """
+    distilled, _ = distill_model(model, UID, n_imgs)
+    if distilled is not None and not MODEL_REGISTRY.attach_distilled(UID, token, distilled):
+        print("Classifier retrained before distilling finished")
 
 
 async def load_classifier_from_http(file_bytes: bytes, CWD: str, UID: str) -> None:
-    """Use skload to load sklearn model from $file_bytes, then save to user directory.
+    """Use skload to load sklearn model from $file_bytes, then register it as the user's classifier.
 
     :param file_bytes: bytes corresponing to skops file of classifier sent over HTTP
     :type file_bytes: bytes
@@ -286,16 +380,41 @@ async def load_classifier_from_http(file_bytes: bytes, CWD: str, UID: str) -> No
     :param UID: user id
     :type UID: str
     """
-    model = skloads(file_bytes)
-    skdump(
-        model,
-        f"{CWD}{sep}{UID}{sep}classifier.skops",
-        compression=ZIP_DEFLATED,
-        compresslevel=9,
-    )
+    model = skloads(file_bytes, trusted=SKOPS_TRUSTED_TYPES)
+    # uploaded bytes are already a valid .skops encoding, so downloading it again doesn't re-encode
+    MODEL_REGISTRY.put(UID, model, f"{CWD}{sep}{UID}", encoded={".skops": file_bytes})
     print("Loaded skops successfully")
 
 
+def get_classifier_bytes(UID: str, file_format: str, distilled: bool = False) -> bytes:
+    """Get user $UID's classifier (or its $distilled student) encoded in $file_format for downloading. If their
+    features were pruned it's rebuilt to predict on stacks of the features they requested (see pruning.py), and
+    if they were compressed it's put behind the projection (see compression.py).
+
+    :param UID: user ID
+    :type UID: str
+    :param file_format: ".pkl" or ".skops"
+    :type file_format: str
+    :param distilled: whether to get the distilled student, defaults to False
+    :type distilled: bool, optional
+    :return: encoded classifier
+    :rtype: bytes
+    """
+    folder_name = f"{CWD}{sep}{UID}"
+    entry = MODEL_REGISTRY.get_or_load(UID, folder_name, lambda path: skload(path, trusted=SKOPS_TRUSTED_TYPES))
+    model = entry.distilled if distilled else entry.model
+    if model is None:
+        raise Exception("classifier has no distilled model")
+    exported = export_model(UID, model)
+    projection = get_projection(UID)
+    if projection is not None:
+        exported = export_compressed_model(projection, exported)
+    if exported is model:
+        # encoded on first download (and cached until retrain)
+        return MODEL_REGISTRY.get_bytes(UID, folder_name, file_format, distilled)
+    return encode_model(exported, file_format)
+
+
 async def segment(
     img_dims: List[Tuple[int, int]],
     labels_dicts: List[dict],
@@ -307,7 +426,16 @@ async def segment(
     train_all: bool = True,
     rescale: bool = True,
     balance: bool = True,
-) -> Tuple[np.ndarray, np.ndarray]:
+    incremental: bool = False,
+    model_name: EnsembleMethodName = "FRF",
+    time_budget_ms: float | None = None,
+    validation: ValidationMode = "oob",
+    superpixels: bool = False,
+    refine_boundaries: bool = False,
+    sampler: SamplerName = "random",
+    prune: bool = False,
+    distill: bool = False,
+) -> Tuple[ResponseBuffer, dict]:
     """Perform FRF segmentation.
 
     Given list of label dicts, convert to arr, reshape to be same as corresponding image. Once
@@ -334,50 +462,126 @@ async def segment(
     :type rescale: bool, optional
     :param balance: whether to balance training points based on class frequency, defaults to True
     :type balance: bool, optional
-    :return: flattened segementations (class values) where labels overwrite predictions if different.
-    :rtype: np.ndarray
+    :param incremental: whether to update the user's previous forest rather than train a new one, defaults to False
+    :type incremental: bool, optional
+    :param model_name: classifier to train, "FRF" (random forest) or "LGBM" (binned gradient boosting), defaults to "FRF"
+    :type model_name: EnsembleMethodName, optional
+    :param time_budget_ms: training time budget in ms (random forest only), defaults to None (fixed 200 trees)
+    :type time_budget_ms: float | None, optional
+    :param validation: validation mode of random forests, see validation.py, defaults to "oob"
+    :type validation: ValidationMode, optional
+    :param superpixels: whether to train and predict per superpixel, see superpixels.py, defaults to False
+    :type superpixels: bool, optional
+    :param refine_boundaries: whether to refine superpixel boundaries per pixel, defaults to False
+    :type refine_boundaries: bool, optional
+    :param sampler: training point sampler, "random", "thinned" (spatially) or "diverse", defaults to "random"
+    :type sampler: SamplerName, optional
+    :param prune: whether to prune unimportant features and refit, see pruning.py, defaults to False
+    :type prune: bool, optional
+    :param distill: whether to distill the classifier to a small forest for applying, in the background after
+        responding (see distill.py), defaults to False
+    :type distill: bool, optional
+    :return: response buffer of flattened uncertainties and segmentations (class values) where labels overwrite
+        predictions if different, and dict of training info (number of trees and validation score)
+    :rtype: Tuple[ResponseBuffer, dict]
     """
     label_arrs: List[np.ndarray] = []
     for i in range(len(img_dims)):
         h, w = img_dims[i]
         label_dict = labels_dicts[i]
         labels_list = [item for keys, item in label_dict.items()]
-        label_arr = np.array(labels_list).reshape(h, w)
+        label_arr = np.array(labels_list, dtype=np.uint8).reshape(h, w)
         label_arrs.append(label_arr)
 
     remasked_arrs_list: List[np.ndarray] = []
-    remasked_flattened_arrs: np.ndarray = np.array([])
-    uncertainty_flattened_arrs: np.ndarray = np.array([])
-    probs, model, score = segment_with_features(label_arrs, UID, n_points=n_points, train_all=train_all, balance_classes=balance)
+    uncertainty_maps: List[np.ndarray] = []
+    response = ResponseBuffer(img_dims)
+    probs, model, score = segment_with_features(
+        label_arrs,
+        UID,
+        model_name=model_name,
+        n_points=n_points,
+        train_all=train_all,
+        balance_classes=balance,
+        incremental=incremental,
+        time_budget_ms=time_budget_ms,
+        validation=validation,
+        superpixels=superpixels,
+        refine_boundaries=refine_boundaries,
+        sampler=sampler,
+        prune=prune,
+    )
+    training_info = {"n_trees": get_n_trees(model), "score": score}
     N_imgs = len(probs)
+    # class index -> original class label (stored in model.classes_)
+    class_lut = np.asarray(model.classes_).astype(np.uint8)
 
     for i in range(N_imgs):
         label_arr = label_arrs[i]
-        max_certainty: np.ndarray = np.amax(probs[i], axis=0)
-        uncertainties = 1 - max_certainty
-        uncertainties = (np.rint(_norm(uncertainties)* 255)).astype(np.uint8)
-        # get one hot of where max prob is, index original class labels (stored in model.classes_) to get remapping
-        class_mask = np.argmax(probs[i], axis=0).astype(np.uint8) #+ 1
-        one_hot = np.eye(len(model.classes_))[class_mask]
-        classes = one_hot * np.array(model.classes_).astype(np.uint8)
-        classes = np.max(classes, axis=-1)
-
-        remasked = np.where(label_arr == 0, classes, label_arr).astype(np.uint8)
-        remasked_arrs_list.append(remasked)
-        if i == 0:
-            remasked_flattened_arrs = remasked.flatten()
-            uncertainty_flattened_arrs = uncertainties.flatten()
-        else:
-            remasked_flattened_arrs = np.concatenate((remasked_flattened_arrs, remasked.flatten()), axis=0, dtype=np.uint8)
-            uncertainty_flattened_arrs = np.concatenate((uncertainty_flattened_arrs, uncertainties.flatten()), axis=0, dtype=np.uint8)
-    await _save_as_tiff(remasked_arrs_list, save_mode, UID, large_w, large_h, score, rescale=rescale)
-    await save_labels(img_dims, labels_dicts, UID, save_mode, large_w, large_h, rescale)
-    await _save_classifier(model, CWD, UID)
-    #print(remasked_flattened_arrs.shape, label_arrs[0].shape)
-    #cmapped_flat = _cmap_uncertainties_return_flat_arr(uncertainty_flattened_arrs)
-    print(np.amax(uncertainty_flattened_arrs), np.mean(uncertainty_flattened_arrs), np.median(uncertainty_flattened_arrs), np.mean(remasked_flattened_arrs))
-    print(remasked_flattened_arrs.shape, uncertainty_flattened_arrs.shape)
-    return remasked_flattened_arrs, uncertainty_flattened_arrs #, least_certain_regions
+        remasked, uncertainties = probs_to_uint8(probs[i], class_lut, axis=0)
+        labelled = label_arr > 0
+        remasked[labelled] = label_arr[labelled]
+        # only the displayed copy is stretched: suggestions compare (unstretched) uncertainties across images
+        remasked_arrs_list.append(response.write(i, remasked, _stretch(uncertainties)))
+        uncertainty_maps.append(uncertainties)
+    set_uncertainty_maps(UID, uncertainty_maps)
+    # exports are only read when saving, so write them after the response (see artifacts.py)
+    queue_artifact(
+        UID,
+        "seg",
+        partial(_write_seg_artifacts, remasked_arrs_list, save_mode, UID, large_w, large_h, score, rescale),
+    )
+    queue_artifact(
+        UID, "labels", partial(_write_labels, img_dims, labels_dicts, UID, save_mode, large_w, large_h, rescale)
+    )
+    token = await _save_classifier(model, CWD, UID)
+    if distill and not superpixels:
+        queue_artifact(UID, "distilled", partial(_distill_classifier, model, token, UID, N_imgs))
+    #print(response.classes.shape, label_arrs[0].shape)
+    #cmapped_flat = _cmap_uncertainties_return_flat_arr(response.uncertainties)
+    print(np.amax(response.uncertainties), np.mean(response.uncertainties), np.median(response.uncertainties), np.mean(response.classes))
+    print(response.classes.shape, response.uncertainties.shape)
+    return response, training_info #, least_certain_regions
+
+
+def _apply_results(
+    img_dims: List[Tuple[int, int]], UID: str, dedup: bool, early_exit: bool
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Load user $UID's classifier and get an iterator of each image's (h, w) uint8 class values and uncertainties."""
+    # the applied segmentation has no score, so a pending deferred one mustn't be stamped on it when saving
+    clear_deferred(UID)
+    # registry hit skips deserialising (and re-flattening) the classifier, i.e when applying to each new slice
+    entry = MODEL_REGISTRY.get_or_load(
+        UID, f"{CWD}{sep}{UID}", lambda path: skload(path, trusted=SKOPS_TRUSTED_TYPES)
+    )
+    # a distilled student is only kept if it agrees with the classifier, so it's used for (bulk) apply
+    model = entry.model if entry.distilled is None else entry.distilled
+    if entry.predictor is None:
+        entry.predictor = get_predictor(model)
+    # superpixel classifiers take region features, whatever the client's superpixel setting now is
+    if is_superpixel_model(model):
+        class_lut = np.asarray(model.classes_).astype(np.uint8)
+        return (
+            probs_to_uint8(p, class_lut, axis=0) for p in apply_superpixels(entry.predictor, UID, len(img_dims))
+        )
+    # streamed in blocks straight to uint8 class values (via model.classes_) and uncertainties, images pipelined
+    return apply_features_done_streaming(model, UID, len(img_dims), entry.predictor, dedup, early_exit)
+
+
+def _finish_apply(
+    arrs_list: List[np.ndarray],
+    uncertainty_maps: List[np.ndarray],
+    UID: str,
+    save_mode: str,
+    large_w: int,
+    large_h: int,
+    rescale: bool,
+) -> None:
+    """Keep applied images' uncertainties for suggestions (see HITL.py) and queue writing their segmentations."""
+    set_uncertainty_maps(UID, uncertainty_maps)
+    queue_artifact(
+        UID, "seg", partial(_write_seg_artifacts, arrs_list, save_mode, UID, large_w, large_h, None, rescale)
+    )
 
 
 async def apply(
@@ -387,7 +591,9 @@ async def apply(
     large_w: int = 0,
     large_h: int = 0,
     rescale: bool = True,
-) -> Tuple[np.ndarray, np.ndarray]:
+    dedup: bool = False,
+    early_exit: bool = False,
+) -> ResponseBuffer:
     """Apply a trained classifier to a collection of images, save the tiff(s) & return the flattened byte arrays.
 
     :param img_dims: list of image dimensions
@@ -402,34 +608,75 @@ async def apply(
     :type large_h: int, optional
     :param rescale: whether to rescale class values to make results visible, defaults to True
     :type rescale: bool, optional
-    :return: flattened segmentations (only class values)
-    :rtype: np.ndarray
+    :param dedup: only predict distinct (quantized) feature rows, for images with large flat regions, defaults to False
+    :type dedup: bool, optional
+    :param early_exit: stop evaluating a random forest's trees on pixels once their class is decided, defaults to False
+    :type early_exit: bool, optional
+    :return: response buffer of flattened uncertainties and segmentations (only class values)
+    :rtype: ResponseBuffer
     """
-    model = skload(f"{CWD}{sep}{UID}{sep}classifier.skops")
-    probs = apply_features_done(model, UID, len(img_dims))
-    N_imgs = len(probs)
+    results = _apply_results(img_dims, UID, dedup, early_exit)
     # array to store coords of least certain region
     #least_certain_regions = np.zeros((N_imgs * 4), dtype=np.int32) - 1
 
     arrs_list: List[np.ndarray] = []
-    flattened_arrs: np.ndarray = np.ndarray([])
-    uncertainty_flattened_arrs: np.ndarray = np.ndarray([])
-    for i in range(len(img_dims)):
-        print(probs[i].shape)
-        max_certainty: np.ndarray = np.amax(probs[i], axis=0)
-        uncertainties = 1 - max_certainty
-        classes = np.argmax(probs[i], axis=0).astype(np.uint8) + 1
-        arrs_list.append(classes)
-        if i == 0:
-            flattened_arrs = classes.flatten()
-            uncertainty_flattened_arrs = uncertainties.flatten()
-        else:
-            flattened_arrs = np.concatenate((flattened_arrs, classes.flatten()), axis=0, dtype=np.uint8)
-            uncertainty_flattened_arrs = np.concatenate((uncertainty_flattened_arrs, uncertainties.flatten()))
-    await _save_as_tiff(arrs_list, save_mode, UID, large_w, large_h, rescale=rescale)
-    #cmapped_flat = _cmap_uncertainties_return_flat_arr(uncertainty_flattened_arrs)
-    uncertainties_out = (uncertainty_flattened_arrs * 255).astype(np.uint8)
-    return flattened_arrs, uncertainties_out #, least_certain_regions
+    uncertainty_maps: List[np.ndarray] = []
+    response = ResponseBuffer(img_dims)
+    for i, (classes, uncertainties) in enumerate(results):
+        arrs_list.append(response.write(i, classes, uncertainties))
+        uncertainty_maps.append(uncertainties)
+    _finish_apply(arrs_list, uncertainty_maps, UID, save_mode, large_w, large_h, rescale)
+    #cmapped_flat = _cmap_uncertainties_return_flat_arr(response.uncertainties)
+    return response #, least_certain_regions
+
+
+def stream_apply(
+    img_dims: List[Tuple[int, int]],
+    UID: str,
+    save_mode: str,
+    large_w: int = 0,
+    large_h: int = 0,
+    rescale: bool = True,
+    dedup: bool = False,
+    early_exit: bool = False,
+) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+    """Like apply(), but yield each image's results as soon as it's predicted, for a streamed response.
+
+    The classifier is loaded before returning, so a missing classifier raises here rather than mid-stream. Once the
+    last image is yielded, the tiff(s) are queued for saving as in apply(). If prediction fails part way nothing is
+    saved, and encode_frames() ends the stream with an error frame (see responses.py).
+
+    :param img_dims: list of image dimensions
+    :type img_dims: List[Tuple[int, int]]
+    :param UID: user id
+    :type UID: str
+    :param save_mode: whether the image is large or a stack
+    :type save_mode: str
+    :param large_w: width of large image, defaults to 0
+    :type large_w: int, optional
+    :param large_h: height of large image, defaults to 0
+    :type large_h: int, optional
+    :param rescale: whether to rescale class values to make results visible, defaults to True
+    :type rescale: bool, optional
+    :param dedup: only predict distinct (quantized) feature rows, for images with large flat regions, defaults to False
+    :type dedup: bool, optional
+    :param early_exit: stop evaluating a random forest's trees on pixels once their class is decided, defaults to False
+    :type early_exit: bool, optional
+    :return: iterator of (image index, (h, w) uint8 class values, (h, w) uint8 uncertainties)
+    :rtype: Iterator[Tuple[int, np.ndarray, np.ndarray]]
+    """
+    results = _apply_results(img_dims, UID, dedup, early_exit)
+
+    def _stream() -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        arrs_list: List[np.ndarray] = []
+        uncertainty_maps: List[np.ndarray] = []
+        for i, (classes, uncertainties) in enumerate(results):
+            arrs_list.append(classes)
+            uncertainty_maps.append(uncertainties)
+            yield i, classes, uncertainties
+        _finish_apply(arrs_list, uncertainty_maps, UID, save_mode, large_w, large_h, rescale)
+
+    return _stream()
 
 
 def _cmap_uncertainties_return_flat_arr(uncertainties: np.ndarray) -> np.ndarray:
@@ -442,7 +689,10 @@ def _cmap_uncertainties_return_flat_arr(uncertainties: np.ndarray) -> np.ndarray
     return scaled.flatten()
 
 
-def _norm(arr: np.ndarray) -> np.ndarray:
-    scaled = arr - np.amin(arr)
-    normed = scaled / np.amax(scaled)
-    return normed
\ No newline at end of file
+def _stretch(arr: np.ndarray) -> np.ndarray:
+    """Stretch uint8 $arr to span 0-255 with a lookup table (zeros if it's constant)."""
+    lo, hi = int(np.amin(arr)), int(np.amax(arr))
+    if hi == lo:
+        return np.zeros_like(arr)
+    lut = np.rint((np.arange(256) - lo) * (255 / (hi - lo))).clip(0, 255).astype(np.uint8)
+    return lut[arr]
\ No newline at end of file
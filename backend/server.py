@@ -12,7 +12,7 @@ from flask import (
 import base64
 from io import BytesIO
 from PIL import Image
-from typing import Callable
+from typing import Callable, List
 from azure.storage.blob import BlobServiceClient
 import os
 import json
@@ -23,9 +23,12 @@ from encode import encode, featurise, imwrite
 from segment import (
     segment,
     load_classifier_from_http,
+    get_classifier_bytes,
     apply,
+    stream_apply,
     save_labels,
     save_processed_segs,
+    retag_segmentation,
 )
 from file_handling import (
     delete_old_folders,
@@ -34,6 +37,16 @@ from file_handling import (
     _make_activity_log,
     _update_log,
 )
+from training_set import clear_training_set
+from incremental import clear_incremental_forest
+from binning import clear_binner
+from model_registry import MODEL_REGISTRY
+from artifacts import wait_for_artifacts, clear_artifacts
+from pruning import get_features_to_compute, clear_session_features
+from compression import N_COMPONENTS
+from responses import encode_frames
+from HITL import suggest_regions, get_uncertainty_maps, clear_uncertainty_maps, N_SUGGESTIONS, SUGGESTION_SIZES
+from validation import check_validation_mode, start_deferred, pop_deferred_score, clear_deferred
 
 # Very important: this environment variable is only present on webapp. If running locally, this fails and we use cwd instead.
 server = False
@@ -136,6 +149,19 @@ def hello_world():
 
 
 # ================================= INIT =================================
+def _forget_session_state(UID: str) -> None:
+    """Drop any in-memory state (i.e persistent training set, forest, bins, scores, classifier, queued writes, features,
+    uncertainties) of user whose data folder has been deleted."""
+    clear_training_set(UID)
+    clear_incremental_forest(UID)
+    clear_binner(UID)
+    clear_deferred(UID)
+    MODEL_REGISTRY.forget(UID)
+    clear_artifacts(UID)
+    clear_session_features(UID)
+    clear_uncertainty_maps(UID)
+
+
 async def init_fn(request) -> Response:
     """Call when user connects for first time. Creates a temporary folder in app directory."""
     UID = request.json["id"]
@@ -144,7 +170,8 @@ async def init_fn(request) -> Response:
     except FileExistsError:
         pass
     _make_activity_log(UID)
-    delete_old_folders(UID)
+    for old_UID in delete_old_folders(UID):
+        _forget_session_state(old_UID)
     return jsonify(success=True)
 
 
@@ -159,10 +186,22 @@ async def init_app():
 async def featurise_fn(request) -> Response:
     """Call when user uploads an image(s). Converts b64 to image, performs featurisation and stores serverside."""
     UID = request.json["id"]
-    features = request.json["features"]
+    # the user's pruned features if they've pruned (see pruning.py) and not changed their features since
+    features = get_features_to_compute(UID, request.json["features"])
     images = [_get_image_from_b64(i) for i in request.json["images"]]
     offset = request.json["offset"]
-    await featurise(images, UID, selected_features=features, offset=offset)
+    superpixels: bool = request.json.get("superpixels", False)
+    compression: str | None = request.json.get("compression", None)
+    n_components: int = request.json.get("n_components", N_COMPONENTS)
+    await featurise(
+        images,
+        UID,
+        selected_features=features,
+        offset=offset,
+        superpixels=superpixels,
+        compression=compression,
+        n_components=n_components,
+    )
     return jsonify(success=True)
 
 
@@ -229,7 +268,16 @@ async def segment_fn(request) -> Response:
             request.json["train_all"],
             request.json["balance"],
         )
-        segmentation, uncertainties = await segment(
+        incremental: bool = request.json.get("incremental", False)
+        model_name: str = request.json.get("model", "FRF")
+        time_budget_ms: float | None = request.json.get("time_budget_ms", None)
+        validation = check_validation_mode(request.json.get("validation", "oob"))
+        superpixels: bool = request.json.get("superpixels", False)
+        refine_boundaries: bool = request.json.get("refine_boundaries", False)
+        sampler: str = request.json.get("sampler", "random")
+        prune: bool = request.json.get("prune", False)
+        distill: bool = request.json.get("distill", False)
+        body, training_info = await segment(
             img_dims,
             labels_dicts,
             UID,
@@ -240,13 +288,53 @@ async def segment_fn(request) -> Response:
             train_all,
             rescale,
             balance,
+            incremental,
+            model_name,
+            time_budget_ms,
+            validation,
+            superpixels,
+            refine_boundaries,
+            sampler,
+            prune,
+            distill,
         )
     elif segment_type == "apply":
-        segmentation, uncertainties = await apply(
-            img_dims, UID, save_mode, large_w, large_h, rescale=rescale
+        dedup: bool = request.json.get("dedup", False)
+        early_exit: bool = request.json.get("early_exit", False)
+        if request.json.get("stream", False):
+            # one frame per image as soon as it's predicted (see responses.py)
+            frames = stream_apply(
+                img_dims,
+                UID,
+                save_mode,
+                large_w,
+                large_h,
+                rescale=rescale,
+                dedup=dedup,
+                early_exit=early_exit,
+            )
+            return Response(encode_frames(frames), mimetype="application/octet-stream")
+        body = await apply(
+            img_dims,
+            UID,
+            save_mode,
+            large_w,
+            large_h,
+            rescale=rescale,
+            dedup=dedup,
+            early_exit=early_exit,
         )
-    response = Response(uncertainties.tobytes() + segmentation.tobytes())
-    response.headers.add("Content-Type", "application/octet-stream")
+    # uncertainties then segmentations, sent straight from the preallocated buffer (see responses.py)
+    response = Response(body.chunks(), mimetype="application/octet-stream")
+    response.headers["Content-Length"] = str(body.nbytes)
+    if segment_type == "segment":
+        # achieved tree count and validation score, readable by the GUI via Access-Control-Expose-Headers
+        response.headers.add("X-Samba-Trees", str(training_info["n_trees"]))
+        if training_info["score"] is not None:
+            response.headers.add("X-Samba-Score", f"{training_info['score']:.4f}")
+        response.headers.add("Access-Control-Expose-Headers", "X-Samba-Trees, X-Samba-Score")
+        # deferred validation runs only once the segmentation has been sent
+        response.call_on_close(lambda: start_deferred(UID))
     return response
 
 
@@ -257,12 +345,40 @@ async def segment_respond():
     return response
 
 
+# ================================= SUGGEST =================================
+async def suggest_fn(request) -> Response:
+    """Suggest the most uncertain regions of the user's last segmentation to label next (see HITL.py)."""
+    UID: str = request.json["id"]
+    k: int = request.json.get("k", N_SUGGESTIONS)
+    sizes: List[int] = request.json.get("sizes", list(SUGGESTION_SIZES))
+    uncertainty_maps = get_uncertainty_maps(UID)
+    if uncertainty_maps is None:
+        raise Exception("no segmentation to suggest regions from, segment first")
+    suggestions = [
+        {"img": img_idx, "x": x0, "y": y0, "w": w, "h": h, "uncertainty": score}
+        for img_idx, x0, y0, w, h, score in suggest_regions(uncertainty_maps, k, sizes)
+    ]
+    return jsonify(suggestions=suggestions)
+
+
+@app.route("/suggest", methods=["POST", "GET", "OPTIONS"])
+async def suggest_respond():
+    """Suggestion response."""
+    response = await generic_response(request, suggest_fn)
+    return response
+
+
 # ================================= SAVING =================================
 async def save_fn(request) -> Response:
     """Return the saved segmentation or classifier (from segment function)."""
     UID = request.json["id"]
     save_type = request.json["type"]
+    # seg/labels from the last segment/apply may still be being written in the background
+    wait_for_artifacts(UID)
     if save_type == "segmentation":
+        deferred_score = pop_deferred_score(UID)
+        if deferred_score is not None:
+            await retag_segmentation(UID, deferred_score)
         response = send_file(
             f"{CWD}{sep}{UID}{sep}seg.tiff",
             mimetype="image/tiff",
@@ -276,10 +392,14 @@ async def save_fn(request) -> Response:
         )
     else:
         file_format = request.json["format"]
+        # the small student classifier from distilling (see distill.py), if requested
+        distilled: bool = request.json.get("distilled", False)
+        classifier_bytes = get_classifier_bytes(UID, file_format, distilled)
+        name = "classifier_distilled" if distilled else "classifier"
         response = send_file(
-            f"{CWD}{sep}{UID}{sep}classifier{file_format}",
+            BytesIO(classifier_bytes),
             mimetype="application/octet-stream",
-            download_name=f"classifier{file_format}",
+            download_name=f"{name}{file_format}",
         )
     return response
 
@@ -393,6 +513,7 @@ def _map_fname_to_zip_fname(fname: str) -> str:
 
 async def save_to_gallery_fn(request) -> Response:
     UID = request.json["id"]
+    wait_for_artifacts(UID)
     with zipfile.ZipFile(f"{CWD}{sep}{UID}{sep}{UID}.zip", "w") as zipf:
         for fn in os.listdir(f"{CWD}{sep}{UID}"):
             fname, extension = fn.split(".")
@@ -0,0 +1,216 @@
+"""Superpixel-level classification.
+
+Per-pixel training and prediction run over every one of an image's h*w feature rows, though neighbouring pixels of
+the same phase are near-identical. In superpixel mode each image is over-segmented into superpixels (SLIC on the
+greyscale image) once at featurisation time, and the classifier is trained and applied on one row per superpixel:
+the mean and standard deviation of each feature over the region. A region's training label is the majority label of
+its labelled pixels. Predicting ~1 row per SUPERPIXEL_PIXELS pixels makes the prediction itself much cheaper, at the
+cost of boundaries snapping to superpixel edges. These can optionally be refined by a per-pixel classifier run only
+on pixels at edges between superpixels of different predicted classes.
+
+Limitations: the speedup is far short of the 100-1000x fewer rows suggests, as loading features and computing the
+region statistics over every pixel remains. Measured end to end on a two phase test image, superpixel segmentation
+was only ~4x faster than per-pixel, and agreed with it with a Dice of just 0.62.
+
+Superpixel classifiers take region features, so they're marked as such (see mark_superpixel_model()) and applying
+dispatches on that mark rather than on the client's superpixel setting. The mark is an attribute of the model, so
+it's kept when saved and downloaded, and apply_classifier.py handles superpixel classifiers too.
+"""
+import numpy as np
+from skimage.segmentation import slic, find_boundaries
+from typing import Callable, Dict, List, Tuple
+
+from file_handling import load_features, load_superpixels
+
+# approx number of pixels per superpixel
+SUPERPIXEL_PIXELS = 100
+# SLIC compactness (for images scaled to [0, 1]): higher makes more regular, less boundary-adherent superpixels
+SLIC_COMPACTNESS = 0.1
+# attribute set on classifiers trained on region features
+SUPERPIXEL_MODEL_ATTR = "superpixels_"
+
+
+def mark_superpixel_model(model: object) -> object:
+    """Mark $model as trained on region features, so it's applied per superpixel.
+
+    :param model: classifier trained on region features
+    :type model: object
+    :return: $model
+    :rtype: object
+    """
+    setattr(model, SUPERPIXEL_MODEL_ATTR, True)
+    return model
+
+
+def is_superpixel_model(model: object) -> bool:
+    """Whether $model was trained on region features, from mark_superpixel_model().
+
+    :param model: any (trained) model
+    :type model: object
+    :return: true if superpixel classifier
+    :rtype: bool
+    """
+    return bool(getattr(model, SUPERPIXEL_MODEL_ATTR, False))
+
+
+def compute_superpixels(img_arr: np.ndarray, region_pixels: int = SUPERPIXEL_PIXELS) -> np.ndarray:
+    """Over-segment greyscale $img_arr into superpixels of approx $region_pixels pixels with SLIC.
+
+    :param img_arr: (h, w) greyscale img arr
+    :type img_arr: np.ndarray
+    :param region_pixels: approx number of pixels per superpixel, defaults to SUPERPIXEL_PIXELS
+    :type region_pixels: int, optional
+    :return: (h, w) int32 arr of superpixel ids 0..n_regions-1
+    :rtype: np.ndarray
+    """
+    img = img_arr.astype(np.float32)
+    img_range = np.amax(img) - np.amin(img)
+    img = (img - np.amin(img)) / max(float(img_range), 1e-12)
+    n_segments = max(1, img_arr.size // region_pixels)
+    superpixels = slic(img, n_segments=n_segments, compactness=SLIC_COMPACTNESS, channel_axis=None, start_label=0)
+    # ids may skip values, so relabel to contiguous
+    _, contiguous = np.unique(superpixels, return_inverse=True)
+    return contiguous.reshape(img_arr.shape).astype(np.int32)
+
+
+def region_features(feature_stack: np.ndarray, superpixels: np.ndarray) -> np.ndarray:
+    """Mean and standard deviation of each feature of $feature_stack over each superpixel.
+
+    :param feature_stack: (h, w, n_features) arr or memory map of features
+    :type feature_stack: np.ndarray
+    :param superpixels: (h, w) arr of superpixel ids, from compute_superpixels()
+    :type superpixels: np.ndarray
+    :return: (n_regions, 2 * n_features) float32 arr of feature means then standard deviations
+    :rtype: np.ndarray
+    """
+    h, w, feat = feature_stack.shape
+    ids = superpixels.reshape(-1)
+    n_regions = int(np.amax(ids)) + 1
+    counts = np.maximum(np.bincount(ids, minlength=n_regions), 1)
+    out = np.empty((n_regions, 2 * feat), dtype=np.float32)
+    for j in range(feat):
+        channel = np.asarray(feature_stack[:, :, j], dtype=np.float64).reshape(-1)
+        mean = np.bincount(ids, weights=channel, minlength=n_regions) / counts
+        mean_sq = np.bincount(ids, weights=channel**2, minlength=n_regions) / counts
+        out[:, j] = mean
+        out[:, feat + j] = np.sqrt(np.maximum(mean_sq - mean**2, 0))
+    return out
+
+
+def region_targets(superpixels: np.ndarray, label_arr: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Majority label (ignoring unlabelled, 0, pixels) of each superpixel with any labelled pixels.
+
+    :param superpixels: (h, w) arr of superpixel ids
+    :type superpixels: np.ndarray
+    :param label_arr: (h, w) arr of labels, 0 for unlabelled
+    :type label_arr: np.ndarray
+    :return: ids of labelled superpixels and their labels
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    ids = superpixels.reshape(-1)
+    labels = label_arr.reshape(-1).astype(np.int64)
+    n_regions = int(np.amax(ids)) + 1
+    n_labels = int(np.amax(labels)) + 1
+    counts = np.bincount(ids * n_labels + labels, minlength=n_regions * n_labels).reshape((n_regions, n_labels))
+    labelled = np.flatnonzero(np.sum(counts[:, 1:], axis=1) > 0)
+    targets = np.argmax(counts[labelled, 1:], axis=1) + 1
+    return labelled, targets.astype(np.uint8)
+
+
+def get_region_training_data(UID: str, labels: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Region features and majority labels of every labelled superpixel of each image.
+
+    :param UID: user ID pointing to folder with the features and superpixels
+    :type UID: str
+    :param labels: list of label arrs
+    :type labels: List[np.ndarray]
+    :return: region fit data and target data
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    fit_data: List[np.ndarray] = []
+    target_data: List[np.ndarray] = []
+    for i, label_arr in enumerate(labels):
+        if not np.any(label_arr > 0):
+            continue
+        superpixels = load_superpixels(UID, i)
+        labelled, targets = region_targets(superpixels, label_arr)
+        fit_data.append(region_features(load_features(UID, i), superpixels)[labelled])
+        target_data.append(targets)
+    return np.concatenate(fit_data, axis=0), np.concatenate(target_data, axis=0)
+
+
+def refine_boundaries(
+    probs: np.ndarray,
+    superpixels: np.ndarray,
+    feature_stack: np.ndarray,
+    pixel_predictor: Callable[[np.ndarray], np.ndarray],
+) -> int:
+    """Re-predict pixels on edges between superpixels of different predicted classes with a per-pixel classifier.
+
+    :param probs: (n_classes, h, w) arr of superpixel class probabilities, updated in place
+    :type probs: np.ndarray
+    :param superpixels: (h, w) arr of superpixel ids
+    :type superpixels: np.ndarray
+    :param feature_stack: (h, w, n_features) arr or memory map of features
+    :type feature_stack: np.ndarray
+    :param pixel_predictor: per-pixel prediction function with the same classes as the superpixel classifier
+    :type pixel_predictor: Callable[[np.ndarray], np.ndarray]
+    :return: number of refined pixels
+    :rtype: int
+    """
+    classes = np.argmax(probs, axis=0)
+    # edges of superpixels where the predicted class changes, padded by a pixel either side
+    edges = find_boundaries(superpixels, mode="thick") & find_boundaries(classes, mode="thick")
+    ys, xs = np.nonzero(edges)
+    if ys.shape[0] > 0:
+        probs[:, ys, xs] = pixel_predictor(np.asarray(feature_stack[ys, xs])).T
+    return ys.shape[0]
+
+
+def apply_superpixels(
+    predictor: Callable[[np.ndarray], np.ndarray],
+    UID: str,
+    n_imgs: int,
+    pixel_predictor: Callable[[np.ndarray], np.ndarray] | None = None,
+) -> List[np.ndarray]:
+    """Predict each superpixel of images 0..$n_imgs-1 and scatter the class probabilities to their pixels.
+
+    :param predictor: prediction function of a classifier trained on region features
+    :type predictor: Callable[[np.ndarray], np.ndarray]
+    :param UID: user ID pointing to folder with the features and superpixels
+    :type UID: str
+    :param n_imgs: number of images to loop over
+    :type n_imgs: int
+    :param pixel_predictor: per-pixel prediction function to refine boundaries with, defaults to None (no refining)
+    :type pixel_predictor: Callable[[np.ndarray], np.ndarray] | None, optional
+    :return: list of (n_classes, h, w) arrs of class probabilities for each image
+    :rtype: List[np.ndarray]
+    """
+    out: List[np.ndarray] = []
+    for i in range(n_imgs):
+        superpixels = load_superpixels(UID, i)
+        feature_stack = load_features(UID, i)
+        region_probs = predictor(region_features(feature_stack, superpixels))
+        probs = np.ascontiguousarray(region_probs[superpixels].transpose((2, 0, 1)))
+        if pixel_predictor is not None:
+            n_refined = refine_boundaries(probs, superpixels, feature_stack, pixel_predictor)
+            print(f"Refined {n_refined} boundary pixels of image {i}")
+        out.append(probs)
+    return out
+
+
+def dice_scores(seg_a: np.ndarray, seg_b: np.ndarray) -> Dict[int, float]:
+    """Dice coefficient of each class between segmentations $seg_a and $seg_b, i.e superpixel vs per-pixel.
+
+    :param seg_a: arr of class values
+    :type seg_a: np.ndarray
+    :param seg_b: arr of class values (same shape as $seg_a)
+    :type seg_b: np.ndarray
+    :return: dict of class value: dice coefficient
+    :rtype: Dict[int, float]
+    """
+    scores: Dict[int, float] = {}
+    for c in np.union1d(np.unique(seg_a), np.unique(seg_b)):
+        in_a, in_b = seg_a == c, seg_b == c
+        scores[int(c)] = float(2 * np.sum(in_a & in_b) / (np.sum(in_a) + np.sum(in_b)))
+    return scores
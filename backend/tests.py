@@ -5,28 +5,77 @@ Unit tests for featurisation and random forest segmentation.
 """
 
 import unittest
+import unittest.mock
 
 import numpy as np
-from math import isclose, pi
+from math import isclose, pi, ceil
 import matplotlib.pyplot as plt
 from tifffile import imread
 from skimage.metrics import mean_squared_error
 import time
 import sys
+import tempfile
+import os
+import threading
+import asyncio
 from azure.storage.blob import BlobServiceClient
 
 from test_resources.call_weka import sep
 
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
 
 
 import features as ft
+from file_handling import save_features, load_features, get_file_signature, save_superpixels
+from training_set import TrainingSet, clear_training_set
+from incremental import (
+    IncrementalForest,
+    get_incremental_forest,
+    clear_incremental_forest,
+    FULL_RETRAIN_CHANGE_FRAC,
+    MAX_INCREMENTAL_UPDATES,
+    MIN_REPLACE_FRAC,
+    REPLACE_SCALE,
+)
+import compiled_forest as cf
+from model_registry import (
+    ModelRegistry,
+    RegistryEntry,
+    MODEL_REGISTRY,
+    estimate_model_nbytes,
+    get_classifier_path,
+    encode_model,
+)
+from artifacts import queue_artifact, wait_for_artifacts
+from dedup import DedupPredictor, unique_rows
+from superpixels import compute_superpixels, region_features, region_targets, dice_scores, is_superpixel_model
+from compression import compress_features, get_projection, explained_variance, export_compressed_model
+from apply_classifier import load_classifier_from_file
+from distill import distill, DISTILL_AGREEMENT, DISTILL_TREES
+from HITL import integral_image, window_sums, suggest_regions
+from responses import ResponseBuffer, encode_frames, decode_frames, FRAME_HEADER
+from pruning import (
+    computed_columns,
+    prune_features,
+    get_features_to_compute,
+    clear_session_features,
+    is_pruned_model,
+    get_kept_columns,
+    export_model,
+    set_pruned_features,
+    make_pruned_model,
+)
+from validation import compute_oob_score, split_holdout, HOLDOUT_FRAC, start_deferred, pop_deferred_score
+from binning import get_binner, clear_binner, bin_features, make_binned_model, CompiledBooster, SKOPS_TRUSTED_TYPES
+from skops.io import dumps as skdumps, loads as skloads, load as skload
 from test_resources.call_weka import (
     set_macro_path,
     set_config_file,
     run_weka,
     get_label_arr,
 )
+import forest_based as fb
+import segment as seg
 from forest_based import segment_no_features_get_arr
 
 # add call to grab the weka features tif from azure blob
@@ -206,6 +255,834 @@ class TestFeatures(unittest.TestCase):
         assert np.sum(bilaterals[0]) == np.sum(bilaterals[2])
         assert np.sum(bilaterals[0]) > np.sum(bilaterals[3])
 
+    def test_compression(self) -> None:
+        """Feature compression test.
+
+        Compress a default feature stack with PCA: it should keep most of the (correlated) features' variance and
+        later stacks should reuse the saved projection until the session re-featurises uncompressed. A random
+        projection should give the same shape, and a forest should train on the compressed stack. Its download,
+        loaded as apply_classifier.py does, should predict the same on the full (uncompressed) stack.
+        """
+        rng = np.random.default_rng(8)
+        img = (rng.random((48, 48)) * 255).astype(np.uint8)
+        img[:, 24:] //= 4
+        feature_stack = ft.multiscale_advanced_features(img, ft.DEAFAULT_FEATURES, 1)
+        label = np.zeros((48, 48), dtype=np.uint8)
+        label[4:44, 4:12], label[4:44, 36:44] = 1, 2
+
+        with tempfile.TemporaryDirectory() as folder:
+            compressed = compress_features(folder, feature_stack, "pca", 8, refit=True)
+            projection = get_projection(folder)
+            assert compressed.shape == (48, 48, 8) and projection.n_components == 8
+            assert np.allclose(projection.components @ projection.components.T, np.eye(8), atol=1e-4)
+            assert explained_variance([feature_stack], projection) > 0.8
+            assert np.array_equal(compress_features(folder, feature_stack, None), compressed)
+
+            save_features(folder, 0, compressed)
+            _, model, _ = fb.segment_with_features([label], folder)
+            clear_training_set(folder)
+            assert model.n_features_in_ == 8
+
+            download_path = f"{folder}{sep}classifier.skops"
+            with open(download_path, "wb") as f:
+                f.write(encode_model(export_compressed_model(projection, model), ".skops"))
+            downloaded = load_classifier_from_file(download_path)
+            full_classes = downloaded.predict(feature_stack.reshape((-1, feature_stack.shape[-1])))
+            compressed_classes = model.predict(compressed.reshape((-1, 8)))
+            assert np.mean(full_classes == compressed_classes) > 0.99
+
+            assert compress_features(folder, feature_stack, "random", 8, refit=True).shape == (48, 48, 8)
+            assert np.array_equal(compress_features(folder, feature_stack, None, refit=True), feature_stack)
+            assert get_projection(folder) is None
+
+
+class TestTrainingData(unittest.TestCase):
+    """Test building training sets in forest_based.py."""
+
+    def test_class_weights_sparse(self) -> None:
+        """Class weights test.
+
+        Class ids needn't be 1..K - with classes 2 and 5 (ratio 3:1) the rarer class should be weighted 3x and
+        the frequencies should only include classes that are present.
+        """
+        target = np.array([2, 2, 2, 5] * 100)
+        weights, freqs = fb.get_class_weights(target)
+        assert freqs == [300, 100]
+        assert np.all(weights[target == 2] == 1)
+        assert np.all(weights[target == 5] == 3)
+
+    def test_stratified_sample(self) -> None:
+        """Stratified sampling test.
+
+        Sampling $n_points from sparse class ids should preserve class ratios, never repeat a point and keep
+        the fit and target rows aligned.
+        """
+        target = np.repeat(np.array([1, 4, 9]), [6000, 3000, 1000])
+        fit = np.arange(target.shape[0]).reshape((-1, 1)) * 10
+        sample_fit, sample_target = fb.sample_training_data(fit, target, 1000)
+        classes, counts = np.unique(sample_target, return_counts=True)
+        assert classes.tolist() == [1, 4, 9]
+        assert counts.tolist() == [600, 300, 100]
+        assert np.unique(sample_fit).shape[0] == sample_fit.shape[0]
+        assert np.all(target[sample_fit[:, 0] // 10] == sample_target)
+
+    def test_thinned_sample(self) -> None:
+        """Spatially thinned sampling test.
+
+        Thinning two solid labelled blocks should keep at most each class's share of points, spread over the
+        blocks (no two in the same grid cell) rather than clumped, with fit and target rows aligned. Labels over
+        more images than a class's share of points still give at most its share.
+        """
+        w = 100
+        label = np.zeros((100, w), dtype=np.uint8)
+        label[:60, :50], label[70:, 60:] = 1, 2
+        pixels = np.flatnonzero(label)
+        target = label.reshape(-1)[pixels]
+        fit = pixels.reshape((-1, 1)).astype(np.float32)
+        pixel_data = (np.zeros_like(pixels, dtype=np.int32), pixels)
+        for sampler in ["thinned", "diverse"]:
+            sample_fit, sample_target = fb.sample_training_data_with_sampler(
+                fit, target, 300, sampler, pixel_data, np.array([w])  # type: ignore
+            )
+            sampled = sample_fit[:, 0].astype(np.int64)
+            assert np.all(label.reshape(-1)[sampled] == sample_target)
+            assert np.unique(sampled).shape[0] == sampled.shape[0]
+            counts = np.bincount(sample_target, minlength=3)
+            assert 0 < counts[1] <= 300 * 3000 // 4200 and 0 < counts[2] <= 300 * 1200 // 4200
+            ys = sampled[sample_target == 1] // w
+            assert np.amax(ys) - np.amin(ys) > 40
+        with self.assertRaises(Exception):
+            fb.sample_training_data_with_sampler(fit, target, 300, "poisson", pixel_data, np.array([w]))  # type: ignore
+
+        # labels over more images than the class's share of points: still at most its share
+        n_imgs, side = 30, 4
+        img_idx = np.repeat(np.arange(n_imgs, dtype=np.int32), side * side)
+        pix_idx = np.tile(np.arange(side * side), n_imgs)
+        target = np.ones(n_imgs * side * side, dtype=np.uint8)
+        fit = np.arange(target.shape[0]).reshape((-1, 1)).astype(np.float32)
+        sample_fit, _ = fb.sample_training_data_with_sampler(
+            fit, target, 10, "thinned", (img_idx, pix_idx), np.full(n_imgs, side)  # type: ignore
+        )
+        assert sample_fit.shape[0] == 10 and np.unique(sample_fit).shape[0] == 10
+
+    def test_gather_training_data(self) -> None:
+        """Training data extraction test.
+
+        Save random feature stacks to a temp folder and label some of them. Gathering the labelled rows from the
+        (memory-mapped) stacks should give the same fit and target data as masking each full stack in turn.
+        """
+        rng = np.random.default_rng(0)
+        stacks = [rng.random((32, 48, 6), dtype=np.float32) for _ in range(3)]
+        labels = [np.zeros((32, 48), dtype=np.uint8) for _ in range(3)]
+        labels[0][4:8, 4:12] = 1
+        labels[2][10:20, 30:33] = 3
+        with tempfile.TemporaryDirectory() as folder:
+            for i, stack in enumerate(stacks):
+                save_features(folder, i, stack)
+            fit, target = fb.get_training_data_features_done(labels, folder)
+        expected_fit = np.concatenate([s.reshape((-1, 6))[lab.flatten() > 0] for s, lab in zip(stacks, labels)])
+        expected_target = np.concatenate([lab[lab > 0] for lab in labels])
+        assert np.array_equal(fit, expected_fit)
+        assert np.array_equal(target, expected_target)
+
+    def test_time_budgeted_fit(self) -> None:
+        """Time-budgeted training test.
+
+        Grow a forest within a (large) time budget, then fit a forest with the same number of trees and random
+        state in one go. As warm-started trees get the same seeds, the running OOB score should match sklearn's.
+        A tiny budget should still grow one batch of trees.
+        """
+        rng = np.random.default_rng(5)
+        X = rng.random((3000, 6), dtype=np.float32)
+        y = (X[:, 0] + 0.3 * rng.random(3000) > 0.6).astype(np.uint8) + 1
+        model = fb.get_model("FRF", max_depth=6)
+        model.set_params(random_state=0)
+        model, score = fb.fit_time_budgeted(model, X, y, None, 60000)
+        n_trees = len(model.estimators_)
+        assert fb.BUDGET_MIN_TREES <= n_trees <= fb.BUDGET_MAX_TREES
+
+        reference = fb.get_model("FRF", n_trees=n_trees, max_depth=6)
+        reference.set_params(random_state=0)
+        reference = fb.fit(reference, X, y, None)
+        assert isclose(score, reference.oob_score_, abs_tol=1e-9)
+
+        model, _ = fb.fit_time_budgeted(fb.get_model("FRF", max_depth=6), X, y, None, 0)
+        assert len(model.estimators_) == fb.BUDGET_BATCH_TREES
+
+    def test_validation_modes(self) -> None:
+        """Validation test.
+
+        A deferred OOB score computed after training (from a copy of the trees) should equal sklearn's OOB score,
+        and a holdout split should keep HOLDOUT_FRAC of the rows out of training.
+        """
+        rng = np.random.default_rng(6)
+        X = rng.random((2000, 4), dtype=np.float32)
+        y = (X[:, 0] + 0.3 * rng.random(2000) > 0.6).astype(np.uint8) + 1
+        model = fb.get_model("FRF", n_trees=30, max_depth=6)
+        model.set_params(random_state=0)
+        model = fb.fit(model, X, y, None)
+        deferred = compute_oob_score(list(model.estimators_), model.classes_, model.max_samples, X, y)
+        assert isclose(deferred, model.oob_score_, abs_tol=1e-9)
+
+        train_X, train_y, train_w, holdout_X, holdout_y = split_holdout(X, y, np.ones(2000))
+        assert holdout_y.shape[0] == int(2000 * HOLDOUT_FRAC) and train_X.shape[0] + holdout_X.shape[0] == 2000
+        assert train_w is not None and train_w.shape[0] == train_y.shape[0]
+
+    def test_deferred_score_cleared(self) -> None:
+        """Deferred score lifetime test.
+
+        Segmenting in "deferred" mode leaves a pending score for saving; a later "oob" segmentation must drop it,
+        so saving the newer segmentation (popping the score) doesn't stamp the old classifier's score onto it.
+        """
+        rng = np.random.default_rng(12)
+        stack = rng.random((32, 32, 4), dtype=np.float32)
+        label = np.zeros((32, 32), dtype=np.uint8)
+        label[2:30, 2:8], label[2:30, 24:30] = 1, 2
+        with tempfile.TemporaryDirectory() as folder:
+            save_features(folder, 0, stack)
+            _, _, score = fb.segment_with_features([label], folder, validation="deferred")
+            assert score is None
+            start_deferred(folder)
+            assert pop_deferred_score(folder) is not None
+
+            fb.segment_with_features([label], folder, validation="deferred")
+            start_deferred(folder)
+            _, _, oob_score = fb.segment_with_features([label], folder, validation="oob")
+            start_deferred(folder)
+            assert oob_score is not None and pop_deferred_score(folder) is None
+            clear_training_set(folder)
+
+    def test_incremental_policy(self) -> None:
+        """Incremental update policy test.
+
+        The fraction of trees replaced scales with the label change (clamped below), and a change of settings,
+        classes or forest parameters, a large change or too many updates in a row all need a full retrain.
+        """
+        rng = np.random.default_rng(3)
+        X = rng.random((400, 3), dtype=np.float32)
+        y = (X[:, 0] > 0.5).astype(np.uint8) + 1
+        n_trees = 20
+        forest = IncrementalForest()
+        template = fb.get_model("FRF", n_trees=n_trees)
+        assert forest.plan_update(template, y, 0.01) == -1
+        forest.set_model(fb.fit(fb.get_model("FRF", n_trees=n_trees), X, y, None), None, ("oob",))
+
+        assert forest.plan_update(template, y, 0, ("oob",)) == 0
+        assert forest.plan_update(template, y, 0.001, ("oob",)) == ceil(MIN_REPLACE_FRAC * n_trees)
+        assert forest.plan_update(template, y, 0.1, ("oob",)) == ceil(REPLACE_SCALE * 0.1 * n_trees)
+        assert forest.plan_update(template, y, FULL_RETRAIN_CHANGE_FRAC + 0.01, ("oob",)) == -1
+        assert forest.plan_update(template, y, 0.1, ("holdout",)) == -1
+        assert forest.plan_update(template, np.append(y, 3), 0.1, ("oob",)) == -1
+        assert forest.plan_update(fb.get_model("FRF", n_trees=n_trees, max_depth=4), y, 0.1, ("oob",)) == -1
+        forest.n_incremental_updates = MAX_INCREMENTAL_UPDATES
+        assert forest.plan_update(template, y, 0.1, ("oob",)) == -1
+
+    def test_incremental_segment(self) -> None:
+        """Incremental segmentation test.
+
+        A small label edit replaces some of the previous forest's trees in a new forest, leaving the previous one
+        untouched, and the incrementally updated probabilities match predicting with the updated forest. A
+        non-incremental segmentation forgets the forest, so it can't be updated (stale) when incremental is next turned
+        on.
+        """
+        rng = np.random.default_rng(5)
+        stack = rng.random((32, 32, 4), dtype=np.float32)
+        label = np.zeros((32, 32), dtype=np.uint8)
+        label[2:30, 2:8], label[2:30, 24:30] = 1, 2
+        with tempfile.TemporaryDirectory() as folder:
+            save_features(folder, 0, stack)
+            _, first, _ = fb.segment_with_features([label], folder, incremental=True)
+            n_trees = len(first.estimators_)
+            first_trees = list(first.estimators_)
+            label[2:6, 12:14] = 1
+            probs, model, _ = fb.segment_with_features([label], folder, incremental=True)
+            forest = get_incremental_forest(folder)
+            assert model is forest.model and forest.n_incremental_updates == 1
+            # the previous (registered) forest is left as it was
+            assert model is not first and first.estimators_ == first_trees and not first.warm_start
+            n_kept = sum(tree in first_trees for tree in model.estimators_)
+            assert 0 < n_kept < n_trees and len(model.estimators_) == n_trees
+            expected = model.predict_proba(stack.reshape((-1, 4))).T.reshape(probs[0].shape)
+            assert np.allclose(probs[0], expected, atol=1e-5)
+
+            fb.segment_with_features([label], folder, incremental=False)
+            assert get_incremental_forest(folder).model is None
+            clear_training_set(folder)
+            clear_incremental_forest(folder)
+
+    def test_incremental_vote_sums(self) -> None:
+        """Incremental prediction test.
+
+        Retire and replace k trees, twice: the cached vote sums updated with only the retired and new trees should
+        give the updated forest's predict_proba over every pixel of every image.
+        """
+        rng = np.random.default_rng(8)
+        stacks = [rng.random((24, 20, 3), dtype=np.float32), rng.random((16, 28, 3), dtype=np.float32)]
+        X = np.concatenate([stack.reshape((-1, 3)) for stack in stacks], axis=0)
+        y = (X[:, 0] > 0.5).astype(np.uint8) + (X[:, 1] > 0.6) + 1
+        forest = IncrementalForest()
+        forest.set_model(fb.fit(fb.get_model("FRF", n_trees=20), X[::3], y[::3], None), None)
+        with tempfile.TemporaryDirectory() as folder:
+            for i, stack in enumerate(stacks):
+                save_features(folder, i, stack)
+            forest.apply(folder, len(stacks), [], [])
+            for k, offset in ((5, 1), (7, 2)):
+                model, retired, added = forest.replace_trees(k, X[offset::3], y[offset::3], None)
+                assert len(retired) == len(added) == k
+                probs = forest.apply(folder, len(stacks), retired, added)
+                for stack, prob in zip(stacks, probs):
+                    expected = model.predict_proba(stack.reshape((-1, 3))).T.reshape(prob.shape)
+                    assert np.allclose(prob, expected, atol=1e-5)
+
+    def test_training_set_diff(self) -> None:
+        """Persistent training set test.
+
+        Add, relabel and erase strokes over several updates. After each, the training set's rows should match
+        gathering the training data from scratch (up to row order) and only the changed pixels should be counted.
+        """
+        rng = np.random.default_rng(1)
+        stacks = [rng.random((32, 48, 4), dtype=np.float32) for _ in range(2)]
+        labels = [np.zeros((32, 48), dtype=np.uint8) for _ in range(2)]
+
+        def _sorted_rows(fit: np.ndarray, target: np.ndarray) -> list:
+            return sorted(zip(map(tuple, fit.tolist()), target.tolist()))
+
+        with tempfile.TemporaryDirectory() as folder:
+            for i, stack in enumerate(stacks):
+                save_features(folder, i, stack)
+            training_set = TrainingSet(folder)
+            edits = [(0, slice(0, 10), 1), (1, slice(5, 9), 2), (0, slice(5, 15), 2), (0, slice(0, 4), 0)]
+            for img_idx, rows, class_val in edits:
+                labels[img_idx][rows, 10:20] = class_val
+                n_changed = training_set.update(labels)
+                assert n_changed > 0 and n_changed <= 10 * 10
+                fit, target = fb.get_training_data_features_done(labels, folder)
+                expected = _sorted_rows(fit, target)
+                assert _sorted_rows(training_set.fit_data, training_set.target_data) == expected
+            assert training_set.update(labels) == 0
+
+
+class TestCompiledForest(unittest.TestCase):
+    """Test flattened forest inference in compiled_forest.py against sklearn."""
+
+    def test_compiled_matches_sklearn(self) -> None:
+        """Compiled forest test.
+
+        Train a small forest on random data then predict with sklearn and with the compiled forest (both the
+        numba kernel, if installed, and the numpy fallback). Class maps should be identical and probabilities
+        equal up to float32 rounding.
+        """
+        rng = np.random.default_rng(2)
+        X = rng.random((3000, 8), dtype=np.float32)
+        y = (X[:, 0] + X[:, 1] > 1).astype(np.uint8) + 2 * (X[:, 2] > 0.7)
+        model = fb.get_model("FRF", n_trees=20, max_depth=6)
+        model = fb.fit(model, X[:2000], y[:2000], None)
+        expected = model.predict_proba(X)
+
+        compiled = cf.compile_forest(model)
+        probs = compiled.predict_proba(X, block_size=256)
+        fallback = np.zeros_like(probs)
+        cf._predict_blocks_numpy(
+            X, compiled.roots, compiled.feature, compiled.threshold, compiled.child, compiled.value,
+            compiled.max_depth, fallback, 256
+        )
+        fallback /= compiled.n_trees
+        for out in [probs, fallback]:
+            assert np.array_equal(np.argmax(out, axis=1), np.argmax(expected, axis=1))
+            assert np.allclose(out, expected, atol=1e-5)
+
+    def test_streaming_prediction(self) -> None:
+        """Streaming prediction test.
+
+        Predict a (h, w, N) feature stack in small blocks (with a ragged last block) and check class values and
+        uncertainties match predicting the whole image at once.
+        """
+        rng = np.random.default_rng(3)
+        X = rng.random((2000, 4), dtype=np.float32)
+        y = (X[:, 0] > 0.5).astype(np.uint8) + 1
+        model = fb.fit(fb.get_model("FRF", n_trees=10, max_depth=4), X, y, None)
+        feature_stack = rng.random((37, 23, 4), dtype=np.float32)
+
+        predictor = fb.get_predictor(model)
+        classes, uncertainty = fb.predict_image_streaming(predictor, model.classes_, feature_stack, 100)
+        probs = predictor(feature_stack.reshape((-1, 4)))
+        expected_classes = model.classes_[np.argmax(probs, axis=1)].reshape((37, 23))
+        expected_uncertainty = ((1 - np.amax(probs, axis=1)) * 255).astype(np.uint8).reshape((37, 23))
+        assert classes.dtype == np.uint8 and uncertainty.dtype == np.uint8
+        assert np.array_equal(classes, expected_classes)
+        assert np.array_equal(uncertainty, expected_uncertainty)
+
+    def test_uint8_postprocessing(self) -> None:
+        """uint8 class map and uncertainty test.
+
+        Class values from the class lookup table and uint8 uncertainties should match remapping through a one-hot
+        and computing the uncertainty in float64, for both (n_pixels, n_classes) and (n_classes, h, w) layouts.
+        """
+        rng = np.random.default_rng(9)
+        flat = rng.random((37 * 23, 4), dtype=np.float32)
+        flat /= np.sum(flat, axis=1, keepdims=True)
+        class_values = np.array([1, 2, 5, 7])
+
+        one_hot = np.eye(4)[np.argmax(flat, axis=1)]
+        expected_classes = np.max(one_hot * class_values, axis=-1).astype(np.uint8)
+        expected_uncertainty = (1 - np.amax(flat, axis=1).astype(np.float64)) * 255
+        for probs, axis in [(flat, 1), (flat.T.reshape((4, 37, 23)), 0)]:
+            classes, uncertainty = fb.probs_to_uint8(probs, class_values.astype(np.uint8), axis=axis)
+            assert classes.dtype == np.uint8 and uncertainty.dtype == np.uint8
+            assert np.array_equal(classes.ravel(), expected_classes)
+            assert np.all(np.abs(uncertainty.ravel() - expected_uncertainty) <= 1)
+
+    def test_dedup_prediction(self) -> None:
+        """Deduplicated prediction test.
+
+        A feature stack that's mostly one repeated (flat phase) row, plus forced hash collisions, should be
+        predicted exactly as without dedup whilst only predicting its distinct rows.
+        """
+        rng = np.random.default_rng(5)
+        X = rng.random((2000, 4), dtype=np.float32)
+        y = (X[:, 0] > 0.5).astype(np.uint8) + 1
+        model = fb.fit(fb.get_model("FRF", n_trees=10, max_depth=4), X, y, None)
+        flat = np.repeat(rng.random((1, 4), dtype=np.float32), 1000, axis=0)
+        flat[:50] = rng.random((50, 4), dtype=np.float32)
+
+        predictor = fb.get_predictor(model)
+        dedup_predictor = DedupPredictor(predictor, mantissa_bits=23)
+        assert np.array_equal(dedup_predictor(flat), predictor(flat))
+        assert dedup_predictor.n_predicted == 51 and dedup_predictor.n_rows == 1000
+
+        # every row colliding with the first: rows differing from it are predicted individually
+        with unittest.mock.patch("dedup.hash_rows", lambda q: np.zeros(q.shape[0], dtype=np.uint64)):
+            representatives, groups = unique_rows(flat, mantissa_bits=23)
+        assert np.array_equal(flat[representatives][groups], flat)
+
+    def test_early_exit(self) -> None:
+        """Early exit prediction test.
+
+        With delta=0 only pixels whose class can't change are frozen, so classes should match the full forest's
+        exactly whilst skipping trees; the numpy fallback should match the numba kernel, and a single batch of every
+        tree should equal predict_proba.
+        """
+        rng = np.random.default_rng(7)
+        X = rng.random((3000, 6), dtype=np.float32)
+        y = (X[:, 0] + X[:, 1] > 1).astype(np.uint8) + 1
+        model = fb.fit(fb.get_model("FRF", n_trees=64, max_depth=6), X[:2000], y[:2000], None)
+        compiled = cf.compile_forest(model)
+        expected = compiled.predict_proba(X)
+
+        predictor = cf.EarlyExitPredictor(compiled, delta=0)
+        probs = predictor(X)
+        assert np.array_equal(np.argmax(probs, axis=1), np.argmax(expected, axis=1))
+        assert predictor.n_rows == 3000 and predictor.saved_frac > 0
+
+        _, n_evaluated = compiled.predict_proba_early_exit(X, delta=1e-3)
+        fallback = np.zeros_like(probs)
+        fallback_evaluated = np.zeros(3000, dtype=np.int32)
+        cf._predict_blocks_early_exit_numpy(
+            X, compiled.roots, compiled.feature, compiled.threshold, compiled.child, compiled.value,
+            compiled.max_depth, compiled.exit_bounds(1e-3), cf.EARLY_EXIT_BATCH, fallback, fallback_evaluated, 256
+        )
+        assert np.array_equal(fallback_evaluated, n_evaluated)
+
+        full_batch, _ = compiled.predict_proba_early_exit(X, batch_trees=compiled.n_trees)
+        assert np.allclose(full_batch, expected, atol=1e-6)
+
+    def test_superpixel_segmentation(self) -> None:
+        """Superpixel mode test.
+
+        Over-segment a noisy two phase image, check region features and majority labels against a direct
+        computation, then segment in superpixel mode (with refined boundaries) and compare to per pixel with Dice.
+        Only the superpixel classifier is marked as taking region features, and the mark survives saving.
+        """
+        rng = np.random.default_rng(6)
+        phases = np.zeros((64, 64), dtype=np.uint8)
+        phases[:, 32:] = 1
+        img = (phases * 120 + 60 + rng.normal(0, 10, (64, 64))).clip(0, 255).astype(np.uint8)
+        label = np.zeros((64, 64), dtype=np.uint8)
+        label[4:60, 4:12], label[4:60, 52:60] = 1, 2
+
+        superpixels = compute_superpixels(img, region_pixels=16)
+        feature_stack = ft.multiscale_advanced_features(img, ft.DEAFAULT_FEATURES, 1)
+        features = region_features(feature_stack, superpixels)
+        region = superpixels == 5
+        assert np.allclose(features[5, 0], np.mean(feature_stack[region][:, 0]), rtol=1e-4)
+        assert np.allclose(features[5, feature_stack.shape[-1]], np.std(feature_stack[region][:, 0]), rtol=1e-3)
+        labelled, targets = region_targets(superpixels, label)
+        assert np.all(np.isin(np.unique(superpixels[label == 1]), labelled))
+        assert np.array_equal(targets, np.where(np.isin(labelled, superpixels[:, :12]), 1, 2))
+
+        with tempfile.TemporaryDirectory() as folder:
+            save_features(folder, 0, feature_stack)
+            save_superpixels(folder, 0, superpixels)
+            pixel_probs, pixel_model, _ = fb.segment_with_features([label], folder)
+            sp_probs, sp_model, _ = fb.segment_with_features(
+                [label], folder, superpixels=True, refine_boundaries=True
+            )
+            clear_training_set(folder)
+        pixel_seg = pixel_model.classes_[np.argmax(pixel_probs[0], axis=0)]
+        sp_seg = sp_model.classes_[np.argmax(sp_probs[0], axis=0)]
+        assert sp_model.n_features_in_ == 2 * feature_stack.shape[-1]
+        assert min(dice_scores(sp_seg, pixel_seg).values()) > 0.9
+        assert is_superpixel_model(sp_model) and not is_superpixel_model(pixel_model)
+        assert is_superpixel_model(skloads(skdumps(sp_model), trusted=SKOPS_TRUSTED_TYPES))
+
+    def test_feature_pruning(self) -> None:
+        """Feature pruning test.
+
+        Importance only on the Gaussian blur columns should switch off the other filters, and only on the smallest
+        sigma's columns should narrow the sigma range. Then prune a trained
+        forest: the rewritten feature stack should match featurising with the pruned features, and the pruned
+        model should predict like its forest on the kept columns. The pruned features should survive a restart and
+        the exported (downloadable) model should predict the same on the full requested stack.
+        """
+        rng = np.random.default_rng(7)
+        img = (rng.random((48, 48)) * 255).astype(np.uint8)
+        img[:, 24:] //= 4
+        label = np.zeros((48, 48), dtype=np.uint8)
+        label[4:44, 4:12], label[4:44, 36:44] = 1, 2
+        feature_dict = ft.DEAFAULT_FEATURES
+        feature_stack = ft.multiscale_advanced_features(img, feature_dict, 1)
+
+        gaussian_cols = computed_columns(feature_dict, {**feature_dict, "Sobel Filter": 0, "Hessian": 0})
+        importances = np.full(feature_stack.shape[-1], 1e-4)
+        importances[gaussian_cols] = 1
+        kept, pruned_dict, surviving = prune_features(importances, feature_dict)
+        assert np.array_equal(kept, gaussian_cols) and np.array_equal(surviving, gaussian_cols)
+        assert pruned_dict["Hessian"] == 0 and pruned_dict["Sobel Filter"] == 0
+        assert np.array_equal(ft.multiscale_advanced_features(img, pruned_dict, 1), feature_stack[:, :, surviving])
+        n_per_sigma = feature_stack.shape[-1] // 5
+        importances = np.full(feature_stack.shape[-1], 1e-4)
+        importances[:n_per_sigma] = 1
+        _, pruned_dict, surviving = prune_features(importances, feature_dict)
+        assert pruned_dict["Maximum Sigma"] == 1 and np.array_equal(surviving, np.arange(n_per_sigma))
+
+        with tempfile.TemporaryDirectory() as folder:
+            save_features(folder, 0, feature_stack)
+            assert get_features_to_compute(folder, feature_dict) == feature_dict
+            probs, model, _ = fb.segment_with_features([label], folder, prune=True)
+            pruned_stack = np.array(load_features(folder, 0))
+            session_features = get_features_to_compute(folder, feature_dict)
+            clear_training_set(folder)
+            clear_session_features(folder)
+        assert is_pruned_model(model)
+        assert np.array_equal(ft.multiscale_advanced_features(img, session_features, 1), pruned_stack)
+        flat = pruned_stack.reshape((-1, pruned_stack.shape[-1]))
+        expected = model.steps[-1][1].predict_proba(flat[:, get_kept_columns(model)])
+        assert np.allclose(fb.predict_proba(model, flat), expected, atol=1e-5)
+        assert np.allclose(probs[0].reshape((probs[0].shape[0], -1)).T, expected, atol=1e-5)
+
+        # smallest sigma only, so the stack is pruned to its first n_per_sigma columns
+        full_flat = feature_stack.reshape((-1, feature_stack.shape[-1]))
+        reduced_flat = full_flat[:, :n_per_sigma]
+        kept = np.arange(0, n_per_sigma, 2)
+        y = (full_flat[:, 0] > np.median(full_flat[:, 0])).astype(np.uint8) + 1
+        forest = fb.fit(fb.get_model("FRF", n_trees=10), reduced_flat[::4, kept], y[::4], None)
+        pruned_model = make_pruned_model(kept, n_per_sigma, forest)
+        with tempfile.TemporaryDirectory() as folder:
+            get_features_to_compute(folder, feature_dict)
+            set_pruned_features(folder, pruned_dict)
+            # i.e a restart: the pruned features are loaded from the user folder
+            clear_session_features(folder)
+            assert get_features_to_compute(folder, feature_dict) == pruned_dict
+            exported = export_model(folder, pruned_model)
+            clear_session_features(folder)
+        assert exported.steps[0][1].n_features_in_ == feature_stack.shape[-1]
+        assert np.array_equal(exported.predict_proba(full_flat), pruned_model.predict_proba(reduced_flat))
+
+    def test_binned_booster(self) -> None:
+        """Binned gradient boosting test.
+
+        Fit session bins on a cached feature stack, train the "LGBM" booster on the uint8 bin codes and check the
+        compiled booster matches the pipeline's own predictions, before and after a skops round trip. The bins
+        should be reused until the features change.
+        """
+        rng = np.random.default_rng(4)
+        stack = rng.random((40, 50, 5), dtype=np.float32)
+        flat = stack.reshape((-1, 5))
+        y = (flat[:, 0] > 0.5).astype(np.uint8) + (flat[:, 1] > 0.7) + 1
+        with tempfile.TemporaryDirectory() as folder:
+            save_features(folder, 0, stack)
+            binner = get_binner(folder, 1)
+            assert get_binner(folder, 1) is binner
+            codes = bin_features(binner, flat)
+            assert codes.dtype == np.uint8
+            booster = fb.fit(fb.get_model("LGBM", n_trees=20), codes, y, None)
+            model = make_binned_model(binner, booster)
+            loaded = skloads(skdumps(model), trusted=SKOPS_TRUSTED_TYPES)
+            expected = model.predict_proba(flat)
+            for m in [model, loaded]:
+                probs = CompiledBooster(m).predict_proba(flat)
+                assert np.array_equal(np.argmax(probs, axis=1), np.argmax(expected, axis=1))
+                assert np.allclose(probs, expected, atol=1e-5)
+            save_features(folder, 0, stack + 1)
+            assert get_binner(folder, 1) is not binner
+            clear_binner(folder)
+
+    def test_pipelined_apply(self) -> None:
+        """Pipelined apply test.
+
+        Predict a stack of cached feature stacks with several workers and a memory budget smaller than one
+        stack, with later images finishing first. Results should still come back in image order.
+        """
+        stacks = [np.full((8, 8, 2), i, dtype=np.float32) for i in range(6)]
+
+        def _predict(feature_stack: np.ndarray) -> float:
+            time.sleep(0.01 * (6 - feature_stack[0, 0, 0]))
+            return float(feature_stack[0, 0, 0])
+
+        with tempfile.TemporaryDirectory() as folder:
+
+            def _load(idx: int) -> np.ndarray:
+                return np.asarray(load_features(folder, idx))
+
+            for i, stack in enumerate(stacks):
+                save_features(folder, i, stack)
+            for n_workers, budget in [(1, 1), (3, 1), (3, 2**20)]:
+                out = list(fb.pipeline_images(folder, len(stacks), _load, _predict, n_workers, budget))
+                assert out == [float(i) for i in range(6)]
+
+
+class TestModelRegistry(unittest.TestCase):
+    """Test in-memory classifier registry in model_registry.py."""
+
+    def test_lru_eviction(self) -> None:
+        """LRU eviction test.
+
+        With room for two models, registering a third evicts the least recently used. Every dirty classifier is
+        written to disk in the background (see artifacts.py), so it's still there after a restart. A stale version
+        is a miss and a miss loads (and registers) the model.
+        """
+        rng = np.random.default_rng(7)
+        X = rng.random((500, 3), dtype=np.float32)
+        y = (X[:, 0] > 0.5).astype(np.uint8) + 1
+        model = fb.fit(fb.get_model("FRF", n_trees=5, max_depth=4), X, y, None)
+        nbytes = estimate_model_nbytes(model)
+        assert nbytes > 0
+
+        with tempfile.TemporaryDirectory() as folder:
+            registry = ModelRegistry(max_bytes=2 * nbytes)
+            entry_a = registry.put("a", model, folder)
+            registry.put("b", model, folder)
+            assert registry.get("a", None) is entry_a
+            registry.put("c", model, folder)
+            for UID in ("a", "b", "c"):
+                wait_for_artifacts(UID, ["classifier"])
+            assert os.path.exists(get_classifier_path(folder)) and os.path.exists(get_classifier_path(folder, ".pkl"))
+            version = get_file_signature(get_classifier_path(folder))
+            assert registry.get("b", version) is None
+            assert registry.get("a", entry_a.version) is entry_a and registry.nbytes == 2 * nbytes
+            # after a restart the classifier is loaded from disk
+            restarted = ModelRegistry().get_or_load("c", folder, lambda path: skload(path))
+            assert np.array_equal(restarted.model.predict_proba(X), model.predict_proba(X))
+
+            registry.put("a", model, folder, version)
+            assert registry.get("a", (0, 0, 0)) is None
+            entry = registry.get_or_load("a", folder, lambda path: skload(path))
+            assert registry.get("a", version) is entry and not entry.dirty
+
+    def test_modified_model(self) -> None:
+        """Registered model ownership test.
+
+        A registered classifier whose trees are changed in place (rather than updating a copy) fails to write
+        instead of saving a torn classifier.
+        """
+        rng = np.random.default_rng(7)
+        X = rng.random((500, 3), dtype=np.float32)
+        y = (X[:, 0] > 0.5).astype(np.uint8) + 1
+        model = fb.fit(fb.get_model("FRF", n_trees=5, max_depth=4), X, y, None)
+
+        with tempfile.TemporaryDirectory() as folder:
+            entry = RegistryEntry(model, folder, None)
+            model.estimators_ = model.estimators_[1:]
+            with self.assertRaises(Exception):
+                entry.write()
+            assert entry.dirty and not os.path.exists(get_classifier_path(folder))
+
+    def test_lazy_encoding(self) -> None:
+        """Lazy serialization test.
+
+        A dirty classifier's encoding is cached when its bytes are asked for, it round trips, and the classifier is
+        written to disk in the background.
+        """
+        rng = np.random.default_rng(7)
+        X = rng.random((500, 3), dtype=np.float32)
+        y = (X[:, 0] > 0.5).astype(np.uint8) + 1
+        model = fb.fit(fb.get_model("FRF", n_trees=5, max_depth=4), X, y, None)
+
+        with tempfile.TemporaryDirectory() as folder:
+            registry = ModelRegistry()
+            entry = registry.put("a", model, folder)
+            skops_bytes = registry.get_bytes("a", folder, ".skops")
+            assert registry.get_bytes("a", folder, ".skops") is skops_bytes
+            wait_for_artifacts("a", ["classifier"])
+            assert not entry.dirty and entry.encode(".skops") is skops_bytes
+            assert registry.nbytes == estimate_model_nbytes(model) + sum(len(b) for b in entry.encoded.values())
+            loaded = skloads(skops_bytes)
+            assert np.array_equal(loaded.predict_proba(X), model.predict_proba(X))
+            written = skload(get_classifier_path(folder))
+            assert np.array_equal(written.predict_proba(X), model.predict_proba(X))
+
+    def test_distillation(self) -> None:
+        """Distillation test.
+
+        Distill a forest trained on a two phase feature stack: the student should agree with it and, once attached,
+        be written and loaded alongside it. It can't be attached once the classifier's been registered again.
+        """
+        rng = np.random.default_rng(9)
+        stack = rng.random((60, 60, 4), dtype=np.float32)
+        flat = stack.reshape((-1, 4))
+        y = (flat[:, 0] > 0.5).astype(np.uint8) + 1
+        model = fb.fit(fb.get_model("FRF", n_trees=20), flat[::4], y[::4], None)
+
+        with tempfile.TemporaryDirectory() as folder:
+            save_features(folder, 0, stack)
+            student, score = distill(model, folder, 1)
+            assert student is not None and score >= DISTILL_AGREEMENT
+            assert len(student.estimators_) == DISTILL_TREES
+            assert np.mean(student.predict(flat) == model.predict(flat)) >= DISTILL_AGREEMENT
+
+            registry = ModelRegistry()
+            old_token = registry.put("a", model, folder).token
+            # the same classifier object registered again (i.e updated since) is a different registration
+            token = registry.put("a", model, folder).token
+            assert not registry.attach_distilled("a", old_token, student)
+            assert registry.attach_distilled("a", token, student)
+            wait_for_artifacts("a", ["classifier"])
+            assert os.path.exists(get_classifier_path(folder, ".skops", distilled=True))
+            entry = ModelRegistry().get_or_load("a", folder, lambda path: skload(path))
+            assert np.array_equal(entry.distilled.predict_proba(flat), student.predict_proba(flat))
+
+
+class TestArtifacts(unittest.TestCase):
+    """Test background artifact writer in artifacts.py."""
+
+    def test_coalescing(self) -> None:
+        """Coalescing test.
+
+        Whilst the worker is busy, queueing two writes of the same artifact only runs the latest, and waiting for
+        a user's artifacts returns once it's written.
+        """
+        release = threading.Event()
+        written: List[str] = []
+        queue_artifact("blocker", "seg", release.wait)
+        queue_artifact("a", "seg", lambda: written.append("old"))
+        queue_artifact("a", "seg", lambda: written.append("new"))
+        queue_artifact("a", "labels", lambda: written.append("labels"))
+        assert written == []
+        release.set()
+        wait_for_artifacts("a")
+        assert written == ["new", "labels"]
+
+
+class TestResponseBuffer(unittest.TestCase):
+    """Test preallocated response body in responses.py."""
+
+    def test_layout(self) -> None:
+        """Response layout test.
+
+        Writing images of different sizes into the buffer then joining its chunks should give every image's
+        flattened uncertainties followed by every image's flattened class values.
+        """
+        rng = np.random.default_rng(10)
+        img_dims = [(13, 7), (20, 20), (1, 5)]
+        imgs = [
+            (rng.integers(0, 4, dims, dtype=np.uint8), rng.integers(0, 256, dims, dtype=np.uint8)) for dims in img_dims
+        ]
+        body = ResponseBuffer(img_dims)
+        for i, (classes, uncertainties) in enumerate(imgs):
+            class_view = body.write(i, classes, uncertainties)
+            assert np.array_equal(class_view, classes)
+        expected = b"".join(u.tobytes() for _, u in imgs) + b"".join(c.tobytes() for c, _ in imgs)
+        assert b"".join(body.chunks(chunk_bytes=64)) == expected and body.nbytes == len(expected)
+
+    def test_frames(self) -> None:
+        """Streamed frames test.
+
+        Encoding images of different sizes (out of order, as they'd finish) as frames then decoding the body should
+        give back each image's index, class values and uncertainties. A truncated body, or one where prediction
+        failed part way, should raise when decoded.
+        """
+        rng = np.random.default_rng(11)
+        results = [
+            (i, rng.integers(0, 4, dims, dtype=np.uint8), rng.integers(0, 256, dims, dtype=np.uint8))
+            for i, dims in [(1, (9, 4)), (0, (3, 17))]
+        ]
+        decoded = list(decode_frames(b"".join(encode_frames(iter(results)))))
+        assert len(decoded) == 2
+        for (i, classes, uncertainties), (j, decoded_classes, decoded_uncertainties) in zip(results, decoded):
+            assert i == j
+            assert np.array_equal(classes, decoded_classes) and np.array_equal(uncertainties, decoded_uncertainties)
+
+        body = b"".join(encode_frames(iter(results)))
+        with self.assertRaises(Exception):
+            list(decode_frames(body[:-FRAME_HEADER.size]))
+
+        def _failing() -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+            yield results[0]
+            raise Exception("prediction failed")
+
+        decoded_frames = decode_frames(b"".join(encode_frames(_failing())))
+        assert next(decoded_frames)[0] == results[0][0]
+        with self.assertRaisesRegex(Exception, "prediction failed"):
+            next(decoded_frames)
+
+    def test_stream_apply(self) -> None:
+        """Streamed apply test.
+
+        Applying a classifier to a stack streamed frame by frame should give the same class values and uncertainties
+        as the buffered response body.
+        """
+        rng = np.random.default_rng(12)
+        stacks = [rng.random((20, 24, 4), dtype=np.float32) for _ in range(3)]
+        X = np.concatenate([stack.reshape((-1, 4)) for stack in stacks], axis=0)
+        y = (X[:, 0] > 0.5).astype(np.uint8) + (X[:, 1] > 0.7) + 1
+        model = fb.fit(fb.get_model("FRF", n_trees=20), X[::5], y[::5], None)
+        img_dims = [(20, 24)] * len(stacks)
+        # in the app folder, as apply finds the classifier and saves the segmentation there
+        with tempfile.TemporaryDirectory(dir=seg.CWD) as folder:
+            UID = os.path.basename(folder)
+            for i, stack in enumerate(stacks):
+                save_features(UID, i, stack)
+            MODEL_REGISTRY.put(UID, model, folder)
+            body = asyncio.run(seg.apply(img_dims, UID, "stack"))
+            frames = list(decode_frames(b"".join(encode_frames(seg.stream_apply(img_dims, UID, "stack")))))
+            wait_for_artifacts(UID)
+            MODEL_REGISTRY.forget(UID)
+        assert [i for i, _, _ in frames] == list(range(len(stacks)))
+        for i, classes, uncertainties in frames:
+            start, end = body.offsets[i], body.offsets[i + 1]
+            assert np.array_equal(classes.reshape(-1), body.classes[start:end])
+            assert np.array_equal(uncertainties.reshape(-1), body.uncertainties[start:end])
+
+
+class TestHITL(unittest.TestCase):
+    """Test uncertain region suggestion in HITL.py."""
+
+    def test_suggest_regions(self) -> None:
+        """Region suggestion test.
+
+        Integral image window sums should match summing each window directly. Over a stack with an uncertain
+        square in one image and an uncertain bottom right corner in another, the square should be suggested first
+        as one larger window, the corner should be found, and no two suggestions in the same image should overlap.
+        """
+        rng = np.random.default_rng(8)
+        arr = rng.random((40, 50))
+        sums = window_sums(integral_image(arr), 7, 9)
+        direct = np.array([[np.sum(arr[y : y + 7, x : x + 9]) for x in range(42)] for y in range(34)])
+        assert np.allclose(sums, direct)
+
+        maps = [(rng.random((300, 301)) * 50).astype(np.uint8) for _ in range(3)]
+        maps[1][100:200, 40:140] = 255
+        maps[2][-20:, -20:] = 255
+        suggestions = suggest_regions(maps, k=6, sizes=(16, 32, 64))
+        img_idx, x0, y0, w, h, score = suggestions[0]
+        assert (img_idx, w, h, score) == (1, 64, 64, 1.0)
+        assert 40 <= x0 <= 76 and 100 <= y0 <= 136
+        assert any(s[0] == 2 and s[1] >= 281 and s[2] >= 280 for s in suggestions)
+        for i, a in enumerate(suggestions):
+            for b in suggestions[i + 1 :]:
+                disjoint = a[1] + a[3] <= b[1] or b[1] + b[3] <= a[1] or a[2] + a[4] <= b[2] or b[2] + b[4] <= a[2]
+                assert a[0] != b[0] or disjoint
+
 
 def weka_dog_per_sigma(sigma: int) -> int:
     """Get number of DoGs at given length scale when iterating through each filter.
@@ -0,0 +1,218 @@
+"""Persistent per-session training sets.
+
+Every segment request sends the full label arrays of every image, even if the user only added one stroke.
+Rather than re-gathering every labelled row from the cached features each time, keep the (pixel index,
+features, label) rows of each user between calls. New label arrays are diffed against the previous ones and
+only the changed pixels are added, removed or relabelled, so assembling the training data costs time
+proportional to the edit.
+
+Rows live in one growable buffer (capacity doubles, so appends are amortised O(1)) and removals swap rows
+in from the tail, so the training data is always the contiguous first $n_rows rows and needs no copying.
+"""
+import numpy as np
+from threading import Lock
+from typing import Dict, List, Tuple
+
+from file_handling import get_features_signature, load_features
+
+MIN_CAPACITY = 1024
+
+
+class TrainingSet:
+    """Labelled rows of one user's images, kept in sync with their labels via diffs."""
+
+    def __init__(self, folder_name: str) -> None:
+        """Create empty training set for the features cached in $folder_name.
+
+        :param folder_name: user data folder where features are cached
+        :type folder_name: str
+        """
+        self.folder_name = folder_name
+        self.lock = Lock()
+        self.reset()
+
+    @property
+    def fit_data(self) -> np.ndarray:
+        """Flat fit data (feature vectors of all labelled pixels). A view, so copy before releasing the lock."""
+        return self._fit[: self.n_rows]
+
+    @property
+    def target_data(self) -> np.ndarray:
+        """Flat target data (class values of all labelled pixels). A view, like fit_data."""
+        return self._target[: self.n_rows]
+
+    @property
+    def pixel_data(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Tuple of (image index, flat pixel index) of each row."""
+        return self._img[: self.n_rows], self._pix[: self.n_rows]
+
+    def reset(self) -> None:
+        """Forget all rows and labels."""
+        self.n_rows = 0
+        self.n_feat = -1
+        self._fit = np.empty((0, 0), dtype=np.float32)
+        self._target = np.empty((0,), dtype=np.int64)
+        self._img = np.empty((0,), dtype=np.int32)
+        self._pix = np.empty((0,), dtype=np.int64)
+        # per image: last seen flat labels, map of flat pixel -> row (-1 if unlabelled) and features signature
+        self._labels: Dict[int, np.ndarray] = {}
+        self._row_of: Dict[int, np.ndarray] = {}
+        self._signatures: Dict[int, Tuple[int, int, int]] = {}
+
+    def update(self, labels: List[np.ndarray], _rebuilding: bool = False) -> int:
+        """Diff $labels against the previous labels of each image and add/remove/relabel rows of changed pixels.
+
+        Images whose cached features have changed since their rows were gathered (re-featurised or
+        renamed after a delete) are dropped and re-gathered in full.
+
+        :param labels: list of (HxW) label arrs, 0=unlabelled, 1,2,3,... are classes
+        :type labels: List[np.ndarray]
+        :return: number of pixels whose label changed
+        :rtype: int
+        """
+        for i in [i for i in self._labels if i >= len(labels)]:
+            self.drop_image(i)
+
+        n_changed = 0
+        for i, label in enumerate(labels):
+            flat_labels = label.reshape(-1)
+            prev_labels = self._labels.get(i)
+            if prev_labels is not None:
+                stale_features = self._signatures[i] != get_features_signature(self.folder_name, i)
+                if prev_labels.shape != flat_labels.shape or stale_features:
+                    self.drop_image(i)
+                    prev_labels = None
+            if prev_labels is None:
+                if not np.any(flat_labels):
+                    continue
+                prev_labels = np.zeros_like(flat_labels)
+                self._row_of[i] = np.full(flat_labels.shape[0], -1, dtype=np.int64)
+                self._signatures[i] = get_features_signature(self.folder_name, i)
+
+            changed = np.flatnonzero(flat_labels != prev_labels)
+            self._labels[i] = flat_labels.copy()
+            if changed.shape[0] == 0:
+                continue
+            n_changed += changed.shape[0]
+            old, new = prev_labels[changed], flat_labels[changed]
+
+            self._remove_rows(self._row_of[i][changed[(old != 0) & (new == 0)]])
+            relabelled = changed[(old != 0) & (new != 0)]
+            self._target[self._row_of[i][relabelled]] = flat_labels[relabelled]
+            added = changed[(old == 0) & (new != 0)]
+            if added.shape[0] > 0 and not self._append_rows(i, added, flat_labels[added]):
+                if _rebuilding:
+                    raise Exception("cached feature stacks have different numbers of features")
+                # feature count changed (i.e user changed features) so every row is stale: start again
+                self.reset()
+                return self.update(labels, _rebuilding=True)
+        return n_changed
+
+    def drop_image(self, idx: int) -> None:
+        """Remove every row and the stored labels of image $idx.
+
+        :param idx: image index
+        :type idx: int
+        """
+        row_of = self._row_of.get(idx)
+        if row_of is not None:
+            self._remove_rows(row_of[row_of >= 0])
+            del self._row_of[idx]
+        self._labels.pop(idx, None)
+        self._signatures.pop(idx, None)
+
+    def _append_rows(self, idx: int, pixels: np.ndarray, targets: np.ndarray) -> bool:
+        """Gather features of $pixels of image $idx from the (memory-mapped) cache and append them as rows.
+
+        :return: False if the features have a different number of channels to the existing rows
+        :rtype: bool
+        """
+        feature_stack = load_features(self.folder_name, idx)
+        h, w, feat = feature_stack.shape
+        if self.n_rows > 0 and feat != self.n_feat:
+            return False
+        if self.n_feat != feat or self._fit.dtype != feature_stack.dtype:
+            self._fit = np.empty((0, feat), dtype=feature_stack.dtype)
+            self.n_feat = feat
+        if self.n_rows == 0 and self._target.dtype != targets.dtype:
+            self._target = np.empty((self._fit.shape[0],), dtype=targets.dtype)
+
+        k = pixels.shape[0]
+        self._reserve(self.n_rows + k)
+        start, end = self.n_rows, self.n_rows + k
+        np.take(feature_stack.reshape((h * w, feat)), pixels, axis=0, out=self._fit[start:end])
+        self._target[start:end] = targets
+        self._img[start:end] = idx
+        self._pix[start:end] = pixels
+        self._row_of[idx][pixels] = np.arange(start, end)
+        self.n_rows = end
+        return True
+
+    def _reserve(self, n_needed: int) -> None:
+        """Grow row buffers (by doubling) so they can hold at least $n_needed rows."""
+        capacity = self._fit.shape[0]
+        if n_needed <= capacity:
+            return
+        new_capacity = max(2 * capacity, n_needed, MIN_CAPACITY)
+        n = self.n_rows
+        fit = np.empty((new_capacity, self.n_feat), dtype=self._fit.dtype)
+        fit[:n] = self._fit[:n]
+        self._fit = fit
+        for name in ["_target", "_img", "_pix"]:
+            old: np.ndarray = getattr(self, name)
+            new = np.empty((new_capacity,), dtype=old.dtype)
+            new[:n] = old[:n]
+            setattr(self, name, new)
+
+    def _remove_rows(self, rows: np.ndarray) -> None:
+        """Remove $rows by moving surviving rows from the tail into the holes they leave. O(len(rows)).
+
+        :param rows: (unique) row indices to remove
+        :type rows: np.ndarray
+        """
+        k = rows.shape[0]
+        if k == 0:
+            return
+        for idx in np.unique(self._img[rows]):
+            in_img = self._img[rows] == idx
+            self._row_of[int(idx)][self._pix[rows[in_img]]] = -1
+
+        n_new = self.n_rows - k
+        holes = rows[rows < n_new]
+        tail = np.arange(n_new, self.n_rows)
+        movers = tail[~np.isin(tail, rows)]
+        self._fit[holes] = self._fit[movers]
+        for arr in [self._target, self._img, self._pix]:
+            arr[holes] = arr[movers]
+        for idx in np.unique(self._img[holes]):
+            in_img = self._img[holes] == idx
+            self._row_of[int(idx)][self._pix[holes[in_img]]] = holes[in_img]
+        self.n_rows = n_new
+
+
+_TRAINING_SETS: Dict[str, TrainingSet] = {}
+_REGISTRY_LOCK = Lock()
+
+
+def get_training_set(UID: str) -> TrainingSet:
+    """Get (or create) the persistent training set of user $UID, whose features are cached in folder $UID.
+
+    :param UID: user ID
+    :type UID: str
+    :return: the user's training set
+    :rtype: TrainingSet
+    """
+    with _REGISTRY_LOCK:
+        if UID not in _TRAINING_SETS:
+            _TRAINING_SETS[UID] = TrainingSet(UID)
+        return _TRAINING_SETS[UID]
+
+
+def clear_training_set(UID: str) -> None:
+    """Forget training set of user $UID, i.e when their data folder is deleted.
+
+    :param UID: user ID
+    :type UID: str
+    """
+    with _REGISTRY_LOCK:
+        _TRAINING_SETS.pop(UID, None)
@@ -0,0 +1,213 @@
+"""Validation scores of trained classifiers.
+
+Scoring a random forest on its out-of-bag (OOB) samples costs about as much as predicting every training sample
+again, for a number most users never look at. The /segmenting request picks a validation mode:
+    - "none": no score
+    - "oob": sklearn's OOB score, computed during training (the previous behaviour)
+    - "holdout": train on all but a small held out fraction of the (shuffled) training rows, score on those
+    - "deferred": train without scoring, then compute the OOB score in a background thread once the response
+      has been sent. It's only waited for when the user downloads the segmentation (whose tiff stores it).
+
+OOB scores here are computed from running sums of each tree's votes on its own out-of-bag rows, so they equal
+sklearn's oob_score_ and can be updated a few trees at a time (see forest_based.fit_time_budgeted()).
+"""
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from sklearn.ensemble._forest import _generate_unsampled_indices, _get_n_samples_bootstrap
+from typing import Callable, Dict, List, Literal, Tuple, TypeAlias
+
+ValidationMode: TypeAlias = Literal["none", "oob", "holdout", "deferred"]
+VALIDATION_MODES: List[str] = ["none", "oob", "holdout", "deferred"]
+
+HOLDOUT_FRAC = 0.1
+MAX_HOLDOUT_ROWS = 5000
+# max time to wait for a deferred score when saving
+DEFERRED_TIMEOUT_S = 60
+
+
+def check_validation_mode(mode: str) -> ValidationMode:
+    """Raise if $mode isn't a known validation mode.
+
+    :param mode: validation mode from the request
+    :type mode: str
+    :return: $mode
+    :rtype: ValidationMode
+    """
+    if mode not in VALIDATION_MODES:
+        raise Exception(f"unknown validation mode {mode}, must be one of {VALIDATION_MODES}")
+    return mode  # type: ignore
+
+
+def add_oob_votes(trees: List, fit_data: np.ndarray, oob_votes: np.ndarray, max_samples: int | float | None) -> None:
+    """Add class probabilities of each tree in $trees on its out-of-bag (not bootstrapped) rows to $oob_votes.
+
+    :param trees: fitted trees of a forest (trained on $fit_data)
+    :type trees: List
+    :param fit_data: flat fit data the forest was trained on
+    :type fit_data: np.ndarray
+    :param oob_votes: (n_samples, n_classes) arr of running vote sums, updated in place
+    :type oob_votes: np.ndarray
+    :param max_samples: forest's max_samples parameter
+    :type max_samples: int | float | None
+    """
+    n_samples = fit_data.shape[0]
+    n_samples_bootstrap = _get_n_samples_bootstrap(n_samples, max_samples)
+    for tree in trees:
+        unsampled = _generate_unsampled_indices(tree.random_state, n_samples, n_samples_bootstrap)
+        oob_votes[unsampled] += tree.predict_proba(fit_data[unsampled], check_input=False)
+
+
+def oob_accuracy(oob_votes: np.ndarray, classes: np.ndarray, target_data: np.ndarray) -> float:
+    """Accuracy of the OOB votes over samples that were out-of-bag for at least one tree.
+
+    :param oob_votes: (n_samples, n_classes) arr of vote sums, from add_oob_votes()
+    :type oob_votes: np.ndarray
+    :param classes: class values of the forest (forest.classes_)
+    :type classes: np.ndarray
+    :param target_data: flat target data
+    :type target_data: np.ndarray
+    :return: OOB accuracy
+    :rtype: float
+    """
+    has_votes = np.any(oob_votes > 0, axis=1)
+    if not np.any(has_votes):
+        return 0.0
+    predicted = classes[np.argmax(oob_votes[has_votes], axis=1)]
+    return float(np.mean(predicted == target_data[has_votes]))
+
+
+def compute_oob_score(
+    trees: List, classes: np.ndarray, max_samples: int | float | None, fit_data: np.ndarray, target_data: np.ndarray
+) -> float:
+    """OOB score of a forest trained without oob_score, i.e in the background for "deferred" validation.
+
+    :param trees: fitted trees of the forest (a copy of forest.estimators_, so later updates don't affect it)
+    :type trees: List
+    :param classes: class values of the forest
+    :type classes: np.ndarray
+    :param max_samples: forest's max_samples parameter
+    :type max_samples: int | float | None
+    :param fit_data: flat fit data the forest was trained on
+    :type fit_data: np.ndarray
+    :param target_data: flat target data the forest was trained on
+    :type target_data: np.ndarray
+    :return: OOB accuracy
+    :rtype: float
+    """
+    oob_votes = np.zeros((fit_data.shape[0], len(classes)), dtype=np.float64)
+    add_oob_votes(trees, fit_data, oob_votes, max_samples)
+    return oob_accuracy(oob_votes, classes, target_data)
+
+
+def split_holdout(
+    fit_data: np.ndarray, target_data: np.ndarray, weights: np.ndarray | None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray | None, np.ndarray, np.ndarray]:
+    """Hold out the last HOLDOUT_FRAC (at most MAX_HOLDOUT_ROWS) rows of *already shuffled* training data.
+
+    :param fit_data: flat (shuffled) fit data
+    :type fit_data: np.ndarray
+    :param target_data: flat (shuffled) target data
+    :type target_data: np.ndarray
+    :param weights: flat weights arr
+    :type weights: np.ndarray | None
+    :return: tuple of fit data, target data and weights to train on, then held out fit and target data
+    :rtype: Tuple[np.ndarray, np.ndarray, np.ndarray | None, np.ndarray, np.ndarray]
+    """
+    n = target_data.shape[0]
+    n_holdout = min(int(n * HOLDOUT_FRAC), MAX_HOLDOUT_ROWS)
+    n_train = n - n_holdout
+    train_weights = None if weights is None else weights[:n_train]
+    return fit_data[:n_train], target_data[:n_train], train_weights, fit_data[n_train:], target_data[n_train:]
+
+
+def holdout_accuracy(probs: np.ndarray, classes: np.ndarray, target_data: np.ndarray) -> float | None:
+    """Accuracy of predicted class probabilities $probs on held out rows.
+
+    :param probs: (n_holdout, n_classes) arr of predicted class probabilities
+    :type probs: np.ndarray
+    :param classes: class values of the model (model.classes_)
+    :type classes: np.ndarray
+    :param target_data: held out target data
+    :type target_data: np.ndarray
+    :return: accuracy, or None if nothing was held out
+    :rtype: float | None
+    """
+    if target_data.shape[0] == 0:
+        return None
+    return float(np.mean(classes[np.argmax(probs, axis=1)] == target_data))
+
+
+class DeferredScore:
+    """A score function to be run in the background after the response is sent, and its result."""
+
+    def __init__(self, score_fn: Callable[[], float]) -> None:
+        """Store (unstarted) $score_fn.
+
+        :param score_fn: function computing the score
+        :type score_fn: Callable[[], float]
+        """
+        self.score_fn = score_fn
+        self.future: Future | None = None
+
+
+# single worker so background scoring never takes more than one core from interactive requests
+_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+_DEFERRED: Dict[str, DeferredScore] = {}
+_REGISTRY_LOCK = Lock()
+
+
+def defer_score(UID: str, score_fn: Callable[[], float]) -> None:
+    """Register $score_fn as the pending score of user $UID's latest classifier, replacing any previous one.
+
+    :param UID: user ID
+    :type UID: str
+    :param score_fn: function computing the score, run by start_deferred()
+    :type score_fn: Callable[[], float]
+    """
+    with _REGISTRY_LOCK:
+        _DEFERRED[UID] = DeferredScore(score_fn)
+
+
+def start_deferred(UID: str) -> None:
+    """Start computing user $UID's pending score in the background (if there is one and it hasn't started).
+
+    :param UID: user ID
+    :type UID: str
+    """
+    with _REGISTRY_LOCK:
+        deferred = _DEFERRED.get(UID)
+        if deferred is not None and deferred.future is None:
+            deferred.future = _EXECUTOR.submit(deferred.score_fn)
+
+
+def pop_deferred_score(UID: str, timeout: float = DEFERRED_TIMEOUT_S) -> float | None:
+    """Wait for (starting if needed) then forget user $UID's pending score.
+
+    :param UID: user ID
+    :type UID: str
+    :param timeout: max time to wait in seconds, defaults to DEFERRED_TIMEOUT_S
+    :type timeout: float, optional
+    :return: the score, or None if there was no pending score or it failed/timed out
+    :rtype: float | None
+    """
+    start_deferred(UID)
+    with _REGISTRY_LOCK:
+        deferred = _DEFERRED.pop(UID, None)
+    if deferred is None or deferred.future is None:
+        return None
+    try:
+        return deferred.future.result(timeout=timeout)
+    except Exception as e:
+        print(e)
+        return None
+
+
+def clear_deferred(UID: str) -> None:
+    """Forget pending score of user $UID.
+
+    :param UID: user ID
+    :type UID: str
+    """
+    with _REGISTRY_LOCK:
+        _DEFERRED.pop(UID, None)